@@ -0,0 +1,86 @@
+import numpy as np
+
+from note_arrays import PC_NAMES
+
+
+# a chord is the set of its pitch classes as a 12-bit mask (bit i = pitch class i, 0 = C), so the empty chord is 0;
+# the start and end symbols get the first codes above the masks
+EMPTY = 0
+START = 1 << 12
+END = START + 1
+NUM_CODES = END + 1
+
+_STEP_PCS = {'C': 0, 'D': 2, 'E': 4, 'F': 5, 'G': 7, 'A': 9, 'B': 11}
+
+
+def name_pitch_class(name: str) -> int:
+    """ pitch class of a note name in music21's notation (e.g. 'E-' -> 3, 'C#' -> 1) """
+    return (_STEP_PCS[name[0]] + name.count('#') - name.count('-')) % 12
+
+
+def chord_code(notes: list) -> int:
+    """ code of a chord given as a list of note names """
+    code = 0
+    for n in notes:
+        code |= 1 << name_pitch_class(n)
+    return code
+
+
+def code_pitch_classes(code: int) -> list:
+    """ the pitch classes of a chord code, from low to high """
+    return [pc for pc in range(12) if code >> pc & 1]
+
+
+class ChordVocab:
+    """ conversion between chord strings (sorted note names separated by spaces, like read_chord_file) and chord codes.
+        Chords with the same pitch classes get the same code whatever their spelling; a code is converted back to the
+        first spelling seen for it (or spelled with the first name seen for each pitch class).
+        The conversions are cached, so that each distinct chord string is only parsed once """
+    def __init__(self, names: tuple = PC_NAMES) -> None:
+        self.start = START
+        self.end = END
+        # spelling of each pitch class for the codes that were never seen as strings
+        self.names = list(names)
+        self._spelled = set()
+        self._codes = {'<s>': START, '<e>': END, '': EMPTY}
+        self._strings = {START: '<s>', END: '<e>', EMPTY: ''}
+
+    def __len__(self) -> int:
+        """ number of distinct chords seen """
+        return len(self._strings)
+
+    def encode(self, chord_str: str) -> int:
+        """ code of a chord string """
+        code = self._codes.get(chord_str)
+        if code is None:
+            notes = chord_str.split()
+            code = chord_code(notes)
+            self._codes[chord_str] = code
+            self._strings.setdefault(code, " ".join(sorted(notes)))
+            for n in notes:
+                pc = name_pitch_class(n)
+                if pc not in self._spelled:
+                    self._spelled.add(pc)
+                    self.names[pc] = n
+        return code
+
+    def decode(self, code: int) -> str:
+        """ chord string of a code """
+        code = int(code)
+        chord_str = self._strings.get(code)
+        if chord_str is None:
+            if not 0 <= code < START:
+                raise ValueError(f"{code} is not a chord code")
+            chord_str = self._strings[code] = " ".join(sorted(self.names[pc] for pc in code_pitch_classes(code)))
+        return chord_str
+
+    def encode_seq(self, chords) -> np.ndarray:
+        """ int array of the codes of a sequence of chord strings (an array of codes is returned as is) """
+        if isinstance(chords, np.ndarray) and chords.dtype.kind in 'iu':
+            return chords
+        return np.fromiter((c if isinstance(c, (int, np.integer)) else self.encode(c) for c in chords), dtype=np.int32,
+                           count=len(chords))
+
+    def decode_seq(self, codes) -> list:
+        """ list of the chord strings of a sequence of codes (strings are returned as is) """
+        return [c if isinstance(c, str) else self.decode(c) for c in codes]
@@ -1,13 +1,16 @@
 import argparse
 import random
 
+from chord_codes import ChordVocab
 from music21 import *
 from parse_chords import read_chord_file
 
-def compose(seq: list, show_score: bool = True):
+def compose(seq: list, show_score: bool = True, vocab: ChordVocab = None):
     """ transcribe the chord sequence from strings into music21 Stream.
-    seq: list[str], a list of strings representing chords.
+    seq: list[str], a list of strings representing chords (or chord codes, converted back with vocab).
     show_score: bool, if set to True, show the score (need MuseScore installed) """
+    if vocab is not None:
+        seq = vocab.decode_seq(seq)
     composition = stream.Stream()
     chord_streams = []
     for i, chord_str in enumerate(seq):
@@ -0,0 +1,229 @@
+import argparse
+import json
+import numpy as np
+import os
+import tempfile
+
+from chord_codes import ChordVocab
+from parse_chords import iter_chord_dir
+
+
+# a packed file (a corpus, or a saved ngram model): a magic string, the length of the json header (8 bytes, little endian),
+# the header, then the arrays, each aligned to ALIGN bytes so that they can be used straight from the memory map
+MAGIC = b"CHORDCORPUS\0"
+CORPUS_VERSION = 1
+CORPUS_EXT = ".corpus"
+ALIGN = 64
+# number of elements of an array written at a time
+WRITE_BLOCK = 1 << 20
+
+
+def corpus_file_path(chord_dir: str) -> str:
+    """ path of the packed corpus of a chord directory: chords/max3 -> chords/max3.corpus """
+    return os.path.normpath(chord_dir) + CORPUS_EXT
+
+
+def _aligned(n: int) -> int:
+    return -(-n // ALIGN) * ALIGN
+
+
+def list_chord_files(chord_dir: str) -> list:
+    """ sorted paths of the chord files in chord_dir and its subdirectories (hidden files are skipped, like read_chord_dir) """
+    fnames = []
+    for root, dirs, files in os.walk(chord_dir):
+        for filename in files:
+            if not filename.startswith('.'):
+                fnames.append(os.path.join(root, filename))
+    return sorted(fnames)
+
+
+def _source_stats(fnames: list, chord_dir: str) -> dict:
+    """ (size, mtime) of each chord file, to tell when the corpus is out of date """
+    stats = {}
+    for fname in fnames:
+        st = os.stat(fname)
+        stats[os.path.relpath(fname, chord_dir)] = [st.st_size, st.st_mtime_ns]
+    return stats
+
+
+def write_packed(fpath: str, magic: bytes, header: dict, arrays: dict) -> None:
+    """ write a packed file: magic, the json header (with the dtype, length and offset of each array added to it) and the
+        arrays, aligned so that read_packed can map them. The file is replaced atomically """
+    header["arrays"] = {}
+    offset = 0
+    for name, array in arrays.items():
+        header["arrays"][name] = [array.dtype.str, len(array), offset]
+        offset = _aligned(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode()
+
+    # write to a temporary file first: the old file may still be mapped by other processes
+    fdir = os.path.dirname(os.path.abspath(fpath))
+    if not os.path.isdir(fdir):
+        raise FileNotFoundError(f"can't write {fpath}: no directory {fdir}")
+    fd, tmp_fpath = tempfile.mkstemp(dir=fdir, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(magic + len(header_bytes).to_bytes(8, "little") + header_bytes)
+        data_start = _aligned(f.tell())
+        for name, array in arrays.items():
+            f.seek(data_start + header["arrays"][name][2])
+            # in blocks, so that arrays mapped from other files are copied without reading them into memory at once
+            for i in range(0, len(array), WRITE_BLOCK):
+                f.write(np.ascontiguousarray(array[i:i + WRITE_BLOCK]).tobytes())
+        # pad the end so that the last array is complete even if it's empty
+        f.truncate(data_start + offset)
+    os.chmod(tmp_fpath, 0o644)
+    os.replace(tmp_fpath, fpath)
+
+
+def read_packed(fpath: str, magic: bytes, version: int, kind: str = "packed file") -> tuple:
+    """ open a packed file written by write_packed with a memory map.
+        returns the header and a dict of the arrays (read-only views of the file);
+        raises ValueError if it isn't a packed file of this kind (magic, described as kind in the error) and version """
+    with open(fpath, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(f"{fpath} is not a {kind}")
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    if header["version"] != version:
+        raise ValueError(f"{fpath} has version {header['version']}, expected {version}")
+
+    data = np.memmap(fpath, dtype=np.uint8, mode="r")
+    data_start = _aligned(len(magic) + 8 + header_len)
+    arrays = {}
+    for name, (dtype, length, offset) in header["arrays"].items():
+        start = data_start + offset
+        arrays[name] = data[start:start + length * np.dtype(dtype).itemsize].view(dtype)
+    return header, arrays
+
+
+class ChordCorpus:
+    """ a packed corpus opened with a memory map: the arrays are views of the file, so opening takes constant time and
+        processes that open the same corpus share its pages.
+        chords: int32 array of the chord codes of all the pieces (see chord_codes), each piece starting with <s> and ending with <e>;
+        keys: int16 array of key codes (indices into key_names), empty if the corpus has no keys (not per measure);
+        piece_offsets, key_offsets: piece i is chords[piece_offsets[i]:piece_offsets[i + 1]] (same for keys) """
+    def __init__(self, corpus_fpath: str) -> None:
+        self.path = corpus_fpath
+        header, arrays = read_packed(corpus_fpath, MAGIC, CORPUS_VERSION, "chord corpus")
+        self.header = header
+        self.piece_names = header["pieces"]
+        self.key_names = header["key_names"]
+        self._vocab = None
+
+        self.chords = arrays["chords"]
+        self.keys = arrays["keys"]
+        self.piece_offsets = arrays["piece_offsets"]
+        self.key_offsets = arrays["key_offsets"]
+
+    @property
+    def vocab(self) -> ChordVocab:
+        """ vocab converting the codes back to the chord strings, as spelled in the chord files """
+        if self._vocab is None:
+            self._vocab = ChordVocab()
+            for chord_str in self.header["chords"]:
+                self._vocab.encode(chord_str)
+        return self._vocab
+
+    def __len__(self) -> int:
+        """ number of pieces """
+        return len(self.piece_names)
+
+    def piece(self, i: int) -> tuple:
+        """ (key codes, chord codes) of the i-th piece """
+        return (self.keys[self.key_offsets[i]:self.key_offsets[i + 1]],
+                self.chords[self.piece_offsets[i]:self.piece_offsets[i + 1]])
+
+    def pieces(self):
+        """ generator over the pieces, like parse_chords.iter_chord_dir with vocab=self.vocab:
+            yields (piece name, list of keys, array of chord codes) """
+        for i, name in enumerate(self.piece_names):
+            keys, chords = self.piece(i)
+            yield name, self.key_strings(keys), chords
+
+    def key_strings(self, keys: np.ndarray = None) -> list:
+        """ the key names of key codes (defaults to all the keys of the corpus) """
+        if keys is None:
+            keys = self.keys
+        return [self.key_names[k] for k in keys.tolist()]
+
+    def read(self) -> tuple:
+        """ the same view as read_chord_dir(chord_dir, vocab=self.vocab): 1) a list of keys; 2) the array of chord codes """
+        return self.key_strings(), self.chords
+
+
+def build_corpus(chord_dir: str, corpus_fpath: str = None) -> str:
+    """ pack the chord files of chord_dir (e.g. chords/max3) into one corpus file (defaults to chords/max3.corpus).
+        returns the path of the corpus (raises NotADirectoryError if chord_dir isn't a directory) """
+    if not os.path.isdir(chord_dir):
+        raise NotADirectoryError(f"{chord_dir} is not a directory of chord files")
+    if corpus_fpath is None:
+        corpus_fpath = corpus_file_path(chord_dir)
+    fnames = list_chord_files(chord_dir)
+    vocab = ChordVocab()
+    pieces, all_keys, all_chords = [], [], []
+    for name, keys, chords in iter_chord_dir(chord_dir, vocab=vocab):
+        pieces.append(name)
+        all_keys.append(keys)
+        all_chords.append(chords)
+
+    key_names = sorted({k for keys in all_keys for k in keys})
+    key_to_code = {k: i for i, k in enumerate(key_names)}
+    arrays = {
+        "chords": np.concatenate(all_chords).astype(np.int32) if all_chords else np.zeros(0, dtype=np.int32),
+        "keys": np.array([key_to_code[k] for keys in all_keys for k in keys], dtype=np.int16),
+        "piece_offsets": np.concatenate(([0], np.cumsum([len(c) for c in all_chords], dtype=np.int64))),
+        "key_offsets": np.concatenate(([0], np.cumsum([len(k) for k in all_keys], dtype=np.int64))),
+    }
+    header = {
+        "version": CORPUS_VERSION,
+        "pieces": pieces,
+        "key_names": key_names,
+        "chords": [vocab.decode(code) for code in np.unique(arrays["chords"]).tolist()],
+        "sources": _source_stats(fnames, chord_dir),
+    }
+    write_packed(corpus_fpath, MAGIC, header, arrays)
+    return corpus_fpath
+
+
+def open_corpus(corpus_fpath: str) -> ChordCorpus:
+    """ open a packed corpus file (constant time: nothing is read until it's used) """
+    return ChordCorpus(corpus_fpath)
+
+
+def load_corpus(chord_dir: str, check: bool = True) -> ChordCorpus:
+    """ open the packed corpus of chord_dir, building it first if it doesn't exist (see build_corpus).
+        check: also rebuild it if the chord files changed since it was built (this lists the directory, without reading the files) """
+    corpus_fpath = corpus_file_path(chord_dir)
+    if os.path.exists(corpus_fpath):
+        corpus = open_corpus(corpus_fpath)
+        if not check or corpus.header["sources"] == _source_stats(list_chord_files(chord_dir), chord_dir):
+            return corpus
+    build_corpus(chord_dir, corpus_fpath)
+    return open_corpus(corpus_fpath)
+
+
+def main(args):
+    for chord_dir in args.dirs:
+        corpus_fpath = build_corpus(chord_dir)
+        corpus = open_corpus(corpus_fpath)
+        print(f"packed {len(corpus)} pieces, {len(corpus.chords)} chords ({len(corpus.vocab)} distinct) into {corpus_fpath}")
+
+
+def dir_path(string):
+    if os.path.isdir(string):
+        return string
+    else:
+        raise NotADirectoryError(string)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "dirs",
+        type=dir_path,
+        nargs="+",
+        help="chord directories (e.g. chords/max3) to pack into chords/max3.corpus",
+    )
+    args = parser.parse_args()
+
+    main(args)
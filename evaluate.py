@@ -1,6 +1,9 @@
 import glob
+import numpy as np
 import os
 
+from chord_codes import ChordVocab
+from corpus import load_corpus
 from music21 import *
 from parse_chords import read_chord_dir, read_chord_file
 
@@ -10,31 +13,23 @@ def lcs(X, Y):
     source: https://www.geeksforgeeks.org/longest-common-substring-dp-29/
 
     returns the length of the longest common sequential subsequence for two lists of chords: X and Y
+    (chord strings or chord codes, see chord_codes)
     """
-    
-    # find the length of the lists
-    m = len(X)
-    n = len(Y)
-
-    # LCSuff is the table with zero
-    # value initially in each cell
-    LCSuff = [[0 for k in range(n+1)] for l in range(m+1)]
- 
+    X = np.asarray(X)
+    Y = np.asarray(Y)
+
     # To store the length of
     # longest common substring
     result = 0
- 
-    # Following steps to build
-    # LCSuff[m+1][n+1] in bottom up fashion
-    for i in range(m + 1):
-        for j in range(n + 1):
-            if (i == 0 or j == 0):
-                LCSuff[i][j] = 0
-            elif (X[i-1] == Y[j-1]):
-                LCSuff[i][j] = LCSuff[i-1][j-1] + 1
-                result = max(result, LCSuff[i][j])
-            else:
-                LCSuff[i][j] = 0
+
+    # build the LCSuff table one row at a time: LCSuff[i][j] is LCSuff[i-1][j-1] + 1 where X[i-1] == Y[j-1], else 0
+    # (only the previous row is kept)
+    prev_row = np.zeros(len(Y) + 1, dtype=np.int64)
+    for x in X:
+        row = np.zeros(len(Y) + 1, dtype=np.int64)
+        row[1:] = np.where(Y == x, prev_row[:-1] + 1, 0)
+        result = max(result, int(row.max()))
+        prev_row = row
     return result
 
 
@@ -53,10 +48,13 @@ def generate_lcs_evaluations(gen_directory, piece_dir):
 
     lcs_list = []
 
-    _, all_chords = read_chord_dir(chord_path)
+    # compare chord codes rather than strings
+    corpus = load_corpus(chord_path)
+    vocab = corpus.vocab
+    _, all_chords = corpus.read()
     for filepath in glob.glob(f"{gen_path}/**/*.txt", recursive=True):
         with open(filepath, 'r') as f:
-            _, gen_seq = read_chord_file(f)
+            _, gen_seq = read_chord_file(f, vocab=vocab)
             # longest common subsequence between the current generated sequence and our corpus
             cur_lcs = lcs(gen_seq, all_chords)
             lcs_list.append(cur_lcs)
@@ -76,14 +74,17 @@ def is_sublist(a, b):
             return True
     return False
 
-def same_sequence_number(sequence, comp_dir):
+def same_sequence_number(sequence, comp_dir, vocab: ChordVocab = None):
     """
     takes in a sequence of chords and returns the number of pieces in the ghibli corpus
     that have the same sequence of roots as the given chord sequence
+    (chord strings, or chord codes converted back with vocab)
     """
     root_list = []
     piece_count = 0
     dir = os.path.join("roots", comp_dir)
+    if vocab is not None:
+        sequence = vocab.decode_seq(sequence)
 
     # construct chords using .split 
     for chord_in_seq in sequence:
@@ -1,6 +1,7 @@
 import os
 
 from baseline import *
+from corpus import load_corpus
 from evaluate import generate_lcs_evaluations, generate_ssn_evaluation
 from hmm import *
 from ngrams import *
@@ -15,6 +16,8 @@ seq_len_experiments = [4, 8, 12]
 num_seqs = 100
 # ngrams-specific experiments
 n_experiments = [2, 3, 5, 7, 9]
+# pruning of the ngram counts, as arguments of NgramTrie.prune (e.g. {"min_count": 2}); empty: no pruning
+ngram_pruning = {}
 # hmm-specific experiments: emission method
 hmm_methods = ["best", "prob"]
 # rnn-specific experiments
@@ -62,21 +65,27 @@ def gen_outputs(baseline: bool = True, ngrams: bool = True, hmm: bool = True, rn
         # maxnote
         for maxnote in maxnote_experiments:
             chord_dir = os.path.join("chords", maxnote)
-            # get chords from training corpus
-            _, chord_list = read_chord_dir(chord_dir)
+            # get chords from training corpus (as codes, from the packed corpus)
+            corpus = load_corpus(chord_dir)
+            vocab = corpus.vocab
+            _, chord_list = corpus.read()
+            # count the ngrams of every n in one pass
+            trie = NgramTrie(max(n_experiments), vocab=vocab)
+            trie.update(chord_list)
+            if ngram_pruning:
+                trie.prune(**ngram_pruning)
             output_maxnote_dir = gen_dir(os.path.join(output_dir, maxnote))
             # n
             for n in n_experiments:
                 output_n_dir = gen_dir(os.path.join(output_maxnote_dir, f"n{n}"))
-                # build the ngram model
-                m = NgramModel(n)
-                m.update(chord_list)
+                # the ngram model of order n
+                m = trie.model(n)
                 # seq_len
                 for seq_len in seq_len_experiments:
                     output_seq_dir = gen_dir(os.path.join(output_n_dir, f"seq{seq_len}"))
-                    for i in range(num_seqs):
-                        # generate a sequence
-                        seq = m.generate(seq_len)
+                    # generate all the sequences at once
+                    seqs = m.decode_batch(m.generate_batch(num_seqs, seq_len))
+                    for i, seq in enumerate(seqs):
                         filepath = os.path.join(output_seq_dir, f"{i}.txt")
                         write_seq_to_file(seq, filepath)
         
@@ -90,8 +99,10 @@ def gen_outputs(baseline: bool = True, ngrams: bool = True, hmm: bool = True, rn
             if not maxnote.endswith("_per_mm"):
                 continue
             chord_dir = os.path.join("chords", maxnote)
-            # get keys and chords from training corpus
-            key_list, chord_list = read_chord_dir(chord_dir)
+            # get keys and chords from training corpus (as codes, from the packed corpus)
+            corpus = load_corpus(chord_dir)
+            vocab = corpus.vocab
+            key_list, chord_list = corpus.read()
             output_maxnote_dir = gen_dir(os.path.join(output_dir, maxnote))
             # emission method
             for emission_method in hmm_methods:
@@ -100,13 +111,13 @@ def gen_outputs(baseline: bool = True, ngrams: bool = True, hmm: bool = True, rn
                 for n in n_experiments:
                     output_n_dir = gen_dir(os.path.join(output_m_dir, f"n{n}"))
                     # build the ngram model
-                    m = HMM(n, key_list, chord_list)
+                    m = HMM(n, key_list, chord_list, vocab=vocab)
                     # seq_len
                     for seq_len in seq_len_experiments:
                         output_seq_dir = gen_dir(os.path.join(output_n_dir, f"seq{seq_len}"))
-                        for i in range(num_seqs):
-                            # generate a sequence
-                            _, seq = m.generate(seq_len, gen_chord_method=emission_method)
+                        # generate all the sequences at once
+                        _, seqs = m.decode_batch(*m.generate_batch(num_seqs, seq_len, gen_chord_method=emission_method))
+                        for i, seq in enumerate(seqs):
                             filepath = os.path.join(output_seq_dir, f"{i}.txt")
                             write_seq_to_file(seq, filepath)
     # =====
@@ -3,43 +3,366 @@ import numpy as np
 import os
 import random 
 
-from collections import Counter
+from chord_codes import ChordVocab
 from compose import compose
+from itertools import accumulate
 from ngrams import NgramModel
 from nltk import ngrams
 from nltk import NaiveBayesClassifier
-from parse_chords import read_chord_dir, read_chord_file
+from parse_chords import iter_chord_dir, read_chord_dir, read_chord_file
 from tokenize import String
 from typing import List
 
 
+# keys of a KeyNgramModel are ids below RADIX, and a context is the number written with the ids of its keys in base RADIX
+RADIX = 32
+
+
+def _length_chunks(lengths: np.ndarray, chunk_size: int):
+    """ generator over the indices of chunks of at most chunk_size sequences, shortest first (so that a chunk doesn't step
+        through the padding of a few long sequences) """
+    order = np.argsort(lengths, kind='stable')
+    for i in range(0, len(order), chunk_size):
+        yield order[i:i + chunk_size]
+
+
+class KeyNgramModel(NgramModel):
+    """
+    the ngram model of the keys of an HMM as arrays: the key alphabet is tiny (12 tonics with their spellings, NC, <s>, <e>),
+    so each key is an id (index into self.keys, in order of first appearance) and each context of n-1 keys an integer
+    (the oldest key in the highest digit); counts[i, k] is the count of key id k after the context codes[i] (codes sorted),
+    and first[i, k] the position of its first occurrence, which orders the candidates like NgramModel.
+    update only encodes the ngrams; they are added to the arrays the next time the counts are used
+    """
+    def __init__(self, n: int, verbose: bool = False):
+        super().__init__(n, verbose=verbose)
+        if RADIX ** (n - 1) > np.iinfo(np.int64).max // RADIX:
+            raise ValueError(f"N for a key ngram model must be at most {int(np.log(np.iinfo(np.int64).max) / np.log(RADIX))}.")
+        self.keys = [self.start]
+        self.key_ids = {self.start: 0}
+        self.codes = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros((0, RADIX), dtype=np.int64)
+        self.first = np.zeros((0, RADIX), dtype=np.int64)
+        # number of ngrams counted so far (positions of first occurrences)
+        self.num_ngrams = 0
+        # the ngrams (context code * RADIX + key id) of the updates not added to the arrays yet
+        self.pending = []
+        # row of each context code, built when first needed (see row)
+        self.rows = None
+
+    def update(self, chord_list) -> None:
+        """
+        count the ngrams of a sequence of keys at once, like NgramModel.update
+        chord_list: the keys (strings), in sequential order
+        """
+        self.sampling_tables = {"prob": {}, "semi": {}}
+        self.batch_sampling_tables = {}
+        ids = np.array([self.key_ids.setdefault(k, len(self.key_ids)) for k in chord_list], dtype=np.int64)
+        self.keys = list(self.key_ids)
+        if len(self.keys) > RADIX:
+            raise ValueError(f"a key ngram model can't have more than {RADIX} keys")
+        # a start symbol stands for n-1 of them
+        ids = np.repeat(ids, np.where(ids == self.key_ids[self.start], self.n - 1, 1))
+        if len(ids) < self.n:
+            return
+        windows = np.lib.stride_tricks.sliding_window_view(ids, self.n)
+        self.pending.append(windows[:, :-1] @ (RADIX ** np.arange(self.n - 2, -1, -1, dtype=np.int64)) * RADIX + windows[:, -1])
+
+    def _flush(self) -> None:
+        """ add the ngrams of the updates since the counts were last used to the arrays, at once """
+        if not self.pending:
+            return
+        ngrams = np.concatenate(self.pending)
+        self.pending = []
+        ngrams, first, inverse = np.unique(ngrams, return_index=True, return_inverse=True)
+        self._add(ngrams, np.bincount(inverse, minlength=len(ngrams)), self.num_ngrams + first)
+        self.num_ngrams += len(inverse)
+
+    def _add(self, ngrams: np.ndarray, counts: np.ndarray, first: np.ndarray) -> None:
+        """ add the counts of unique ngrams (context code * RADIX + key id) first seen at positions first to the arrays """
+        # the rows of the new contexts are added in one go
+        codes = np.union1d(self.codes, ngrams // RADIX)
+        old_rows = np.searchsorted(codes, self.codes)
+        all_counts = np.zeros((len(codes), RADIX), dtype=np.int64)
+        all_first = np.full((len(codes), RADIX), np.iinfo(np.int64).max)
+        all_counts[old_rows] = self.counts
+        all_first[old_rows] = self.first
+        rows, next_ids = np.searchsorted(codes, ngrams // RADIX), ngrams % RADIX
+        all_counts[rows, next_ids] += counts
+        all_first[rows, next_ids] = np.minimum(all_first[rows, next_ids], first)
+        self.codes, self.counts, self.first = codes, all_counts, all_first
+        self.rows = None
+
+    def merge(self, other: "KeyNgramModel") -> "KeyNgramModel":
+        """
+        add the counts of another key model of the same order to this model (see NgramModel.merge); the keys of the other
+        model get the ids of this model. Returns self
+        """
+        if other.n != self.n:
+            raise ValueError(f"can't merge a model of order {other.n} into a model of order {self.n}")
+        self._flush()
+        other._flush()
+        self.sampling_tables = {"prob": {}, "semi": {}}
+        self.batch_sampling_tables = {}
+        ids = np.array([self.key_ids.setdefault(k, len(self.key_ids)) for k in other.keys], dtype=np.int64)
+        self.keys = list(self.key_ids)
+        if len(self.keys) > RADIX:
+            raise ValueError(f"a key ngram model can't have more than {RADIX} keys")
+        rows, next_ids = np.nonzero(other.counts)
+        digits = other.codes[rows, None] // RADIX ** np.arange(self.n - 2, -1, -1, dtype=np.int64) % RADIX
+        ngrams = ids[digits] @ (RADIX ** np.arange(self.n - 2, -1, -1, dtype=np.int64)) * RADIX + ids[next_ids]
+        # the other model's ngrams come after the ones of this model, in their order
+        self._add(ngrams, other.counts[rows, next_ids], self.num_ngrams + other.first[rows, next_ids])
+        self.num_ngrams += other.num_ngrams
+        return self
+
+    def prune(self, min_count: int = 1, max_contexts: int = None, min_entropy: float = None) -> "KeyNgramModel":
+        """ NgramModel.prune on the arrays (the same contexts and counts are kept). Returns self """
+        self._flush()
+        self.sampling_tables = {"prob": {}, "semi": {}}
+        self.batch_sampling_tables = {}
+        counts = np.where(self.counts >= min_count, self.counts, 0)
+        totals = counts.sum(axis=1)
+        keep = totals > 0
+        first_code = self.encode((self.start,) * (self.n - 1))
+        is_first = self.codes == first_code
+        if min_entropy is not None:
+            # the distribution of the next keys after the shorter contexts (without their oldest key), from the same counts
+            shorter_codes, shorter = np.unique(self.codes % RADIX ** (self.n - 2), return_inverse=True)
+            shorter_counts = np.zeros((len(shorter_codes), RADIX), dtype=np.int64)
+            np.add.at(shorter_counts, shorter, counts)
+            # (summed in order of first appearance, like NgramModel)
+            src, next_ids = np.nonzero(counts)
+            order = np.lexsort((self.first[src, next_ids], src))
+            src, next_ids = src[order], next_ids[order]
+            p = counts[src, next_ids] / totals[src]
+            shorter_totals = shorter_counts.sum(axis=1)[shorter[src]]
+            entropy = np.bincount(src, minlength=len(self.codes), weights=p * np.log2(
+                p * shorter_totals / shorter_counts[shorter[src], next_ids]))
+            keep &= is_first | (totals / totals.sum() * entropy >= min_entropy)
+        if max_contexts is not None and keep.sum() > max_contexts:
+            # the most frequent contexts (the earliest seen first among the same counts)
+            kept = np.flatnonzero(keep)
+            first_seen = np.where(counts[kept] > 0, self.first[kept], np.iinfo(np.int64).max).min(axis=1)
+            order = np.lexsort((first_seen, -totals[kept], ~is_first[kept]))
+            keep[kept[order[max_contexts:]]] = False
+        self.codes, self.counts, self.first = self.codes[keep], counts[keep], self.first[keep]
+        self.rows = None
+        return self
+
+    def encode(self, context: tuple) -> int:
+        """ code of a context of keys (-1 if a key was never seen) """
+        code = 0
+        for k in context:
+            key_id = self.key_ids.get(k)
+            if key_id is None:
+                return -1
+            code = code * RADIX + key_id
+        return code
+
+    def row(self, context: tuple) -> int:
+        """ row of a context in the count arrays (-1 if it was never seen) """
+        self._flush()
+        if self.rows is None:
+            self.rows = {code: i for i, code in enumerate(self.codes.tolist())}
+        return self.rows.get(self.encode(context), -1) if len(context) == self.n - 1 else -1
+
+    def transitions(self) -> dict:
+        """
+        all the ngrams as flat arrays, grouped by context row and in order of first appearance within a context:
+        from row src to key id next (to row dst, -1 if the new context was never seen), count times;
+        the ngrams of row i are offsets[i]:offsets[i + 1]
+        """
+        self._flush()
+        src, next_ids = np.nonzero(self.counts)
+        order = np.lexsort((self.first[src, next_ids], src))
+        src, next_ids = src[order], next_ids[order]
+        new_codes = (self.codes[src] * RADIX + next_ids) % RADIX ** (self.n - 1)
+        dst = np.minimum(np.searchsorted(self.codes, new_codes), max(len(self.codes) - 1, 0))
+        dst = np.where(self.codes[dst] == new_codes, dst, -1) if len(self.codes) else dst
+        return {
+            "src": src,
+            "next": next_ids,
+            "dst": dst,
+            "count": self.counts[src, next_ids],
+            "offsets": np.concatenate(([0], np.cumsum(np.count_nonzero(self.counts, axis=1)))),
+        }
+
+    def successor_counts(self, context: tuple) -> tuple:
+        i = self.row(context)
+        if i < 0:
+            raise KeyError(context)
+        next_ids = np.flatnonzero(self.counts[i])
+        next_ids = next_ids[np.argsort(self.first[i, next_ids], kind='stable')]
+        counts = self.counts[i, next_ids]
+        return [self.keys[k] for k in next_ids.tolist()], counts.tolist(), int(counts.sum())
+
+    def resolve_context(self, context: tuple):
+        return context if self.row(context) >= 0 else None
+
+    def batch_contexts(self) -> list:
+        self._flush()
+        digits = self.codes[:, None] // RADIX ** np.arange(self.n - 2, -1, -1, dtype=np.int64) % RADIX
+        return [tuple(self.keys[k] for k in row) for row in digits.tolist()]
+
+    def prob(self, context: tuple, next_chord: str):
+        """
+        Calculates probability of a candidate key to be generated given a context;
+        Returns conditional probability
+        """
+        i = self.row(context)
+        key_id = self.key_ids.get(next_chord)
+        if i < 0 or key_id is None:
+            return 0.0
+        return self.counts[i, key_id] / self.counts[i].sum()
+
+    def row_tables(self) -> list:
+        """ the sampling table of each row for generate: (candidate keys, their cumulative probabilities, their next rows) """
+        tables = self.batch_sampling_tables.get("rows")
+        if tables is None:
+            t = self.transitions()
+            next_keys = [self.keys[k] for k in t["next"].tolist()]
+            counts, dst, offsets = t["count"].tolist(), t["dst"].tolist(), t["offsets"].tolist()
+            tables = self.batch_sampling_tables["rows"] = []
+            for start, end in zip(offsets[:-1], offsets[1:]):
+                total = sum(counts[start:end])
+                tables.append((next_keys[start:end], list(accumulate(count / total for count in counts[start:end])),
+                               dst[start:end]))
+        return tables
+
+    def generate(self, seq_len: int, method: str = "prob", as_codes: bool = False):
+        """ NgramModel.generate following the rows of the arrays (the same keys for the same random state) """
+        if method != "prob" or self.verbose:
+            return super().generate(seq_len, method=method, as_codes=as_codes)
+        tables = self.row_tables()
+        row = self.row((self.start,) * (self.n - 1))
+        result = []
+        for i in range(seq_len):
+            if row < 0:
+                break
+            next_keys, cum_probs, next_rows = tables[row]
+            j = random.choices(range(len(next_keys)), cum_weights=cum_probs, k=1)[0]
+            result.append(next_keys[j])
+            if next_keys[j] == self.end:
+                break
+            row = next_rows[j]
+        return result
+
+    def batch_tokens(self) -> list:
+        """ the keys, by id """
+        return self.keys
+
+    def batch_tables(self, method: str = "prob") -> dict:
+        """ NgramModel.batch_tables straight from the arrays (the tokens are the keys, the contexts the rows) """
+        if method != "prob":
+            return super().batch_tables(method)
+        tables = self.batch_sampling_tables.get(method)
+        if tables is not None:
+            return tables
+        t = self.transitions()
+        num_candidates = np.diff(t["offsets"])
+        # the probabilities of each context in a row, accumulated along the rows like accumulate in sampling_table
+        width = int(num_candidates.max()) if len(num_candidates) else 0
+        columns = np.arange(len(t["src"])) - t["offsets"][t["src"]]
+        probs = np.zeros((len(num_candidates), width))
+        probs[t["src"], columns] = t["count"] / self.counts.sum(axis=1)[t["src"]]
+        cum_probs = np.cumsum(probs, axis=1)[t["src"], columns]
+        start_row = self.row((self.start,) * (self.n - 1))
+        tables = self.batch_sampling_tables[method] = {
+            "tokens": self.keys,
+            "token": t["next"].astype(np.int32),
+            "cum_probs": cum_probs + t["src"],
+            "next_context": t["dst"],
+            "offsets": t["offsets"],
+            "start": start_row,
+            "end": self.key_ids.get(self.end, -1),
+        }
+        return tables
+
+    def memory_report(self) -> dict:
+        """ memory of the count arrays (see NgramModel.memory_report) """
+        self._flush()
+        return {self.n: {
+            "contexts": len(self.codes),
+            "ngrams": int(np.count_nonzero(self.counts)),
+            "bytes": self.codes.nbytes + self.counts.nbytes + self.first.nbytes,
+        }}
+
+
 class HMM(object):
-    def __init__(self, order: int, keys: list, chords: list, verbose: bool = False):
+    def __init__(self, order: int, keys: list = (), chords: list = (), verbose: bool = False, vocab: ChordVocab = None,
+                 sparse: bool = False):
         """
         order: number of previous hidden states to look at in order to generate the next hidden state;
         keys: a list of keys (hidden states);
-        chords: a list of chord strings (observed states)
+        chords: a list of chord strings (observed states), or of chord codes with a vocab;
+        (keys and chords can also be added one piece at a time with update_pieces)
+        vocab: if given, the chords are stored as integer codes (see chord_codes) and generate returns chord strings
+               (or codes with as_codes=True);
+        sparse: store the emission matrix as a scipy.sparse CSR matrix, whose size is the number of (key, chord) pairs seen
+                instead of keys x chords
         """
         self.verbose = verbose
         self.order = order
-        self.keys = keys
-        self.chords = chords
-        # make sure that each key is corresponded to each chord in the training data
-        assert(len(self.keys) == len(self.chords))
+        self.vocab = vocab
+        self.sparse = sparse
+
+        # an ngram for keys
+        self.key_ngram = KeyNgramModel(self.order, verbose=self.verbose)
+        # ids of the keys and chords in the order they're first seen, and the (key, chord) pairs of each piece added
+        # since the last build_emissions as arrays of key id * number of chords + chord id (see add_piece)
+        self.key_ids, self.chord_ids = {}, {}
+        self.pending = []
+        # number of times each (key, chord) pair appears in the training data, as arrays of key ids, chord ids and counts
+        self.pair_keys = self.pair_chords = np.zeros(0, dtype=np.int64)
+        self.pair_counts = np.zeros(0)
+        self.update(keys, chords)
 
-        # build an ngram for keys
-        self.key_ngram = NgramModel(self.order, verbose=self.verbose)
+    def add_piece(self, keys: list, chords: list) -> None:
+        """ count the keys and chords of a piece (call build_emissions once all the pieces are added) """
+        if self.vocab is not None:
+            chords = self.vocab.encode_seq(chords)
+        # make sure that each key is corresponded to each chord in the training data
+        assert(len(keys) == len(chords))
         self.key_ngram.update(keys)
+        if not len(keys):
+            return
+        # look up the ids of the piece's unique keys and chords only, then encode its (key, chord) pairs;
+        # they're counted all at once by build_emissions
+        piece_keys, key_idx = np.unique(np.asarray(keys), return_inverse=True)
+        piece_chords, chord_idx = np.unique(np.asarray(chords), return_inverse=True)
+        key_ids = np.array([self.key_ids.setdefault(key, len(self.key_ids)) for key in piece_keys.tolist()], dtype=np.int64)
+        chord_ids = np.array([self.chord_ids.setdefault(chord, len(self.chord_ids)) for chord in piece_chords.tolist()],
+                             dtype=np.int64)
+        # the number of chords can still grow, so it's stored with the pairs
+        self.pending.append((key_ids[key_idx] * len(self.chord_ids) + chord_ids[chord_idx], len(self.chord_ids)))
+
+    def update(self, keys: list, chords: list) -> None:
+        """ add the keys and chords of the training data and rebuild the emission matrix """
+        self.add_piece(keys, chords)
+        self.build_emissions()
 
-        # a list of all unique keys        
+    def update_pieces(self, pieces) -> None:
+        """
+        add the training data one piece at a time, so that only one piece needs to be in memory, then rebuild the emission matrix;
+        pieces: an iterable of (name, keys, chords), e.g. parse_chords.iter_chord_dir or ChordCorpus.pieces
+        """
+        for _, keys, chords in pieces:
+            self.add_piece(keys, chords)
+        self.build_emissions()
+
+    def build_emissions(self) -> None:
+        """ build the emission matrix from the counts of the pieces added so far """
+        self.count_pairs()
+        # a list of all unique keys
         # (index of each key in this list corresponds to the row in the emission matrix)
-        self.unique_keys = list(set(keys))
+        self.unique_keys = sorted(self.key_ids)
         # mapping from a key string to its index in unique_keys
         self.key_to_idx = self.build_idx_mapping(self.unique_keys)
 
         # a list of all unique chords 
         # (index of each chord in this list corresponds to the column in the emission matrix)
-        self.unique_chords = list(set(chords))
+        self.unique_chords = sorted(self.chord_ids)
         # mapping from a chord string to its index in unique_chords
         self.chord_to_idx = self.build_idx_mapping(self.unique_chords)
 
@@ -52,6 +375,25 @@ class HMM(object):
         # each key's value is a list of probability for each possible chord string (fixed index from unique_chords)
         self.key_chord_probs = self.build_key_chord_probs()
         # print(self.key_chord_probs)
+        # sampling tables of the emissions (see emission_table and batch_tables), built when they're first used
+        self.emission_tables = {}
+        self.batch_emission_tables = None
+        # log probabilities of the transitions and emissions for decode (see viterbi_tables)
+        self.decode_tables = None
+
+    def count_pairs(self) -> None:
+        """ add the (key, chord) pairs of the pieces added since the last call to pair_keys, pair_chords and pair_counts """
+        if not self.pending:
+            return
+        num_chords = len(self.chord_ids)
+        # re-encode every pair with the current number of chords, and count them with a single bincount
+        codes = np.concatenate([self.pair_keys * num_chords + self.pair_chords]
+                               + [pairs // width * num_chords + pairs % width for pairs, width in self.pending])
+        weights = np.concatenate([self.pair_counts] + [np.ones(len(pairs)) for pairs, _ in self.pending])
+        codes, inverse = np.unique(codes, return_inverse=True)
+        self.pair_counts = np.bincount(inverse, weights=weights, minlength=len(codes))
+        self.pair_keys, self.pair_chords = np.divmod(codes, num_chords)
+        self.pending = []
 
     def build_idx_mapping(self, from_unique_list: list) -> dict:
         """ 
@@ -65,29 +407,78 @@ class HMM(object):
             mapping[feature] = i
         return mapping
     
-    def build_key_chord_probs(self) -> np.array:
+    def build_key_chord_probs(self):
         """
-        build the emission matrix, with keys as the hidden states and chord strings as the observed states
+        build the emission matrix, with keys as the hidden states and chord strings as the observed states:
+        a (number of keys, number of chords) array, or a scipy.sparse CSR matrix with sparse=True
+        (a key without any chord would get a row of zeros)
         """
+        num_keys, num_chords = len(self.unique_keys), len(self.unique_chords)
+        # the (key, chord) pairs seen, as indices into the matrix (from the ids in the order they were first seen)
+        key_rows = np.array([self.key_to_idx[key] for key in self.key_ids], dtype=np.int64)
+        chord_cols = np.array([self.chord_to_idx[chord] for chord in self.chord_ids], dtype=np.int64)
+        key_idx, chord_idx, counts = key_rows[self.pair_keys], chord_cols[self.pair_chords], self.pair_counts
+        key_totals = np.bincount(key_idx, weights=counts, minlength=num_keys)
+        # turn counts into probabilities
+        probs = counts / np.where(key_totals > 0, key_totals, 1)[key_idx]
+
+        if self.sparse:
+            from scipy.sparse import csr_matrix
+            # rows in key order, and the chords of a row in chord order
+            order = np.lexsort((chord_idx, key_idx))
+            indptr = np.concatenate(([0], np.cumsum(np.bincount(key_idx, minlength=num_keys))))
+            return csr_matrix((probs[order], chord_idx[order], indptr), shape=(num_keys, num_chords))
         # [
-        #   [count_0, count_1, ...] # (for key0)
-        #   [count_0, count_1, ...] # (for key1)
+        #   [prob_0, prob_1, ...] # (for key0)
+        #   [prob_0, prob_1, ...] # (for key1)
         #   ...
         # ]
-        key_chord_counts = np.zeros((len(self.unique_keys), len(self.unique_chords)))
-        for i in range(len(self.keys)):
-            key = self.keys[i]
-            key_idx = self.key_to_idx[key]
-            chord = self.chords[i]
-            chord_idx = self.chord_to_idx[chord]
+        return np.bincount(key_idx * num_chords + chord_idx, weights=probs,
+                           minlength=num_keys * num_chords).reshape(num_keys, num_chords)
 
-            # increment the count of this chord in this key
-            key_chord_counts[key_idx][chord_idx] += 1
-        
-        # turn counts into probabilities
-        return (key_chord_counts.transpose() / key_chord_counts.sum(axis=1)).transpose()
+    def emission_probs(self, key_idx: int) -> tuple:
+        """ the chords a key can emit (indices into unique_chords) and their probabilities """
+        if self.sparse:
+            start, end = self.key_chord_probs.indptr[key_idx], self.key_chord_probs.indptr[key_idx + 1]
+            return self.key_chord_probs.indices[start:end], self.key_chord_probs.data[start:end]
+        chord_probs = self.key_chord_probs[key_idx]
+        return np.arange(len(chord_probs)), chord_probs
+
+    def emission_table(self, key_idx: int) -> tuple:
+        """
+        the chords a key can emit (indices into unique_chords) and their cumulative probabilities, to draw a chord
+        with a binary search (as given to random.choices); built the first time a key is used
+        """
+        table = self.emission_tables.get(key_idx)
+        if table is None:
+            chord_idx, chord_probs = self.emission_probs(key_idx)
+            table = self.emission_tables[key_idx] = (chord_idx.tolist(), list(accumulate(chord_probs.tolist())))
+        return table
+
+    def batch_tables(self) -> dict:
+        """
+        the emission tables of every key as flat arrays, for generate_batch: the chords of key i are the entries
+        offsets[i]:offsets[i + 1] of chord (indices into unique_chords), with their cumulative probabilities plus i in cum_probs
+        (so that one searchsorted finds the chord of every key); best: the most likely chord of each key
+        """
+        if self.batch_emission_tables is None:
+            chord, cum_probs, offsets, best = [], [], [0], []
+            for key_idx in range(len(self.unique_keys)):
+                chord_idx, chord_probs = self.emission_probs(key_idx)
+                _, key_cum_probs = self.emission_table(key_idx)
+                chord.extend(chord_idx.tolist())
+                cum_probs.extend(p + key_idx for p in key_cum_probs)
+                offsets.append(len(chord))
+                best.append(int(chord_idx[chord_probs.argmax(axis=0)]) if len(chord_idx) else -1)
+            self.batch_emission_tables = {
+                "chord": np.array(chord, dtype=np.int64),
+                "cum_probs": np.array(cum_probs),
+                "offsets": np.array(offsets, dtype=np.int64),
+                "best": np.array(best, dtype=np.int64),
+            }
+        return self.batch_emission_tables
 
-    def generate(self, seq_len: int, gen_key_method: str = "prob", gen_chord_method: str = "prob") -> list:
+    def generate(self, seq_len: int, gen_key_method: str = "prob", gen_chord_method: str = "prob", as_codes: bool = False) -> list:
         """
         seq_len: number of chords to be produced until encountering ending;
         gen_key_method: (for key's ngram model)
@@ -96,25 +487,304 @@ class HMM(object):
         gen_chord_method: (for generating chords from emission matrix)
             prob - randomly generate by probability; 
             best - generate chord of the highest probability;
+        as_codes: with a vocab, return the chord codes instead of the chord strings;
         Returns the generated chord sequence
         """
         gen_keys = self.key_ngram.generate(seq_len, method=gen_key_method)
         gen_chords = []
         for key in gen_keys:
             key_idx = self.key_to_idx[key]
-            chord_probs = self.key_chord_probs[key_idx]
             if gen_chord_method == "prob":
-                gen_chord = random.choices(self.unique_chords, weights=chord_probs, k=1)[0]
+                chord_idx, cum_probs = self.emission_table(key_idx)
+                gen_chord = self.unique_chords[random.choices(chord_idx, cum_weights=cum_probs, k=1)[0]]
             elif gen_chord_method == "best":
-                gen_chord = self.unique_chords[chord_probs.argmax(axis=0)]
+                chord_idx, chord_probs = self.emission_probs(key_idx)
+                gen_chord = self.unique_chords[chord_idx[chord_probs.argmax(axis=0)]]
             else:
                 raise ValueError("Unrecognized method for generating chords from emission matrix in HMM. Currently supported methods are: 'prob', 'best'.")
             gen_chords.append(gen_chord)
+        if self.vocab is not None and not as_codes:
+            gen_chords = self.vocab.decode_seq(gen_chords)
         return gen_keys, gen_chords
 
+    def generate_batch(self, num_seqs: int, seq_len: int, gen_key_method: str = "prob", gen_chord_method: str = "prob",
+                       seed=None) -> tuple:
+        """
+        generate num_seqs sequences at once: the keys with the batch generation of the key ngram model
+        (see NgramModel.generate_batch), then all their chords with one random draw per chord;
+        gen_key_method, gen_chord_method: as in generate;
+        seed: seed (or numpy random generator) of the random numbers;
+        Returns two (num_seqs, seq_len) int arrays padded with -1 after the end of each sequence (see decode_batch):
+        the keys (indices into unique_keys), and the chords (codes with a vocab, otherwise indices into unique_chords)
+        """
+        if gen_chord_method not in ("prob", "best"):
+            raise ValueError("Unrecognized method for generating chords from emission matrix in HMM. Currently supported methods are: 'prob', 'best'.")
+        rng = np.random.default_rng(seed)
+        key_tokens = self.key_ngram.generate_batch(num_seqs, seq_len, method=gen_key_method, seed=rng)
+        # from the tokens of the key model to the rows of the emission matrix (the -1 padding maps to the -1 added at the end)
+        token_keys = np.array([self.key_to_idx.get(t, -1) for t in self.key_ngram.batch_tables(gen_key_method)["tokens"]] + [-1],
+                              dtype=np.int64)
+        keys = token_keys[key_tokens]
+        generated = keys >= 0
+        key_idx = keys[generated]
+
+        tables = self.batch_tables()
+        if gen_chord_method == "prob":
+            cum_probs, offsets = tables["cum_probs"], tables["offsets"]
+            # scaled by the total probability like random.choices
+            totals = cum_probs[offsets[1:] - 1] - np.arange(len(offsets) - 1)
+            r = rng.random(len(key_idx)) * totals[key_idx]
+            j = np.minimum(np.searchsorted(cum_probs, key_idx + r, side='right'), offsets[key_idx + 1] - 1)
+            chord_idx = tables["chord"][j]
+        else:
+            chord_idx = tables["best"][key_idx]
+        chords = np.full(keys.shape, -1, dtype=np.int32)
+        chords[generated] = np.array(self.unique_chords)[chord_idx] if self.vocab is not None else chord_idx
+        return keys.astype(np.int32), chords
+
+    def viterbi_tables(self) -> dict:
+        """
+        the hidden states of decode are the contexts of the key ngram model (the last order-1 keys);
+        the transitions are its ngrams: from context src[e] with key[e] (index into unique_keys) to context dst[e]
+        (-1 if the new context was never seen), with log probability log_prob[e];
+        log_emissions: (number of keys, number of chords + 1) log probabilities of the chords in each key,
+        the last column (0) being used for the chords never seen in training;
+        targets: the contexts that a transition reaches; by_degree: the transitions into them, grouped by how many there are:
+        a list of (columns, edges), the transitions into the contexts targets[columns] being the rows of edges (in order),
+        so that each group is reduced at once along the last axis
+        """
+        if self.decode_tables is None:
+            m = self.key_ngram
+            t = m.transitions()
+            # from the key ids of the key model to the rows of the emission matrix
+            key = np.array([self.key_to_idx.get(k, -1) for k in m.keys], dtype=np.int64)[t["next"]]
+            log_prob = np.log(t["count"] / m.counts.sum(axis=1)[t["src"]])
+            # keys that never emitted a chord (only in the key sequences) can't be decoded
+            known = key >= 0
+            emissions = self.key_chord_probs.toarray() if self.sparse else self.key_chord_probs
+            with np.errstate(divide='ignore'):
+                log_emissions = np.log(emissions)
+            dst = t["dst"][known]
+            into = np.flatnonzero(dst >= 0)
+            into = into[np.argsort(dst[into], kind='stable')]
+            targets, group_starts = np.unique(dst[into], return_index=True)
+            degree = np.diff(np.append(group_starts, len(into)))
+            by_degree = []
+            for d in np.unique(degree).tolist():
+                columns = np.flatnonzero(degree == d)
+                by_degree.append((columns, into[group_starts[columns, None] + np.arange(d)]))
+            self.decode_tables = {
+                "src": t["src"][known],
+                "key": key[known],
+                "dst": dst,
+                "targets": targets,
+                "by_degree": by_degree,
+                "log_prob": log_prob[known],
+                "start": m.row((m.start,) * (m.n - 1)),
+                "num_states": len(m.codes),
+                "log_emissions": np.hstack((log_emissions, np.zeros((len(self.unique_keys), 1)))),
+            }
+        return self.decode_tables
+
+    def observations(self, sequences, unseen: str = "ignore", lengths=None) -> tuple:
+        """
+        the chord sequences of decode_sequences and score as a (num_seqs, max_len) array of indices into unique_chords
+        (len(unique_chords) for the chords never seen in training, -1 for the padding), without their leading <s>;
+        returns the array, whether each sequence started with <s> (0 / 1), and the number of chords of each sequence in the array
+        """
+        if unseen not in ("ignore", "raise"):
+            raise ValueError("Unrecognized method for unseen chords. Currently supported methods are: 'ignore', 'raise'.")
+        start = self.vocab.start if self.vocab is not None else '<s>'
+        if isinstance(sequences, np.ndarray):
+            if lengths is None:
+                lengths = np.where((sequences < 0).any(axis=1), (sequences < 0).argmax(axis=1), sequences.shape[1])
+            sequences = [row[:length] for row, length in zip(sequences.tolist(), np.asarray(lengths).tolist())]
+        elif self.vocab is not None:
+            sequences = [self.vocab.encode_seq(seq).tolist() for seq in sequences]
+        num_seqs = len(sequences)
+        lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+        max_len = int(lengths.max()) if num_seqs else 0
+        observed = np.full((num_seqs, max_len), -1, dtype=np.int64)
+        offset = np.array([int(len(seq) > 0 and seq[0] == start) for seq in sequences], dtype=np.int64)
+        num_chords = len(self.unique_chords)
+        for b, seq in enumerate(sequences):
+            for t, chord in enumerate(seq[offset[b]:]):
+                chord_idx = self.chord_to_idx.get(chord)
+                if chord_idx is None:
+                    if unseen == "raise":
+                        raise ValueError(f"{self.vocab.decode(chord) if self.vocab is not None else chord} was never seen in training")
+                    chord_idx = num_chords
+                observed[b, t] = chord_idx
+        return observed, offset, lengths - offset
+
+    def decode(self, chords: list, unseen: str = "ignore") -> list:
+        """
+        the most likely key of each chord of a chord sequence (strings, or codes with a vocab), with the Viterbi algorithm
+        (see decode_sequences); a leading <s> is given the key <s>
+        """
+        return self.decode_sequences([chords], unseen=unseen)[0]
+
+    def decode_sequences(self, sequences, unseen: str = "ignore", lengths=None, chunk_size: int = 64) -> list:
+        """
+        the most likely key sequences of many chord sequences at once, with the Viterbi algorithm in log space over the key
+        contexts (see viterbi_tables), each step vectorized over the sequences and the transitions;
+        sequences: a list of chord sequences (strings, or codes with a vocab), or a (num_seqs, max_len) array of codes
+                   padded with -1 (lengths: the length of each row, defaults to the entries before the first -1);
+                   a leading <s> of a sequence is given the key <s>, decoding starts from the context of start symbols;
+        unseen: what to do with a chord never seen in training: "ignore" - its key only follows from the key transitions;
+                "raise" - raise a ValueError; a chord that no reachable key can emit is also ignored;
+        chunk_size: number of sequences decoded together (sequences of similar lengths), which bounds the memory;
+        Returns a list of the key sequences (key strings)
+        """
+        tables = self.viterbi_tables()
+        observed, offset, steps = self.observations(sequences, unseen, lengths)
+        paths = [[] for _ in range(len(steps))]
+        for chunk in _length_chunks(steps, chunk_size):
+            chunk_steps = steps[chunk]
+            for b, path in zip(chunk.tolist(), self.viterbi(tables, observed[chunk, :chunk_steps.max()], chunk_steps)):
+                paths[b] = path
+        return [[self.key_ngram.start] * int(start) + [self.unique_keys[tables["key"][e]] for e in path]
+                for start, path in zip(offset.tolist(), paths)]
+
+    def viterbi(self, tables: dict, observed: np.ndarray, steps: np.ndarray) -> list:
+        """
+        the Viterbi step loop of decode_sequences over a chunk of sequences: observed and steps as returned by observations;
+        Returns the most likely path of each sequence, as a list of transitions (indices into the tables)
+        """
+        src, key, log_prob = tables["src"], tables["key"], tables["log_prob"]
+        log_emissions = tables["log_emissions"]
+        targets = tables["targets"]
+        num_seqs, max_len = observed.shape
+        # the back pointers (transitions) are only kept for the states that can be reached, in the smallest type
+        target_column = np.full(tables["num_states"], -1, dtype=np.int64)
+        target_column[targets] = np.arange(len(targets))
+        back = np.zeros((max(max_len - 1, 0), num_seqs, len(targets)), dtype=np.min_scalar_type(max(len(src) - 1, 0)))
+        # the log probability of each chord of the chunk along each transition, by row
+        chords, observed = np.unique(np.maximum(observed, 0), return_inverse=True)
+        observed = observed.reshape(num_seqs, max_len)
+        edge_emissions = log_emissions[key][:, chords].T.copy()
+        score = np.full((num_seqs, tables["num_states"]), -np.inf)
+        score[:, tables["start"]] = 0
+        final_edge = np.full(num_seqs, -1, dtype=np.int64)
+        for t in range(max_len):
+            rows = np.flatnonzero(t < steps)
+            if not len(rows):
+                break
+            transition = score[rows][:, src] + log_prob
+            with np.errstate(invalid='ignore'):
+                candidates = transition + edge_emissions[observed[rows, t]]
+            # a chord that no reachable key can emit: follow the transitions only
+            stuck = ~np.isfinite(candidates).any(axis=1)
+            candidates[stuck] = transition[stuck]
+            # the best transition overall for the sequences that end at this step
+            ending = steps[rows] == t + 1
+            if ending.any():
+                final_edge[rows[ending]] = candidates[ending].argmax(axis=1)
+            going = ~ending
+            if not going.any():
+                continue
+            candidates = candidates[going]
+            # the first transition reaching the best score of each state
+            best_edge = np.empty((len(candidates), len(targets)), dtype=np.int64)
+            for columns, edges in tables["by_degree"]:
+                if edges.shape[1] == 1:
+                    best_edge[:, columns] = edges[:, 0]
+                else:
+                    best_edge[:, columns] = edges[np.arange(len(columns)), candidates[:, edges].argmax(axis=2)]
+            new_score = np.full((len(candidates), tables["num_states"]), -np.inf)
+            new_score[:, targets] = np.take_along_axis(candidates, best_edge, axis=1)
+            score[rows[going]] = new_score
+            back[t, rows[going]] = best_edge
+
+        paths = []
+        for b in range(num_seqs):
+            path = []
+            if steps[b] > 0:
+                edge = int(final_edge[b])
+                path.append(edge)
+                for t in range(int(steps[b]) - 2, -1, -1):
+                    edge = int(back[t, b, target_column[src[edge]]])
+                    path.append(edge)
+            paths.append(path[::-1])
+        return paths
+
+    def score(self, sequences, unseen: str = "ignore", lengths=None, chunk_size: int = 64) -> tuple:
+        """
+        the log likelihood (natural log) of many chord sequences at once, summed over all the key sequences with the forward
+        algorithm in log space, each step vectorized over the sequences and the transitions;
+        sequences, lengths, chunk_size: as in decode_sequences (the likelihood of a leading <s> is 1: generation starts there);
+        unseen: what to do with a chord never seen in training: "ignore" - it counts as emitted with probability 1 by any key;
+                "raise" - raise a ValueError; a chord that no reachable key can emit has a likelihood of 0 (log -inf);
+        Returns an array of the log likelihood of each sequence, and the perplexity of all the chords of all the sequences
+        """
+        tables = self.viterbi_tables()
+        observed, _, steps = self.observations(sequences, unseen, lengths)
+        log_likelihood = np.zeros(len(steps))
+        for chunk in _length_chunks(steps, chunk_size):
+            chunk_steps = steps[chunk]
+            log_likelihood[chunk] = self.forward(tables, observed[chunk, :chunk_steps.max()], chunk_steps)
+        num_chords = steps.sum()
+        perplexity = float(np.exp(-log_likelihood.sum() / num_chords)) if num_chords else float("nan")
+        return log_likelihood, perplexity
+
+    def forward(self, tables: dict, observed: np.ndarray, steps: np.ndarray) -> np.ndarray:
+        """
+        the forward step loop of score over a chunk of sequences: observed and steps as returned by observations;
+        Returns the log likelihood of each sequence
+        """
+        src, key, log_prob = tables["src"], tables["key"], tables["log_prob"]
+        log_emissions = tables["log_emissions"]
+        targets = tables["targets"]
+        num_seqs, max_len = observed.shape
+
+        def scaled_exp(candidates: np.ndarray) -> tuple:
+            """ the exponentials of the log probabilities of each row divided by the largest one (to sum them without
+                underflow), and the log of that largest one """
+            top = candidates.max(axis=1, keepdims=True)
+            top[~np.isfinite(top)] = 0
+            return np.exp(candidates - top), top
+
+        # the log probability of each chord of the chunk along each transition, by row
+        chords, observed = np.unique(np.maximum(observed, 0), return_inverse=True)
+        observed = observed.reshape(num_seqs, max_len)
+        edge_emissions = log_emissions[key][:, chords].T.copy()
+        log_likelihood = np.zeros(num_seqs)
+        alpha = np.full((num_seqs, tables["num_states"]), -np.inf)
+        alpha[:, tables["start"]] = 0
+        for t in range(max_len):
+            active = t < steps
+            if not active.any():
+                break
+            candidates = alpha[active][:, src] + log_prob + edge_emissions[observed[active, t]]
+            weights, top = scaled_exp(candidates)
+            with np.errstate(divide='ignore'):
+                # the sequences that end at this step: sum over all the transitions
+                ending = (t == steps[active] - 1)
+                log_likelihood[np.flatnonzero(active)[ending]] = np.log(weights[ending].sum(axis=1)) + top[ending, 0]
+                going = ~ending
+                if going.any():
+                    weights = weights[going]
+                    sums = np.empty((len(weights), len(targets)))
+                    for columns, edges in tables["by_degree"]:
+                        sums[:, columns] = weights[:, edges[:, 0]] if edges.shape[1] == 1 else weights[:, edges].sum(axis=2)
+                    new_alpha = np.full((len(weights), alpha.shape[1]), -np.inf)
+                    new_alpha[:, targets] = np.log(sums) + top[going]
+                    alpha[np.flatnonzero(active)[going]] = new_alpha
+        return log_likelihood
+
+    def decode_batch(self, keys: np.ndarray, chords: np.ndarray) -> tuple:
+        """ the sequences of key strings and of chord strings of a batch returned by generate_batch """
+        key_seqs = [[self.unique_keys[k] for k in row if k >= 0] for row in keys.tolist()]
+        chord_seqs = []
+        for row in chords.tolist():
+            row = [c for c in row if c >= 0]
+            chord_seqs.append(self.vocab.decode_seq(row) if self.vocab is not None else [self.unique_chords[c] for c in row])
+        return key_seqs, chord_seqs
+
 def main(args):
-    keys, chords = read_chord_dir(args.dir)
-    hmm = HMM(5, keys, chords, verbose=True)
+    vocab = ChordVocab()
+    hmm = HMM(5, verbose=True, vocab=vocab)
+    hmm.update_pieces(iter_chord_dir(args.dir, vocab=vocab))
     key_seq, chord_seq = hmm.generate(10, gen_key_method="prob", gen_chord_method="prob")
     print(key_seq)
     print(chord_seq)
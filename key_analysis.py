@@ -0,0 +1,72 @@
+import numpy as np
+
+from music21 import analysis
+
+
+# the analysis music21 runs for stream.analyze('key')
+_KEY_ANALYZER = analysis.discrete.analysisClassFromMethodName('key')()
+
+MODES = ('major', 'minor')
+
+# key profiles rotated to every tonic: row mode * 12 + tonic pitch class
+# (e.g. row 3 is E- major, row 12 is C minor)
+KEY_PROFILES = np.array([
+    np.roll(_KEY_ANALYZER.getWeights(mode), tonic)
+    for mode in MODES
+    for tonic in range(12)
+])
+
+# spelling of each key tonic, following music21 (e.g. A- major but G# minor)
+_DEFAULT_TONIC_NAMES = ('C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B')
+_ENHARMONICS = {'C#': 'D-', 'E-': 'D#', 'F#': 'G-', 'G#': 'A-', 'B-': 'A#'}
+KEY_TONIC_NAMES = tuple(
+    name if name in valid else _ENHARMONICS[name]
+    for valid in (_KEY_ANALYZER.keysValidMajor, _KEY_ANALYZER.keysValidMinor)
+    for name in _DEFAULT_TONIC_NAMES
+)
+
+
+def key_correlations(histograms: np.ndarray) -> np.ndarray:
+    """ correlate the pitch class histograms of all measures with the profiles of all 24 keys at once.
+        histograms: (num_measures, 12) durations of each pitch class in each measure;
+        returns a (num_measures, 24) matrix of correlation coefficients, the columns following KEY_PROFILES
+        (0 where a histogram is flat, like music21) """
+    histograms = np.asarray(histograms, dtype=float)
+    h = histograms - histograms.mean(axis=1, keepdims=True)
+    p = KEY_PROFILES - KEY_PROFILES.mean(axis=1, keepdims=True)
+    denominator = np.sqrt(np.outer((h ** 2).sum(axis=1), (p ** 2).sum(axis=1)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        correlations = np.where(denominator > 0, (h @ p.T) / denominator, 0.0)
+    return correlations
+
+
+def rank_keys(correlations: np.ndarray) -> np.ndarray:
+    """ indices of the keys of each measure sorted from the most to the least likely.
+        Ties are broken like music21: the higher tonic pitch class first, then minor before major """
+    # music21 sorts (coefficient, tonic pitch, mode) tuples in reverse
+    tonic = np.tile(np.arange(12), 2)
+    minor = np.repeat(np.arange(2), 12)
+    n = correlations.shape[0]
+    return np.lexsort((np.broadcast_to(-minor, (n, 24)), np.broadcast_to(-tonic, (n, 24)), -correlations), axis=-1)
+
+
+def key_name(idx: int) -> str:
+    """ tonic name of a key index (column of key_correlations) """
+    return KEY_TONIC_NAMES[idx]
+
+
+def keys_from_correlations(correlations: np.ndarray, has_notes: np.ndarray, nc_threshold: float = 0.6) -> list:
+    """ the key tonic of each measure from its key correlations (see key_correlations),
+        or "NC" if the measure has no notes or its best key correlates less than nc_threshold """
+    correlations = np.asarray(correlations).reshape(-1, 24)
+    best = rank_keys(correlations)[:, 0]
+    best_correlations = correlations[np.arange(len(best)), best]
+    return [key_name(k) if notes and c >= nc_threshold else "NC"
+            for k, c, notes in zip(best, best_correlations, has_notes)]
+
+
+def alternate_keys(correlations: np.ndarray, k: int = 3) -> list:
+    """ the tonics of the k most likely keys after the best one, for each measure
+        (like the alternateInterpretations of a music21 key analysis) """
+    correlations = np.asarray(correlations).reshape(-1, 24)
+    return [[key_name(i) for i in row] for row in rank_keys(correlations)[:, 1:k + 1].tolist()]
@@ -0,0 +1,442 @@
+import math
+import numpy as np
+
+from collections import deque
+from fractions import Fraction
+from functools import lru_cache
+from music21 import key, meter
+from note_arrays import NoteArrays, PC_NAMES, transpose_notes
+
+
+# midi status bytes (the channel is in the low 4 bits of channel messages)
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+PROGRAM_CHANGE = 0xC0
+META = 0xFF
+# meta event types that music21 turns into elements of a part
+META_TRACK_NAME = 0x03
+META_INSTRUMENT_NAME = 0x04
+META_SET_TEMPO = 0x51
+META_TIME_SIGNATURE = 0x58
+META_KEY_SIGNATURE = 0x59
+# elements of the conductor track that music21 copies into every part
+CONDUCTOR_META_TYPES = (META_SET_TEMPO, META_TIME_SIGNATURE, META_KEY_SIGNATURE)
+
+
+def read_midi_file(fname: str):
+    """ read the tracks of a standard midi file.
+        returns (ticks per quarter note, list of tracks); a track is a list of (tick, status, data1, data2) events
+        at absolute ticks; meta events have the status 0xFF, their type as data1 and their payload (bytes) as data2.
+        System exclusive messages are skipped """
+    with open(fname, "rb") as f:
+        data = f.read()
+    if data[:4] != b"MThd":
+        raise ValueError(f"{fname} is not a midi file")
+    header_length = int.from_bytes(data[4:8], "big")
+    division = int.from_bytes(data[12:14], "big")
+    if division & 0x8000:
+        raise ValueError(f"{fname} uses SMPTE time division, which is not supported")
+
+    tracks = []
+    pos = 8 + header_length
+    while pos + 8 <= len(data):
+        chunk_type = data[pos:pos + 4]
+        length = int.from_bytes(data[pos + 4:pos + 8], "big")
+        pos += 8
+        if chunk_type == b"MTrk":
+            tracks.append(_read_track(data[pos:pos + length]))
+        pos += length
+    return division, tracks
+
+def _read_varlen(data: bytes, pos: int):
+    value = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value = (value << 7) | (b & 0x7F)
+        if not b & 0x80:
+            return value, pos
+
+def _read_track(data: bytes) -> list:
+    events = []
+    tick = 0
+    pos = 0
+    status = 0
+    while pos < len(data):
+        delta, pos = _read_varlen(data, pos)
+        tick += delta
+        b = data[pos]
+        if b == META:
+            meta_type = data[pos + 1]
+            length, pos = _read_varlen(data, pos + 2)
+            events.append((tick, META, meta_type, data[pos:pos + length]))
+            pos += length
+            continue
+        if b in (0xF0, 0xF7):
+            length, pos = _read_varlen(data, pos + 1)
+            pos += length
+            continue
+        if b & 0x80:
+            status = b
+            pos += 1
+        # otherwise running status: b is the first data byte
+        if status & 0xF0 in (0xC0, 0xD0):
+            events.append((tick, status, data[pos], 0))
+            pos += 1
+        else:
+            events.append((tick, status, data[pos], data[pos + 1]))
+            pos += 2
+    return events
+
+def has_notes(events: list) -> bool:
+    """ whether a track has any note (music21 makes a part of each track with notes) """
+    return any(status & 0xF0 == NOTE_ON and status != META and velocity > 0 for _, status, _, velocity in events)
+
+def track_notes(events: list) -> list:
+    """ pair the note on and off events of a track like music21: each note on is closed by the first following
+        note off (or note on with velocity 0) of the same pitch and channel that hasn't closed an earlier note;
+        notes that are never closed are dropped.
+        returns a list of (on tick, off tick, midi pitch) in the order of the note ons """
+    notes = []
+    pending = {}
+    for tick, status, data1, data2 in events:
+        kind = status & 0xF0
+        if status == META or kind not in (NOTE_ON, NOTE_OFF):
+            continue
+        k = (status & 0x0F, data1)
+        if kind == NOTE_ON and data2 > 0:
+            pending.setdefault(k, deque()).append(len(notes))
+            notes.append([tick, None, data1])
+        elif pending.get(k):
+            notes[pending[k].popleft()][1] = tick
+    return [(on, off, p) for on, off, p in notes if off is not None]
+
+def group_chords(notes: list, tolerance: float):
+    """ gather the notes that start and end together (within tolerance ticks) into chords, like music21's midiTrackToStream.
+        returns (list of lists of note indices, one per note or chord in the order music21 creates them,
+        whether some notes start together but end apart, which makes music21 split the measures into voices) """
+    groups = []
+    gathered = set()
+    voices_required = False
+    for i, (on, off, _) in enumerate(notes):
+        if i in gathered:
+            continue
+        group = [i]
+        for j in range(i + 1, len(notes)):
+            on_j, off_j, _ = notes[j]
+            if abs(on_j - on) >= tolerance:
+                break
+            if abs(off_j - off) > tolerance:
+                voices_required = True
+                continue
+            group.append(j)
+            gathered.add(j)
+        groups.append(group)
+    return groups, voices_required
+
+def best_match(values: np.ndarray, divisors: list):
+    """ vectorized version of music21's quantization: the nearest multiple of 1 / divisor for each value, over all the divisors;
+        equal errors go to the larger divisor.
+        returns (multiple, divisor) int arrays """
+    values = np.asarray(values, dtype=float)
+    best_error = np.full(values.shape, np.inf)
+    best_mult = np.zeros(values.shape, dtype=np.int64)
+    best_div = np.zeros(values.shape, dtype=np.int64)
+    for div in sorted(divisors, reverse=True):
+        # same float operations as music21's common.nearestMultiple
+        unit = 1 / div
+        mult = np.floor(values / unit)
+        low = unit * mult
+        use_low = (low <= values) & (values <= low + unit / 2.0)
+        error = np.round(np.where(use_low, values - low, unit * (mult + 1) - values), 7)
+        better = error < best_error
+        best_error = np.where(better, error, best_error)
+        best_mult = np.where(better, np.where(use_low, mult, mult + 1), best_mult).astype(np.int64)
+        best_div = np.where(better, div, best_div)
+    return best_mult, best_div
+
+def quantize(ticks: np.ndarray, ticks_per_quarter: int, divisors: list, grid: int) -> np.ndarray:
+    """ quantize times in ticks to the nearest multiple of 1 / divisor quarter notes, in 1/grid quarter notes """
+    mult, div = best_match(np.asarray(ticks) / ticks_per_quarter, divisors)
+    return mult * (grid // div)
+
+def quantize_elements(on: np.ndarray, length: np.ndarray, ticks_per_quarter: int, divisors: list, grid: int):
+    """ quantize the offsets and durations (in ticks) of the notes and chords of a part like music21's Stream.quantize:
+        a duration that would leave a gap shorter than the smallest unit before the next element is quantized with the
+        divisor of the next element's offset, and notes (but not grace notes, with no length) last at least the smallest unit.
+        returns (offsets, durations) in 1/grid quarter notes """
+    offset_mult, offset_div = best_match(on / ticks_per_quarter, divisors)
+    ql = length / ticks_per_quarter
+    dur_mult, dur_div = best_match(ql, divisors)
+    if len(on) > 1:
+        # music21 compares floats here, so do the same float operations
+        gap = ((1 / offset_div[1:]) * offset_mult[1:]
+               - (offset_mult[:-1] / offset_div[:-1] + (1 / dur_div[:-1]) * dur_mult[:-1]))
+        requantize = np.flatnonzero((0 < gap) & (gap < 1 / max(divisors)))
+        for i in requantize:
+            m, d = best_match(ql[i:i + 1], [int(offset_div[i + 1])])
+            dur_mult[i], dur_div[i] = m[0], d[0]
+    offsets = offset_mult * (grid // offset_div)
+    durations = dur_mult * (grid // dur_div)
+    durations[(durations == 0) & (length > 0)] = grid // max(divisors)
+    return offsets, durations
+
+@lru_cache(maxsize=None)
+def time_signature_lengths(numerator: int, denominator: int, grid: int) -> tuple:
+    """ (bar length, beat count, beat length) of a time signature, with lengths in 1/grid quarter notes """
+    ts = meter.TimeSignature(f"{numerator}/{denominator}")
+    lengths = []
+    for ql in (ts.barDuration.quarterLength, ts.beatDuration.quarterLength):
+        length = Fraction(ql) * grid
+        if length.denominator != 1:
+            raise ValueError(f"time signature {numerator}/{denominator} doesn't fit the quantization grid")
+        lengths.append(int(length))
+    return lengths[0], ts.beatCount, lengths[1]
+
+@lru_cache(maxsize=None)
+def key_signature_tonic(sharps: int, mode: int) -> str:
+    """ tonic name of a midi key signature, like music21's midiEventsToKey """
+    return key.KeySignature(sharps).asKey('minor' if mode == 1 else 'major').tonic.name
+
+def _measure_starts(time_signatures: list, end: int) -> list:
+    """ start of every measure from 0 until end, like music21's makeMeasures.
+        time_signatures: sorted list of (offset, (bar length, beat count, beat length), numerator).
+        returns a list of (start, index in time_signatures) """
+    measures = []
+    offsets = [o for o, _, _ in time_signatures]
+    o = 0
+    while True:
+        ts = np.searchsorted(offsets, o, side='right') - 1
+        measures.append((o, ts))
+        o += time_signatures[ts][1][0]
+        if o >= end:
+            return measures
+
+def _make_voices(notes: list, start: np.ndarray, stop: np.ndarray):
+    """ music21's makeVoices on the notes of a measure (in music21's order): None if no notes overlap, otherwise the notes of
+        each voice. The number of voices comes from music21's grouping of overlapping notes, and notes are put in the first
+        voice that is free by their start; like music21, a note that finds no free voice is dropped """
+    n = len(notes)
+    overlaps = [[] for _ in range(n)]
+    for a in range(n):
+        for b in range(a + 1, n):
+            (_, end_a), (start_b, _) = sorted(((start[notes[a]], stop[notes[a]]), (start[notes[b]], stop[notes[b]])))
+            if start_b >= end_a:
+                break
+            overlaps[a].append(b)
+            overlaps[b].append(a)
+    # music21's _consolidateLayering
+    groups = {}
+    group_of = {}
+    for a in range(n):
+        if not overlaps[a]:
+            continue
+        dst = None
+        for b in sorted(overlaps[a]):
+            if b in group_of:
+                dst = group_of[b]
+                continue
+            if dst is None:
+                dst = start[notes[a]]
+            groups.setdefault(dst, []).append(b)
+            group_of[b] = dst
+        if a not in group_of:
+            if dst is None:
+                dst = start[notes[a]]
+            groups.setdefault(dst, []).append(a)
+            group_of[a] = dst
+    num_voices = max((len(g) for g in groups.values()), default=1)
+    if num_voices == 1:
+        return None
+
+    voices = [[0, []] for _ in range(num_voices)]
+    for i in notes:
+        for voice in voices:
+            if voice[0] <= start[i]:
+                voice[1].append(i)
+                voice[0] = max(voice[0], stop[i])
+                break
+    return [v for _, v in voices if v]
+
+def _voiced_part_pieces(elements: np.ndarray, offsets: np.ndarray, durations: np.ndarray, measure_start: np.ndarray,
+                        measure_length: np.ndarray):
+    """ _part_pieces for a part whose measures music21 splits into voices before making ties, following music21 measure by
+        measure: notes are ordered by voice, and makeTies looks for the voice of a tied-over piece in the next measure by an id
+        that never matches, so a piece tied from a measure with voices into another measure with voices is left at the
+        measure level, where it isn't split again (it keeps the rest of the duration, past the barline) """
+    num_mm = len(measure_start)
+    start, stop = offsets, offsets + durations
+    grace = durations == 0
+    first_mm = np.full(len(offsets), -1)
+    first_mm[elements] = np.searchsorted(measure_start, offsets[elements], side='right') - 1
+
+    # notes of each measure in music21's order: offset, grace notes first, order of creation
+    level = [[] for _ in range(num_mm)]
+    for i in elements[np.lexsort((elements, ~grace[elements], offsets[elements]))]:
+        level[first_mm[i]].append(int(i))
+    voices = [_make_voices(notes, start, stop) for notes in level]
+    for k in range(num_mm):
+        if voices[k] is not None:
+            level[k] = []
+
+    def sort_measure(k, notes):
+        return sorted(notes, key=lambda i: (start[i] - measure_start[k] if first_mm[i] == k else 0, not grace[i]))
+
+    split = set()
+    for k in range(num_mm - 1):
+        voiced = voices[k] is not None
+        next_voiced = voices[k + 1] is not None
+        notes = [i for v in voices[k] for i in sort_measure(k, v)] if voiced else sort_measure(k, level[k])
+        for i in notes:
+            if stop[i] <= measure_start[k] + measure_length[k]:
+                continue
+            split.add((k, i))
+            if next_voiced:
+                if voiced:
+                    level[k + 1].append(i)
+                else:
+                    voices[k + 1][0].append(i)
+            elif voiced:
+                # music21 moves the notes of the next measure into a voice to receive the piece
+                if voices[k + 1] is None:
+                    voices[k + 1] = [level[k + 1]]
+                    level[k + 1] = []
+                voices[k + 1][0].append(i)
+            else:
+                level[k + 1].append(i)
+
+    element, mm, piece_start, piece_stop = [], [], [], []
+    for k in range(num_mm):
+        in_voices = [i for v in voices[k] or [] for i in v]
+        # voices come before the notes at the measure level, unless a single voice is left, which music21 flattens
+        notes = in_voices + level[k] if voices[k] is not None and len(voices[k]) > 1 else level[k] + in_voices
+        for i in sort_measure(k, notes):
+            element.append(i)
+            mm.append(k)
+            piece_start.append(start[i] if first_mm[i] == k else measure_start[k])
+            piece_stop.append(measure_start[k] + measure_length[k] if (k, i) in split else stop[i])
+    element, mm, piece_start, piece_stop = (np.array(v, dtype=np.int64) for v in (element, mm, piece_start, piece_stop))
+    return element, mm, piece_start - measure_start[mm], piece_stop - piece_start
+
+def _part_pieces(offsets: np.ndarray, durations: np.ndarray, measure_start: np.ndarray, measure_length: np.ndarray,
+                 voices_required: bool = False):
+    """ split the notes and chords of a part at the barlines, like music21's makeTies, and sort the pieces the way music21
+        iterates a measure: by offset, grace notes first, then the order of creation, with the tied-over pieces at the start
+        of a measure after the notes that start there (see _voiced_part_pieces for parts that music21 splits into voices).
+        returns (element index, measure, offset in the measure, duration) of each piece """
+    end = measure_start[-1] + measure_length[-1]
+    # notes without duration at the very end don't fit in any measure (music21 stores them at the end of the part)
+    elements = np.flatnonzero(offsets < end)
+    if voices_required:
+        return _voiced_part_pieces(elements, offsets, durations, measure_start, measure_length)
+    start = offsets[elements]
+    stop = start + durations[elements]
+    first_mm = np.searchsorted(measure_start, start, side='right') - 1
+    last_mm = np.maximum(np.searchsorted(measure_start, stop, side='left') - 1, first_mm)
+
+    counts = last_mm - first_mm + 1
+    element = np.repeat(elements, counts)
+    tied = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    first = np.repeat(first_mm, counts)
+    mm = first + tied
+    piece_start = np.where(tied == 0, offsets[element], measure_start[mm])
+    piece_stop = np.minimum(offsets[element] + durations[element], measure_start[mm] + measure_length[mm])
+
+    # order of the tied-over pieces at the start of a measure: the order of the pieces they continue in the previous measure,
+    # i.e. notes that started at a barline (latest barline first), then the others (earliest measure first)
+    start_in_mm = offsets[element] - measure_start[first]
+    is_tied = tied > 0
+    tier = np.where(is_tied, 2, np.where(durations[element] == 0, 0, 1))
+    late_start = is_tied & (start_in_mm != 0)
+    first_key = np.where(is_tied, np.where(late_start, first, -first), 0)
+    start_key = np.where(is_tied, start_in_mm, 0)
+    sort = np.lexsort((element, start_key, first_key, late_start, tier, piece_start, mm))
+    return element[sort], mm[sort], (piece_start - measure_start[mm])[sort], (piece_stop - piece_start)[sort]
+
+def read_midi_notes(fname: str, quarter_length_divisors: list = (12, 16), to_tonic: str = 'E-'):
+    """ read the notes of a midi file into NoteArrays without building a music21 stream, reproducing what
+        converter.parse + normalizing the key to to_tonic would give: note pairing, chord grouping, quantization, measures from the time
+        signatures of the conductor track, ties over barlines, and the spelling of the pitches after normalizing to to_tonic.
+        returns (first key tonic, NoteArrays) """
+    ticks_per_quarter, tracks = read_midi_file(fname)
+    grid = math.lcm(*quarter_length_divisors)
+    tolerance = ticks_per_quarter / max(quarter_length_divisors)
+
+    def quantize_meta(events):
+        ticks = np.array([t for t, _ in events], dtype=float)
+        return [(int(o), e) for o, (_, e) in zip(quantize(ticks, ticks_per_quarter, quarter_length_divisors, grid), events)]
+
+    # tracks without notes make up the conductor part; each part only sees the conductor tracks that come before it
+    conductor = []
+    parts = []
+    for events in tracks:
+        metas = [(t, (data1, data2)) for t, status, data1, data2 in events if status == META] + \
+                [(t, (None, data1)) for t, status, data1, _ in events if status & 0xF0 == PROGRAM_CHANGE and status != META]
+        if not has_notes(events):
+            conductor += quantize_meta([(t, m) for t, m in metas if m[0] in CONDUCTOR_META_TYPES])
+            continue
+        notes = track_notes(events)
+        groups, voices_required = group_chords(notes, tolerance)
+        # a chord takes its start from its first note and its length from its last note
+        on = np.array([notes[g[0]][0] for g in groups], dtype=float)
+        length = np.array([notes[g[-1]][1] - notes[g[-1]][0] for g in groups], dtype=float)
+        offsets, durations = quantize_elements(on, length, ticks_per_quarter, quarter_length_divisors, grid)
+        own_metas = quantize_meta([(t, m) for t, m in metas if m[0] in
+                                   CONDUCTOR_META_TYPES + (META_TRACK_NAME, META_INSTRUMENT_NAME, None)])
+        parts.append((notes, groups, voices_required, offsets, durations, own_metas, list(conductor)))
+    if not parts:
+        raise ValueError(f"{fname} has no notes")
+
+    part_measures = []
+    for notes, groups, voices_required, offsets, durations, own_metas, part_conductor in parts:
+        time_signatures = sorted(((o, (data[0], 2 ** data[1])) for o, (t, data) in part_conductor if t == META_TIME_SIGNATURE),
+                                 key=lambda ts: ts[0])
+        if not time_signatures:
+            if part_conductor:
+                raise ValueError(f"{fname} has a conductor track without time signature")
+            time_signatures = sorted(((o, (data[0], 2 ** data[1])) for o, (t, data) in own_metas if t == META_TIME_SIGNATURE),
+                                     key=lambda ts: ts[0])
+        if not time_signatures:
+            time_signatures = [(0, (4, 4))]
+        time_signatures = [(o, time_signature_lengths(n, d, grid), n) for o, (n, d) in time_signatures]
+        # measures up to the end of the last note or meta element
+        end = max([int((offsets + durations).max(initial=0))] + [o for o, _ in own_metas + part_conductor])
+        part_measures.append((_measure_starts(time_signatures, end), time_signatures))
+    num_measures = np.array([len(measures) for measures, _ in part_measures])
+    longest = int(num_measures.argmax())
+    measures, time_signatures = part_measures[longest]
+    measure_start = np.array([start for start, _ in measures], dtype=np.int64)
+    ts_index = np.array([ts for _, ts in measures])
+    numerator = np.array([n for _, _, n in time_signatures])[ts_index]
+    bar_length, beat_count, beat_length = (np.array(v)[ts_index] for v in zip(*(lengths for _, lengths, _ in time_signatures)))
+
+    # the first key signature in the first measure of the first part: the part's own before the conductor's
+    notes, groups, voices_required, offsets, durations, own_metas, part_conductor = parts[0]
+    key_signatures = sorted(((o, data) for o, (t, data) in own_metas + part_conductor if t == META_KEY_SIGNATURE),
+                            key=lambda ks: ks[0])
+    key_signatures = [data for o, data in key_signatures if o < bar_length[0]]
+    if not key_signatures:
+        raise ValueError(f"{fname} has no key signature in the first measure")
+    sharps = key_signatures[0][0]
+    first_key = key_signature_tonic(sharps - 256 if sharps > 12 else sharps, key_signatures[0][1])
+
+    columns = [[] for _ in range(5)]
+    for i, (notes, groups, voices_required, offsets, durations, own_metas, part_conductor) in enumerate(parts):
+        n = num_measures[i]
+        element, mm, offset, duration = _part_pieces(offsets, durations, measure_start[:n], bar_length[:n],
+                                                        voices_required=voices_required)
+        # one entry per pitch of each piece
+        group_pitches = [[notes[j][2] for j in g] for g in groups]
+        sizes = np.array([len(p) for p in group_pitches])
+        pitches = np.array([p for g in group_pitches for p in g], dtype=np.int64)
+        group_start = np.cumsum(sizes) - sizes
+        counts = sizes[element]
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        columns[0].append(np.full(counts.sum(), i))
+        for column, values in zip(columns[1:4], (mm, offset, duration)):
+            column.append(np.repeat(values, counts))
+        columns[4].append(pitches[np.repeat(group_start[element], counts) + within] % 12)
+    part, mm, offset, duration, pitch_class = (np.concatenate(c).astype(np.int64) for c in columns)
+    notes = NoteArrays(grid, part, mm, offset, duration, pitch_class, PC_NAMES, measure_start, bar_length, numerator, beat_count,
+                       beat_length, num_measures)
+    return first_key, transpose_notes(notes, first_key, to_tonic)
@@ -1,29 +1,85 @@
 import argparse
+import heapq
+import numpy as np
 import os
 import random 
+import sys
+import tempfile
 
-from collections import Counter
+from bisect import bisect_left, bisect_right
+from chord_codes import ChordVocab
+from collections import Counter, deque
 from compose import compose
+from corpus import read_packed, write_packed
+from itertools import accumulate, groupby
 from nltk import ngrams
 from nltk import NaiveBayesClassifier
-from parse_chords import read_chord_dir, read_chord_file
+from parse_chords import iter_chord_dir, read_chord_dir, read_chord_file
 from tokenize import String
 from typing import List
 
 
+# a saved model is a packed file (see corpus.write_packed) with this magic string; files of another version are rejected
+MODEL_MAGIC = b"NGRAMMODEL\0"
+MODEL_VERSION = 1
+# code padding the saved contexts shorter than n-1 (those of a model that backs off)
+PAD = 0xFFFF
+
+
+def _sizeof(objects, seen: set) -> int:
+    """ bytes taken by objects and everything they hold (containers, chords), not counting the objects
+        already in seen (the ids of the objects counted are added to it, so that shared objects are counted once) """
+    size = 0
+    stack = list(objects)
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (tuple, list)):
+            stack.extend(obj)
+    return size
+
+
+def _relative_entropy(counts: dict, total: int, backoff_counts: dict, backoff_total: int) -> float:
+    """ relative entropy (in bits) of the distribution of next chords counts / total from the backoff distribution """
+    return sum(count / total * np.log2(count / total * backoff_total / backoff_counts[c]) for c, count in counts.items())
+
+
 class NgramModel(object):
+    # whether unseen contexts back off to their longest seen suffix (see NgramTrieModel)
+    backoff = False
 
-    def __init__(self, n: int, verbose: bool = False):
+    def __init__(self, n: int, verbose: bool = False, vocab: ChordVocab = None):
+        """
+        n: order of the model;
+        vocab: if given, chords are stored as integer codes (see chord_codes): update accepts chord strings or codes,
+               and generate returns chord strings (or codes with as_codes=True);
+               otherwise the tokens (e.g. keys) are stored as they are given
+        """
         if n < 2:
             raise ValueError("N for an Ngram model must be greater than 1.")
         self.n = n
         self.verbose = verbose
-        # key: context (previous chords); value: a list of candidate next chord;
-        # example: {("C E G", "A D F"): ["C E G", "B D G", ...]}
+        self.vocab = vocab
+        # start and end symbols of the sequences
+        self.start = vocab.start if vocab else '<s>'
+        self.end = vocab.end if vocab else '<e>'
+        # key: context (previous chords); value: a list of the unique candidate next chords, in order of first appearance;
+        # example: {("C E G", "A D F"): ["C E G", "B D G", ...]} (as codes with a vocab: {(145, 548): [145, 2192, ...]})
         self.context = {}
+        # total count of each context (number of ngrams starting with it)
+        self.context_totals = {}
         # counter for all the ngrams in the tuple form: ((chord_1, chord_2, ..., chord_n-1), chord_n)
         self.ngram_counter = Counter()
-        # mapping from a candid
+        # sampling tables of the contexts used for generation, by method (see sampling_table and batch_tables,
+        # which also keeps the tables of score); reset by update
+        self.sampling_tables = {"prob": {}, "semi": {}}
+        self.batch_sampling_tables = {}
     
     def get_ngrams(self, data_chords: list) -> list:
         """
@@ -36,99 +92,219 @@ class NgramModel(object):
             ) for i in range(self.n-1, len(data_chords))]
         return l
 
-    def update(self, chord_list: list) -> None:
+    def update(self, chord_list) -> None:
         """
-        Updates Language Model
-        chord_list: a list of chords (strings) from the data, in sequential order
+        Updates Language Model, counting the ngrams in place as they stream from chord_list
+        (the time is linear in the number of chords, and no list of ngrams is built)
+        chord_list: an iterable of chords (strings, or codes with a vocab) from the data, in sequential order
         """
         n = self.n
+        if self.vocab is not None:
+            if isinstance(chord_list, np.ndarray):
+                chord_list = chord_list.tolist()
+            chord_list = (self.vocab.encode(c) if isinstance(c, str) else c for c in chord_list)
+        # the distributions change: the sampling tables have to be built again
+        self.sampling_tables = {"prob": {}, "semi": {}}
+        self.batch_sampling_tables = {}
 
-        # add in start symbols to match n
-        new_chord_list = []
+        # sliding window of the previous n-1 chords
+        window = deque(maxlen=n-1)
         for c in chord_list:
-            if c == '<s>':
-                new_chord_list.extend(['<s>'] * (n-2))
-            new_chord_list.append(c)
-
-        # get ngrams
-        ngrams = self.get_ngrams(new_chord_list)
-        # update the ngram_counter with these ngrams
-        self.ngram_counter += Counter(ngrams)
-
-        # update the context
-        for ngram in ngrams:
-            prev_words, target_word = ngram
+            # add in start symbols to match n
+            for chord in [self.start] * (n-1) if c == self.start else [c]:
+                if len(window) == n-1:
+                    self.count_ngram(tuple(window), chord)
+                window.append(chord)
+
+    def count_ngram(self, prev_words: tuple, target_word, count: int = 1) -> None:
+        """ add count occurrences of an ngram to the ngram_counter and the context """
+        ngram = (prev_words, target_word)
+        if ngram not in self.ngram_counter:
             if prev_words in self.context:
                 self.context[prev_words].append(target_word)
             else:
                 self.context[prev_words] = [target_word]
+        self.ngram_counter[ngram] += count
+        self.context_totals[prev_words] = self.context_totals.get(prev_words, 0) + count
+
+    def merge(self, other: "NgramModel") -> "NgramModel":
+        """
+        add the counts of another model of the same order (e.g. trained on another shard of the corpus, in another process)
+        to this model; the result is the same as updating this model with the other model's data after its own.
+        Returns self
+        """
+        if other.n != self.n:
+            raise ValueError(f"can't merge a model of order {other.n} into a model of order {self.n}")
+        if (other.vocab is None) != (self.vocab is None):
+            raise ValueError("can't merge a model of chord codes with a model of chord strings")
+        self.sampling_tables = {"prob": {}, "semi": {}}
+        self.batch_sampling_tables = {}
+        # ngram_counter is in order of first appearance, so the candidates of each context keep their order
+        for (prev_words, target_word), count in other.ngram_counter.items():
+            self.count_ngram(prev_words, target_word, count)
+        return self
+
+    def update_pieces(self, pieces) -> None:
+        """
+        Updates Language Model one piece at a time, so that only one piece needs to be in memory
+        pieces: an iterable of (name, keys, chords), e.g. parse_chords.iter_chord_dir or ChordCorpus.pieces
+        (n-grams across the end of a piece and the start of the next are not counted: generation stops at <e>)
+        """
+        for _, _, chords in pieces:
+            self.update(chords)
+
+    def prune(self, min_count: int = 1, max_contexts: int = None, min_entropy: float = None) -> "NgramModel":
+        """
+        drop rare ngrams and contexts to cap the memory of the model; the probabilities of the contexts left are renormalized,
+        and generation stops in a context that was dropped (see NgramTrie.prune for a model that backs off instead)
+        min_count: drop the ngrams seen fewer times;
+        max_contexts: keep only the max_contexts most frequent contexts;
+        min_entropy: drop the contexts whose next chords are predicted about as well without their oldest chord: the relative
+                     entropy (in bits) of their distribution from the one of their shorter context, weighted by how often
+                     they occur, is below min_entropy;
+        the context of start symbols is always kept. Returns self
+        """
+        self.sampling_tables = {"prob": {}, "semi": {}}
+        self.batch_sampling_tables = {}
+        first_context = (self.start,) * (self.n - 1)
+        successors = {}
+        for (context, c), count in self.ngram_counter.items():
+            if count >= min_count:
+                successors.setdefault(context, {})[c] = count
+        totals = {context: sum(counts.values()) for context, counts in successors.items()}
+
+        if min_entropy is not None:
+            # the distribution of the next chords after the shorter contexts, from the same counts
+            shorter = {}
+            for context, counts in successors.items():
+                shorter_counts = shorter.setdefault(context[1:], Counter())
+                shorter_counts.update(counts)
+            num_ngrams = sum(totals.values())
+            successors = {context: counts for context, counts in successors.items()
+                          if context == first_context or totals[context] / num_ngrams * _relative_entropy(
+                              counts, totals[context], shorter[context[1:]], sum(shorter[context[1:]].values())) >= min_entropy}
+        if max_contexts is not None and len(successors) > max_contexts:
+            # the most frequent contexts (the earliest seen first among the same counts)
+            kept = set(sorted(successors, key=lambda context: (context != first_context, -totals[context]))[:max_contexts])
+            successors = {context: successors[context] for context in successors if context in kept}
+
+        self.context = {context: list(counts) for context, counts in successors.items()}
+        self.context_totals = {context: totals[context] for context in successors}
+        self.ngram_counter = Counter({(context, c): count for context, counts in successors.items() for c, count in counts.items()})
+        return self
+
+    def memory_report(self) -> dict:
+        """
+        memory taken by the counts of the model, by order: {n: {"contexts": number of contexts, "ngrams": number of ngrams,
+        "bytes": bytes of the python objects holding them (the chords and tuples shared between them are counted once)}}
+        """
+        return {self.n: {
+            "contexts": len(self.context),
+            "ngrams": len(self.ngram_counter),
+            "bytes": _sizeof([self.context, self.context_totals, self.ngram_counter], set()),
+        }}
 
     def prob(self, context: tuple, next_chord: str):
         """
         Calculates probability of a candidate chord to be generated given a context;
         Returns conditional probability
         """
-        try:
-            count_of_chord = self.ngram_counter[(context, next_chord)]
-            count_of_context = float(len(self.context[context]))
-            result = count_of_chord / count_of_context
-        except KeyError:
-            result = 0.0
-        return result
+        count_of_context = self.context_totals.get(context)
+        if not count_of_context:
+            return 0.0
+        return self.ngram_counter[(context, next_chord)] / count_of_context
     
+    def successor_counts(self, context: tuple) -> tuple:
+        """ (candidate next chords in order of first appearance, their counts, total count) of a context (KeyError if unseen) """
+        candidate_chords = self.context[context]
+        return candidate_chords, [self.ngram_counter[(context, c)] for c in candidate_chords], self.context_totals[context]
+
+    def resolve_context(self, context: tuple):
+        """ the context whose counts are used for context (None if there are none) """
+        return context if context in self.context else None
+
+    def batch_contexts(self) -> list:
+        """ all the contexts that generation can be in """
+        return list(self.context)
+
     def get_candidates(self, context: tuple) -> dict:
         """ get a mapping from candidate chord to its probability as the next chord given the context """
-        candidate_probs = {}
-        candidate_chords = self.context[context]
-        for c in candidate_chords:
-            candidate_probs[c] = self.prob(context, c)
+        candidate_chords, counts, count_of_context = self.successor_counts(context)
+        candidate_probs = {c: count / count_of_context for c, count in zip(candidate_chords, counts)}
         if self.verbose:
-            print(f"context: {context}\ncandidates: {candidate_probs}")
+            if self.vocab is not None:
+                print(f"context: {tuple(self.vocab.decode_seq(context))}\n"
+                      f"candidates: { {self.vocab.decode(c): p for c, p in candidate_probs.items()} }")
+            else:
+                print(f"context: {context}\ncandidates: {candidate_probs}")
         return candidate_probs
 
+    def sampling_table(self, context: tuple, method: str = "prob") -> tuple:
+        """
+        the candidate chords of a context and their cumulative probabilities, to sample the next chord with a binary search;
+        method: prob - candidates in order of first appearance (as given to random.choices);
+                semi - candidates sorted by chord string (as accumulated by gen_chord_semirandom);
+        tables are built the first time a context is used and kept until the next update
+        """
+        tables = self.sampling_tables[method]
+        table = tables.get(context)
+        if table is None:
+            candidate_chords, counts, count_of_context = self.successor_counts(context)
+            if method == "semi":
+                # (codes are sorted by their chord strings, like the strings themselves)
+                order = sorted(range(len(candidate_chords)),
+                               key=lambda i: self.vocab.decode(candidate_chords[i]) if self.vocab else candidate_chords[i])
+                candidate_chords, counts = [candidate_chords[i] for i in order], [counts[i] for i in order]
+            cum_probs = list(accumulate(count / count_of_context for count in counts))
+            table = tables[context] = (candidate_chords, cum_probs)
+        return table
+
     def gen_chord_semirandom(self, context: tuple):
         """
         Given a context we "semi-randomly" select the next chord to append in a sequence
         """
         # a random r between 0 and 1
         r = random.random()
+        if self.verbose:
+            self.get_candidates(context)
         # get all candidate chords
-        candidate_probs = self.get_candidates(context)
+        candidate_chords, cum_probs = self.sampling_table(context, method="semi")
 
         # accumulate probability from candidate chords by order form highest prob to lowest
         # until greater than the random r
         # semi-random -> next chord
-        summ = 0
-        for candidate_chord in sorted(candidate_probs):
-            summ +=candidate_probs[candidate_chord]
-            if summ > r:
-                return candidate_chord
+        i = bisect_right(cum_probs, r)
+        if i < len(candidate_chords):
+            return candidate_chords[i]
 
     def gen_chord_by_prob(self, context: tuple):
         """
         Given a context we randomly select the next chord by probability
         """
+        if self.verbose:
+            self.get_candidates(context)
         # get all candidate chords
-        candidates = self.get_candidates(context)
-        candidate_chords = list(candidates.keys())
-        candidate_probs = list(candidates.values())
-        # print(candidates, candidate_chords, candidate_probs)
-        return random.choices(candidate_chords, weights=candidate_probs, k=1)[0]
+        candidate_chords, cum_probs = self.sampling_table(context, method="prob")
+        return random.choices(candidate_chords, cum_weights=cum_probs, k=1)[0]
     
-    def generate(self, seq_len: int, method: str = "prob"):
+    def generate(self, seq_len: int, method: str = "prob", as_codes: bool = False):
         """
         seq_len: number of chords to be produced until encountering ending;
         method: prob - randomly generate by probability; 
                 semi - semi-randomly generate with a random threshold for probability;
+        as_codes: with a vocab, return the chord codes instead of the chord strings;
         Returns the generated chord sequence
         """
         n = self.n
         # context_queue: a window of context chords for the next chord to generate
         # start with context of all start symbols
-        context_queue = ['<s>'] * (n-1)
+        context_queue = [self.start] * (n-1)
         # result keeps track of the final sequence
         result = []
         for i in range(seq_len):
+            # a context that was never seen (or pruned) has no next chord
+            if self.resolve_context(tuple(context_queue)) is None:
+                break
             # generate a new chord with the specified method
             if method == "prob":
                 new_chord = self.gen_chord_by_prob(tuple(context_queue))
@@ -141,7 +317,7 @@ class NgramModel(object):
             result.append(new_chord)
 
             # once we reach an ending, the model should not proceed (no chord after ending)
-            if new_chord == "<e>":
+            if new_chord == self.end:
                 break
 
             # update the context queue like a sliding window
@@ -149,17 +325,880 @@ class NgramModel(object):
             # append newly generated chord - now the most recent context for the next iteration
             context_queue.pop(0)
             context_queue.append(new_chord)
+        if self.vocab is not None and not as_codes:
+            return self.vocab.decode_seq(result)
         return result
 
-def main(args):
-    if not args.dir:
+    def batch_tokens(self) -> list:
+        """
+        the tokens of a model without a vocab, in the order of their ids in generate_batch (the same for every method):
+        the start symbol, then the candidates of every context in order of first appearance
+        """
+        tokens = self.batch_sampling_tables.get("tokens")
+        if tokens is None:
+            tokens = [self.start]
+            for context in self.batch_contexts():
+                tokens.extend(self.successor_counts(context)[0])
+            tokens = self.batch_sampling_tables["tokens"] = list(dict.fromkeys(tokens))
+        return tokens
+
+    def batch_tables(self, method: str = "prob") -> dict:
+        """
+        the sampling tables of every context as flat arrays, for generate_batch (built once per method until the next update).
+        A sequence is in the context of the longest suffix of its history that starts a context of batch_contexts
+        (so it remembers as much of its history as generate, and only backs off to look up its candidates);
+        contexts are numbered in the order of batch_contexts (then their other prefixes) and tokens are the chord codes
+        with a vocab (otherwise indices into "tokens", see batch_tokens); the candidates of context i are the entries
+        offsets[i]:offsets[i + 1] of
+        token: the candidate next token;
+        cum_probs: the cumulative probability of the candidates, plus i (so that one searchsorted finds the candidate of every context);
+        next_context: the context after the candidate (-1 if it has no candidates, e.g. after <e>)
+        """
+        tables = self.batch_sampling_tables.get(method)
+        if tables is not None:
+            return tables
+        contexts = self.batch_contexts()
+        # with backoff, a context can be kept while its prefix was pruned: the prefix is still needed to get to the context
+        prefixes = list(dict.fromkeys(contexts + [context[:k] for context in contexts for k in range(len(context))]))
+        resolved = [self.resolve_context(context) for context in prefixes]
+        contexts = [context for context, r in zip(prefixes, resolved) if r is not None]
+        context_idx = {context: i for i, context in enumerate(contexts)}
+        prefixes = set(prefixes)
+
+        def next_context_idx(history: tuple) -> int:
+            # the longest suffix of the history that starts a context
+            for k in range(len(history) + 1):
+                if history[k:] in prefixes:
+                    return context_idx.get(history[k:], -1)
+            return -1
+
+        tables = [self.sampling_table(r, method=method) for r in resolved if r is not None]
+        if self.vocab is not None:
+            tokens = None
+            token_idx = None
+        else:
+            tokens = self.batch_tokens()
+            token_idx = {t: i for i, t in enumerate(tokens)}
+        token, cum_probs, next_context, offsets = [], [], [], [0]
+        for i, (context, (candidate_chords, context_cum_probs)) in enumerate(zip(contexts, tables)):
+            token.extend(candidate_chords if token_idx is None else [token_idx[c] for c in candidate_chords])
+            cum_probs.extend(p + i for p in context_cum_probs)
+            next_context.extend(next_context_idx((context + (c,))[1 - self.n:]) for c in candidate_chords)
+            offsets.append(len(token))
+        tables = self.batch_sampling_tables[method] = {
+            "tokens": tokens,
+            "token": np.array(token, dtype=np.int32),
+            "cum_probs": np.array(cum_probs),
+            "next_context": np.array(next_context, dtype=np.int64),
+            "offsets": np.array(offsets, dtype=np.int64),
+            "start": next_context_idx((self.start,) * (self.n - 1)),
+            "end": self.end if token_idx is None else token_idx.get(self.end, -1),
+        }
+        return tables
+
+    def generate_batch(self, num_seqs: int, seq_len: int, method: str = "prob", seed: int = None) -> np.ndarray:
+        """
+        generate num_seqs sequences at once, all advancing in lockstep with one numpy random draw per sequence and step;
+        seq_len: max number of chords per sequence (a sequence stops after <e>);
+        method: prob / semi, as in generate;
+        seed: seed of the numpy random generator;
+        Returns a (num_seqs, seq_len) int array of chord codes with a vocab (otherwise indices into batch_tokens()),
+        padded with -1 after the end of each sequence (see decode_batch)
+        """
+        if method not in ("prob", "semi"):
+            raise ValueError("Unrecognized method for generating chords with an Ngrams model. Currently supported methods are: 'prob', 'semi'.")
+        tables = self.batch_tables(method)
+        token, cum_probs, next_context, offsets = tables["token"], tables["cum_probs"], tables["next_context"], tables["offsets"]
+        # "prob" scales the random numbers by the total probability like random.choices;
+        # "semi" compares them to the cumulative probabilities as they are
+        totals = cum_probs[offsets[1:] - 1] - np.arange(len(offsets) - 1) if method == "prob" else None
+
+        rng = np.random.default_rng(seed)
+        result = np.full((num_seqs, seq_len), -1, dtype=np.int32)
+        # the current context of each sequence that hasn't ended yet
+        # (none of them can start if the start context has no candidates, like generate)
+        rows = np.arange(num_seqs) if tables["start"] >= 0 else np.arange(0)
+        context = np.full(len(rows), tables["start"], dtype=np.int64)
+        for i in range(seq_len):
+            if not len(rows):
+                break
+            r = rng.random(len(rows))
+            if totals is not None:
+                r *= totals[context]
+            # the first candidate whose cumulative probability is greater than r (or the last one, for rounding errors)
+            j = np.searchsorted(cum_probs, context + r, side='right')
+            j = np.minimum(j, offsets[context + 1] - 1)
+            result[rows, i] = token[j]
+            context = next_context[j]
+            # once we reach an ending (or a context never seen), the sequence should not proceed
+            going = (token[j] != tables["end"]) & (context >= 0)
+            rows, context = rows[going], context[going]
+        return result
+
+    def score_tables(self) -> dict:
+        """
+        the log probabilities of the ngrams as sorted arrays, for score (built once until the next update).
+        Tokens are ids: the chord codes with a vocab, otherwise indices into "ids" (a dict from token to id);
+        contexts: the contexts as rows of ids (big endian, so that they sort like their bytes) padded on the left with PAD,
+        sorted; ngrams: the context index * 2**16 + the id of the next token, sorted, with the log probability in log_probs
+        """
+        tables = self.batch_sampling_tables.get("score")
+        if tables is not None:
+            return tables
+        ids = None if self.vocab is not None else {}
+        padded, ngrams, log_probs = [], [], []
+        for context in self.batch_contexts():
+            candidate_chords, counts, count_of_context = self.successor_counts(context)
+            if ids is not None:
+                context = tuple(ids.setdefault(t, len(ids)) for t in context)
+                candidate_chords = [ids.setdefault(t, len(ids)) for t in candidate_chords]
+            padded.append(((PAD,) * (self.n - 1 - len(context)) + context, candidate_chords, counts, count_of_context))
+        padded.sort(key=lambda entry: entry[0])
+        for i, (_, candidate_chords, counts, count_of_context) in enumerate(padded):
+            ngrams.extend(i * 0x10000 + c for c in candidate_chords)
+            log_probs.extend(np.log(np.array(counts) / count_of_context).tolist())
+        order = np.argsort(ngrams, kind='stable')
+        contexts = np.array([context for context, _, _, _ in padded], dtype=">u2").reshape(-1, self.n - 1)
+        tables = self.batch_sampling_tables["score"] = {
+            "ids": ids,
+            "contexts": contexts.view(f"V{2 * (self.n - 1)}").reshape(-1),
+            "ngrams": np.array(ngrams, dtype=np.int64)[order],
+            "log_probs": np.array(log_probs)[order],
+        }
+        return tables
+
+    def score(self, sequences, unseen_prob: float = 0.0) -> tuple:
+        """
+        the log likelihood (natural log) of many sequences at once, with one vectorized lookup of all their ngrams;
+        sequences: a list of sequences of chords (strings or codes with a vocab, otherwise tokens); a sequence that doesn't
+                   start with <s> is scored as if it did; the chords after the start are scored, like update counts them
+                   (e.g. a piece of the corpus, or a sequence from generate);
+        unseen_prob: probability of an ngram never seen (0 gives a log likelihood of -inf);
+        a context never seen backs off to its longest seen suffix with a model that backs off, like prob;
+        Returns an array of the log likelihood of each sequence, and the perplexity of all the chords of all the sequences
+        """
+        tables = self.score_tables()
+        n = self.n
+        unknown = PAD - 1
+        start = self.start if tables["ids"] is None else tables["ids"].get(self.start, unknown)
+        seq_ids = []
+        for seq in sequences:
+            if tables["ids"] is None:
+                seq = self.vocab.encode_seq(seq).astype(np.int64)
+            else:
+                seq = np.array([tables["ids"].get(t, unknown) for t in seq], dtype=np.int64)
+            if not len(seq) or seq[0] != start:
+                seq = np.concatenate(([start], seq))
+            # like update: a start symbol stands for n-1 of them
+            seq_ids.append(np.repeat(seq, np.where(seq == start, n - 1, 1)))
+        lengths = np.array([len(seq) for seq in seq_ids], dtype=np.int64)
+        log_likelihood = np.zeros(len(seq_ids))
+        if not len(seq_ids) or lengths.sum() < n:
+            return log_likelihood, float("nan")
+
+        # the ngrams of all the sequences, from their windows that don't cross the start of a sequence
+        all_ids = np.concatenate(seq_ids)
+        seq_idx = np.repeat(np.arange(len(seq_ids)), lengths)
+        position = np.arange(len(all_ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        valid = position[n - 1:] >= n - 1
+        ngrams = np.lib.stride_tricks.sliding_window_view(all_ids, n)[valid]
+        ngram_seq = seq_idx[n - 1:][valid]
+
+        def find(table: np.ndarray, keys: np.ndarray) -> np.ndarray:
+            """ index of each key in a sorted table, -1 if it isn't there """
+            if not len(table):
+                return np.full(len(keys), -1)
+            i = np.minimum(np.searchsorted(table, keys), len(table) - 1)
+            return np.where(table[i] == keys, i, -1)
+
+        def find_contexts(rows: np.ndarray) -> np.ndarray:
+            """ index of each context (row of ids) in the tables, -1 if it wasn't seen """
+            return find(tables["contexts"], np.ascontiguousarray(rows.astype(">u2")).view(tables["contexts"].dtype).reshape(-1))
+
+        context_rows = ngrams[:, :-1].copy()
+        context_idx = find_contexts(context_rows)
+        if self.backoff:
+            # the longest seen suffix of the contexts never seen
+            for length in range(n - 2, -1, -1):
+                missing = np.flatnonzero(context_idx < 0)
+                if not len(missing):
+                    break
+                context_rows[missing, :n - 1 - length] = PAD
+                context_idx[missing] = find_contexts(context_rows[missing])
+        j = find(tables["ngrams"], np.where(context_idx >= 0, context_idx * 0x10000 + ngrams[:, -1], -1))
+        with np.errstate(divide='ignore'):
+            log_probs = np.where(j >= 0, tables["log_probs"][j], np.log(unseen_prob))
+        log_likelihood = np.bincount(ngram_seq, weights=log_probs, minlength=len(seq_ids))
+        perplexity = float(np.exp(-log_likelihood.sum() / len(log_probs))) if len(log_probs) else float("nan")
+        return log_likelihood, perplexity
+
+    def save(self, fpath: str) -> None:
+        """
+        save the model into a packed file that load_model maps back: the contexts as a sorted (num_contexts, n-1) array
+        of codes (big endian, so that they sort like their bytes), and the candidate next chords of context i with their
+        counts at offsets[i]:offsets[i + 1] of successors and counts, in order of first appearance (so that a loaded model
+        generates the same sequences); the chord strings of the vocab are in the header.
+        Only models with a vocab can be saved
+        """
+        if self.vocab is None:
+            raise ValueError("only models with a vocab (of chord codes) can be saved")
+        width = self.n - 1
+        contexts = sorted((PAD,) * (width - len(context)) + context for context in self.batch_contexts())
+        successors, counts, offsets = [], [], [0]
+        for padded in contexts:
+            candidate_chords, context_counts, _ = self.successor_counts(tuple(c for c in padded if c != PAD))
+            successors.extend(candidate_chords)
+            counts.extend(context_counts)
+            offsets.append(len(successors))
+        arrays = {
+            "contexts": np.array(contexts, dtype=">u2").reshape(-1),
+            "offsets": np.array(offsets, dtype=np.int64),
+            "successors": np.array(successors, dtype=np.uint16),
+            "counts": np.array(counts, dtype=np.int64),
+        }
+        codes = np.union1d(arrays["contexts"], arrays["successors"])
+        header = {
+            "version": MODEL_VERSION,
+            "n": self.n,
+            "backoff": self.backoff,
+            "chords": [self.vocab.decode(code) for code in codes[codes != PAD].tolist()],
+        }
+        write_packed(fpath, MODEL_MAGIC, header, arrays)
+
+    def decode_batch(self, batch: np.ndarray) -> list:
+        """ the sequences of chord strings (or tokens, without a vocab) of a batch returned by generate_batch """
+        tokens = self.batch_tokens() if self.vocab is None else None
+        sequences = []
+        for row in batch.tolist():
+            row = [t for t in row if t >= 0]
+            sequences.append(self.vocab.decode_seq(row) if tokens is None else [tokens[t] for t in row])
+        return sequences
+
+
+def _smallest(array: np.ndarray) -> np.ndarray:
+    """ array of non-negative integers as the smallest unsigned type that holds its values """
+    return array.astype(np.min_scalar_type(int(array.max(initial=0))))
+
+
+class NgramTrie(object):
+    """
+    counts of the ngrams of every order up to max_n, in one pass over the data.
+    Contexts are stored in a suffix trie: the node of a context (c_1, ..., c_k) is the child of the node of (c_2, ..., c_k)
+    for c_1, so the contexts of all orders share their nodes. model(n) is an NgramModel of order n that reads from the trie,
+    backing off to the longest seen suffix of an unseen context.
+    The trie is kept in flat arrays of chord ids (the codes with a vocab, otherwise indices into self.tokens), one set per
+    level k (contexts of k chords), in the smallest integer types that hold them:
+    chords[k]: the oldest chord of each context, sorted by parent context and then by chord;
+    children[k]: the contexts extended by chord chords[k + 1][j] are the entries children[k][i]:children[k][i + 1] of level k + 1;
+    offsets[k], successors[k], counts[k]: the next chords of context i and their counts are the entries
+                                           offsets[k][i]:offsets[k][i + 1], in order of first appearance.
+    update only keeps the chords; they are counted into the arrays (with a few sorts) the next time the counts are used
+    """
+    def __init__(self, max_n: int, verbose: bool = False, vocab: ChordVocab = None):
+        if max_n < 2:
+            raise ValueError("N for an Ngram model must be greater than 1.")
+        self.max_n = max_n
+        self.verbose = verbose
+        self.vocab = vocab
+        self.start = vocab.start if vocab else '<s>'
+        self.end = vocab.end if vocab else '<e>'
+        # without a vocab, the chords by id and the id of each chord
+        self.tokens = [] if vocab else [self.start]
+        self.token_ids = {} if vocab else {self.start: 0}
+        self.start_id = self.start if vocab else 0
+        # the chords of each update not counted yet, as arrays of ids
+        self.pending = []
+        # views returned by model, to drop their sampling tables on update
+        self.views = {}
+        empty = np.zeros(0, dtype=np.int64)
+        self._build(np.zeros((0, max_n - 1), dtype=np.int32), empty, empty, empty, empty)
+
+    def _reset_views(self) -> None:
+        for view in self.views.values():
+            view.sampling_tables = {"prob": {}, "semi": {}}
+            view.batch_sampling_tables = {}
+
+    def _token_id(self, token) -> int:
+        """ the id of a chord string of a trie without a vocab (a new id if it wasn't seen) """
+        token_id = self.token_ids.get(token)
+        if token_id is None:
+            token_id = self.token_ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return token_id
+
+    def update(self, chord_list) -> None:
+        """
+        count the ngrams of all orders as the chords stream from chord_list
+        chord_list: an iterable of chords (strings, or codes with a vocab) from the data, in sequential order
+        """
+        if self.vocab is None:
+            ids = [self._token_id(c) for c in chord_list]
+        elif isinstance(chord_list, np.ndarray):
+            ids = chord_list
+        else:
+            ids = [self.vocab.encode(c) if isinstance(c, str) else c for c in chord_list]
+        self._reset_views()
+        self.pending.append(np.asarray(ids, dtype=np.int64))
+
+    def update_pieces(self, pieces) -> None:
+        """
+        count the ngrams one piece at a time;
+        pieces: an iterable of (name, keys, chords), e.g. parse_chords.iter_chord_dir or ChordCorpus.pieces
+        """
+        for _, _, chords in pieces:
+            self.update(chords)
+
+    def merge(self, other: "NgramTrie") -> "NgramTrie":
+        """
+        add the counts of another trie of the same max_n (e.g. counted on another shard of the corpus, in another process)
+        to this trie, node by node; the result is the same as updating this trie with the other trie's data after its own.
+        Returns self
+        """
+        if other.max_n != self.max_n:
+            raise ValueError(f"can't merge a trie of max_n {other.max_n} into a trie of max_n {self.max_n}")
+        if (other.vocab is None) != (self.vocab is None):
+            raise ValueError("can't merge a trie of chord codes with a trie of chord strings")
+        self._reset_views()
+        contexts, chords, counts, lo, hi = other._table()
+        if self.vocab is None:
+            # the ids of the other trie's chords in this trie
+            ids = np.array([self._token_id(token) for token in other.tokens], dtype=np.int64)
+            contexts = np.where(contexts >= 0, ids[contexts], -1).astype(np.int32)
+            chords = ids[chords]
+        self._build(*(np.concatenate(parts) for parts in zip(self._table(), (contexts, chords, counts, lo, hi))))
+        return self
+
+    def _windows(self, ids: np.ndarray) -> tuple:
+        """
+        the ngrams of a chord list given to update, as rows for _build: the previous max_n-1 chords of each chord (the most
+        recent first, -1 before the start of the list), the chord, and the number of previous chords
+        """
+        width = self.max_n - 1
+        # a start symbol fills the window with start symbols, so that every order sees enough of them (and isn't counted)
+        stream = np.repeat(ids, np.where(ids == self.start_id, width, 1))
+        counted = np.flatnonzero(stream != self.start_id)
+        padded = np.concatenate((np.full(width, -1, dtype=np.int64), stream))
+        windows = np.lib.stride_tricks.sliding_window_view(padded, width)[counted, ::-1]
+        return windows.astype(np.int32), stream[counted], np.minimum(counted, width)
+
+    def _table(self) -> tuple:
+        """ the counts of the trie as rows for _build, each counted at the level of its context only """
+        self._flush()
+        width = self.max_n - 1
+        contexts = [np.full((1, width), -1, dtype=np.int32)]
+        rows = []
+        for k in range(width + 1):
+            if k:
+                parents = np.repeat(np.arange(len(self.chords[k - 1])), np.diff(self.children[k - 1].astype(np.int64)))
+                contexts.append(contexts[k - 1][parents])
+                contexts[k][:, k - 1] = self.chords[k]
+            nodes = np.repeat(np.arange(len(self.chords[k])), np.diff(self.offsets[k].astype(np.int64)))
+            level = np.full(len(nodes), k, dtype=np.int64)
+            rows.append((contexts[k][nodes], self.successors[k].astype(np.int64), self.counts[k].astype(np.int64), level, level))
+        return tuple(np.concatenate(parts) for parts in zip(*rows))
+
+    def _build(self, contexts: np.ndarray, chords: np.ndarray, counts: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> None:
+        """
+        (re)build the arrays of the trie from rows of counts: row r counts counts[r] times chords[r] after the contexts of
+        lo[r] to hi[r] chords of contexts[r] (the previous chords, the most recent first); the next chords of each context
+        are in order of their first row
+        """
+        width = self.max_n - 1
+        self.radix = radix = max(len(self.tokens), int(chords.max(initial=-1)) + 1, int(contexts.max(initial=-1)) + 1, 1)
+        rows = np.arange(len(chords))
+        # the node of each row at the current level
+        node_ids = np.zeros(len(chords), dtype=np.int64)
+        num_nodes = 1
+        self.chords = [np.zeros(1, dtype=np.uint8)]
+        self.children, self.offsets, self.successors, self.counts = [], [], [], []
+        for k in range(width + 1):
+            # the ngrams counted at this level (all the rows left reach it)
+            at = lo <= k
+            ngrams, first, inverse = np.unique(node_ids[at] * radix + chords[at], return_index=True, return_inverse=True)
+            ngram_counts = np.bincount(inverse, weights=counts[at], minlength=len(ngrams)).astype(np.int64)
+            nodes = ngrams // radix
+            order = np.lexsort((rows[at][first], nodes))
+            self.offsets.append(_smallest(np.searchsorted(nodes[order], np.arange(num_nodes + 1))))
+            self.successors.append(_smallest(ngrams[order] % radix))
+            self.counts.append(_smallest(ngram_counts[order]))
+            if k == width:
+                self.children.append(np.zeros(num_nodes + 1, dtype=np.uint8))
+                break
+            # the nodes of the next level: the contexts extended by their previous chord
+            deeper = hi > k
+            rows, contexts, chords, counts, lo, hi = (a[deeper] for a in (rows, contexts, chords, counts, lo, hi))
+            nodes, node_ids = np.unique(node_ids[deeper] * radix + contexts[:, k], return_inverse=True)
+            self.children.append(_smallest(np.searchsorted(nodes // radix, np.arange(num_nodes + 1))))
+            self.chords.append(_smallest(nodes % radix))
+            num_nodes = len(nodes)
+        self.lookup = [[memoryview(a) for a in arrays] for arrays in (self.chords, self.children, self.offsets)]
+
+    def _flush(self) -> None:
+        """ count the chords of the updates since the last time the counts were used """
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        tables = [self._table()]
+        for ids in pending:
+            windows, chords, lengths = self._windows(ids)
+            tables.append((windows, chords, np.ones(len(chords), dtype=np.int64), np.zeros(len(chords), dtype=np.int64), lengths))
+        self._build(*(np.concatenate(parts) for parts in zip(*tables)))
+
+    def find(self, context: tuple, max_len: int = None) -> tuple:
+        """ the level and index of the node of the longest suffix of context (of at most max_len chords) that was seen,
+            and that suffix (suffixes whose next chords were all pruned are skipped) """
+        self._flush()
+        # (memoryviews read single entries much faster than the arrays)
+        chords, children, offsets = self.lookup
+        level = index = found_level = found_index = 0
+        for prev in reversed(context[-max_len:] if max_len else context):
+            prev = self.token_ids.get(prev) if self.vocab is None else prev
+            if prev is None or not 0 <= prev < self.radix:
+                break
+            lo, hi = children[level][index], children[level][index + 1]
+            index = bisect_left(chords[level + 1], prev, lo, hi)
+            if index == hi or chords[level + 1][index] != prev:
+                break
+            level += 1
+            if offsets[level][index + 1] > offsets[level][index]:
+                found_level, found_index = level, index
+        return found_level, found_index, tuple(context[len(context) - found_level:])
+
+    def successor_counts(self, level: int, index: int) -> tuple:
+        """ (next chords in order of first appearance, their counts, total count) of the node index of level """
+        start, end = int(self.offsets[level][index]), int(self.offsets[level][index + 1])
+        successors = self.successors[level][start:end].tolist()
+        counts = self.counts[level][start:end].tolist()
+        if self.vocab is None:
+            successors = [self.tokens[c] for c in successors]
+        return successors, counts, sum(counts)
+
+    def contexts(self, max_len: int) -> list:
+        """ all the seen contexts of at most max_len chords, shorter first """
+        self._flush()
+        result = [()]
+        level_contexts = [()]
+        for k in range(1, min(max_len, self.max_n - 1) + 1):
+            chords = self.chords[k].tolist()
+            if self.vocab is None:
+                chords = [self.tokens[c] for c in chords]
+            parents = np.repeat(np.arange(len(level_contexts)), np.diff(self.children[k - 1].astype(np.int64))).tolist()
+            level_contexts = [(c,) + level_contexts[p] for c, p in zip(chords, parents)]
+            result.extend(level_contexts)
+        return result
+
+    def prune(self, min_count: int = 1, max_contexts: int = None, min_entropy: float = None) -> "NgramTrie":
+        """
+        drop rare ngrams and contexts to cap the memory of the trie; the models then back off to the longest suffix left,
+        and the probabilities of the contexts left are renormalized. The unigram counts (empty context) are always kept.
+        min_count: drop the ngrams seen fewer times;
+        max_contexts: keep only the max_contexts most frequent contexts (of all orders);
+        min_entropy: drop the contexts whose next chords are predicted about as well by their backoff (the context without
+                     its oldest chord): the relative entropy (in bits) of their distribution from the backoff distribution,
+                     weighted by how often they occur, is below min_entropy; a context is only dropped with its longer contexts;
+        Returns self
+        """
+        self._reset_views()
+        self._flush()
+        width = self.max_n - 1
+        num_ngrams = int(self.counts[0].sum())
+        parents = [None] + [np.repeat(np.arange(len(self.chords[k - 1])), np.diff(self.children[k - 1].astype(np.int64)))
+                            for k in range(1, width + 1)]
+        nodes = [np.repeat(np.arange(len(self.chords[k])), np.diff(self.offsets[k].astype(np.int64))) for k in range(width + 1)]
+        successors = [s.astype(np.int64) for s in self.successors]
+        counts = [c.astype(np.int64) for c in self.counts]
+        keep = [np.ones(len(chords), dtype=bool) for chords in self.chords]
+        totals = [np.bincount(nodes[k], weights=counts[k], minlength=len(self.chords[k])) for k in range(width + 1)]
+
+        # the longest contexts first, so that a context is only dropped once its longer contexts are
+        has_children = np.zeros(len(self.chords[width]), dtype=bool)
+        for k in range(width, 0, -1):
+            num_nodes = len(self.chords[k])
+            # (the backoff distribution, of the parents, is the one before they are pruned themselves)
+            backoff_totals = totals[k - 1]
+            if min_count > 1:
+                kept = counts[k] >= min_count
+                nodes[k], successors[k], counts[k] = nodes[k][kept], successors[k][kept], counts[k][kept]
+                totals[k] = np.bincount(nodes[k], weights=counts[k], minlength=num_nodes)
+            drop = ~has_children & (totals[k] == 0)
+            if min_entropy is not None:
+                backoff_keys = nodes[k - 1] * self.radix + successors[k - 1]
+                order = np.argsort(backoff_keys)
+                j = order[np.searchsorted(backoff_keys[order], parents[k][nodes[k]] * self.radix + successors[k])]
+                p = counts[k] / totals[k][nodes[k]]
+                entropy = np.bincount(nodes[k], minlength=num_nodes, weights=p * np.log2(
+                    p * backoff_totals[parents[k][nodes[k]]] / counts[k - 1][j]))
+                with np.errstate(invalid='ignore'):
+                    drop |= ~has_children & (totals[k] / num_ngrams * entropy < min_entropy)
+            keep[k] = ~drop
+            has_children = np.bincount(parents[k][keep[k]], minlength=len(self.chords[k - 1])) > 0
+
+        if max_contexts is not None:
+            levels = np.concatenate([np.full(len(self.chords[k]), k) for k in range(1, width + 1)])
+            context_totals = np.concatenate(totals[1:])
+            kept = np.concatenate(keep[1:])
+            candidates = np.flatnonzero(kept)
+            if len(candidates) > max_contexts:
+                # a context occurs at least as often as its longer contexts, so keeping the most frequent ones
+                # (the shorter first among the same counts) keeps the trie connected
+                order = np.lexsort((levels[candidates], -context_totals[candidates]))
+                kept[candidates[order[max_contexts:]]] = False
+                keep[1:] = np.split(kept, np.cumsum([len(self.chords[k]) for k in range(1, width)]))
+
+        # renumber the nodes left (a node goes with its parent)
+        new_index = [np.zeros(1, dtype=np.int64)]
+        for k in range(1, width + 1):
+            keep[k] &= keep[k - 1][parents[k]]
+            new_index.append(np.cumsum(keep[k]) - 1)
+        for k in range(width + 1):
+            kept_ngrams = keep[k][nodes[k]]
+            node_ids = new_index[k][nodes[k][kept_ngrams]]
+            num_nodes = int(keep[k].sum())
+            self.offsets[k] = _smallest(np.searchsorted(node_ids, np.arange(num_nodes + 1)))
+            self.successors[k] = _smallest(successors[k][kept_ngrams])
+            self.counts[k] = _smallest(counts[k][kept_ngrams])
+            if k:
+                self.chords[k] = self.chords[k][keep[k]]
+                self.children[k - 1] = _smallest(np.searchsorted(new_index[k - 1][parents[k][keep[k]]],
+                                                                 np.arange(len(self.chords[k - 1]) + 1)))
+        self.children[width] = np.zeros(len(self.chords[width]) + 1, dtype=np.uint8)
+        self.lookup = [[memoryview(a) for a in arrays] for arrays in (self.chords, self.children, self.offsets)]
+        return self
+
+    def memory_report(self, max_n: int = None) -> dict:
+        """
+        memory taken by the trie, by order (of the ngrams: context length + 1, up to max_n):
+        {n: {"contexts": number of contexts, "ngrams": number of ngrams, "bytes": bytes of the arrays of its level}}
+        """
+        self._flush()
+        report = {}
+        for k in range(min(max_n or self.max_n, self.max_n)):
+            arrays = (self.chords[k], self.children[k], self.offsets[k], self.successors[k], self.counts[k])
+            report[k + 1] = {
+                "contexts": len(self.chords[k]),
+                "ngrams": len(self.successors[k]),
+                "bytes": sum(a.nbytes for a in arrays),
+            }
+        return report
+
+    def model(self, n: int) -> "NgramTrieModel":
+        """ the model of order n (n <= max_n) """
+        if not 2 <= n <= self.max_n:
+            raise ValueError(f"N must be between 2 and {self.max_n}.")
+        if n not in self.views:
+            self.views[n] = NgramTrieModel(self, n)
+        return self.views[n]
+
+
+class NgramTrieModel(NgramModel):
+    """
+    an NgramModel of order n that reads its counts from an NgramTrie (see NgramTrie.model).
+    A context that was never seen backs off to its longest seen suffix, down to the unigram counts
+    """
+    backoff = True
+
+    def __init__(self, trie: NgramTrie, n: int):
+        self.trie = trie
+        self.n = n
+        self.verbose = trie.verbose
+        self.vocab = trie.vocab
+        self.start = trie.start
+        self.end = trie.end
+        self.sampling_tables = {"prob": {}, "semi": {}}
+        self.batch_sampling_tables = {}
+
+    def update(self, chord_list) -> None:
+        """ updates the trie (and so the models of every order) """
+        self.trie.update(chord_list)
+
+    def merge(self, other: "NgramTrieModel") -> "NgramTrieModel":
+        """ merges the trie of another view into the trie (and so the models of every order, see NgramTrie.merge) """
+        self.trie.merge(other.trie)
+        return self
+
+    def prune(self, min_count: int = 1, max_contexts: int = None, min_entropy: float = None) -> "NgramTrieModel":
+        """ prunes the trie (and so the models of every order, see NgramTrie.prune) """
+        self.trie.prune(min_count, max_contexts, min_entropy)
+        return self
+
+    def memory_report(self) -> dict:
+        """ memory of the orders of the trie used by this model (see NgramTrie.memory_report) """
+        return self.trie.memory_report(self.n)
+
+    def successor_counts(self, context: tuple) -> tuple:
+        level, index, _ = self.trie.find(context, self.n - 1)
+        return self.trie.successor_counts(level, index)
+
+    def resolve_context(self, context: tuple):
+        return self.trie.find(context, self.n - 1)[2]
+
+    def batch_contexts(self) -> list:
+        return self.trie.contexts(self.n - 1)
+
+    def prob(self, context: tuple, next_chord: str):
+        """
+        Calculates probability of a candidate chord to be generated given a context
+        (or its longest seen suffix);
+        Returns conditional probability
+        """
+        candidate_chords, counts, count_of_context = self.successor_counts(context)
+        if not count_of_context:
+            return 0.0
+        for c, count in zip(candidate_chords, counts):
+            if c == next_chord:
+                return count / count_of_context
+        return 0.0
+
+
+class PackedNgramModel(NgramModel):
+    """
+    a read-only NgramModel loaded from a file saved by NgramModel.save (see load_model). The arrays are memory maps of
+    the file, so loading takes no time whatever the size of the model, and processes that load the same file share its pages
+    """
+    def __init__(self, fpath: str, verbose: bool = False):
+        header, arrays = read_packed(fpath, MODEL_MAGIC, MODEL_VERSION, "saved ngram model")
+        self.path = fpath
+        self.header = header
+        self.n = header["n"]
+        self.backoff = header["backoff"]
+        self.verbose = verbose
+        self.vocab = ChordVocab()
+        for chord_str in header["chords"]:
+            self.vocab.encode(chord_str)
+        self.start = self.vocab.start
+        self.end = self.vocab.end
+        self.contexts = arrays["contexts"].reshape(-1, self.n - 1)
+        # each context as one byte string, to binary search the sorted contexts
+        self.context_keys = self.contexts.view(f"V{self.contexts.itemsize * (self.n - 1)}").reshape(-1)
+        self.offsets = arrays["offsets"]
+        self.successors = arrays["successors"]
+        self.counts = arrays["counts"]
+        self.sampling_tables = {"prob": {}, "semi": {}}
+        self.batch_sampling_tables = {}
+
+    def update(self, chord_list) -> None:
+        raise ValueError("a loaded model is read-only")
+
+    def merge(self, other):
+        raise ValueError("a loaded model is read-only")
+
+    def prune(self, min_count: int = 1, max_contexts: int = None, min_entropy: float = None):
+        raise ValueError("a loaded model is read-only")
+
+    def memory_report(self) -> dict:
+        """ size of the arrays of each order (in the memory map, so only the pages used are read) """
+        report = {}
+        lengths = (self.contexts != PAD).sum(axis=1)
+        num_successors = np.diff(self.offsets)
+        row_bytes = self.contexts.itemsize * (self.n - 1) + self.offsets.itemsize
+        ngram_bytes = self.successors.itemsize + self.counts.itemsize
+        for length in np.unique(lengths).tolist():
+            sel = lengths == length
+            num_ngrams = int(num_successors[sel].sum())
+            report[length + 1] = {
+                "contexts": int(sel.sum()),
+                "ngrams": num_ngrams,
+                "bytes": int(sel.sum()) * row_bytes + num_ngrams * ngram_bytes,
+            }
+        return report
+
+    def find(self, context: tuple) -> int:
+        """ index of a context in self.contexts (-1 if it wasn't saved) """
+        if len(context) > self.n - 1 or any(not 0 <= c < PAD for c in context):
+            return -1
+        padded = np.array((PAD,) * (self.n - 1 - len(context)) + tuple(context), dtype=self.contexts.dtype)
+        key = padded.view(self.context_keys.dtype)[0]
+        i = int(np.searchsorted(self.context_keys, key))
+        return i if i < len(self.context_keys) and self.context_keys[i] == key else -1
+
+    def resolve_context(self, context: tuple):
+        context = tuple(context)[len(context) - (self.n - 1):] if len(context) > self.n - 1 else tuple(context)
+        shortest = 0 if self.backoff else len(context)
+        for k in range(len(context), shortest - 1, -1):
+            suffix = context[len(context) - k:]
+            if self.find(suffix) >= 0:
+                return suffix
+        return None
+
+    def batch_contexts(self) -> list:
+        return [tuple(c for c in row if c != PAD) for row in self.contexts.tolist()]
+
+    def successor_counts(self, context: tuple) -> tuple:
+        resolved = self.resolve_context(context)
+        if resolved is None:
+            raise KeyError(context)
+        i = self.find(resolved)
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        counts = self.counts[start:end].tolist()
+        return self.successors[start:end].tolist(), counts, sum(counts)
+
+    def prob(self, context: tuple, next_chord: str):
+        """
+        Calculates probability of a candidate chord to be generated given a context;
+        Returns conditional probability
+        """
+        try:
+            candidate_chords, counts, count_of_context = self.successor_counts(context)
+        except KeyError:
+            return 0.0
+        for c, count in zip(candidate_chords, counts):
+            if c == next_chord:
+                return count / count_of_context
+        return 0.0
+
+
+def load_model(fpath: str, verbose: bool = False) -> PackedNgramModel:
+    """ load a model saved by NgramModel.save (raises ValueError if the file isn't a saved model of the current version) """
+    return PackedNgramModel(fpath, verbose=verbose)
+
+
+def _write_run(ngrams: np.ndarray, first: np.ndarray, run_fpath: str) -> None:
+    """ write a sorted run of build_model: the unique rows of ngrams (big endian codes, so that they sort like their bytes),
+        with their counts and the position of their first occurrence """
+    keys = ngrams.view(f"V{ngrams.itemsize * ngrams.shape[1]}").reshape(-1)
+    # stable, so that the first occurrence of each ngram comes first
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    run = np.empty(len(starts), dtype=[("ngram", ngrams.dtype, (ngrams.shape[1],)), ("count", np.int64), ("first", np.int64)])
+    run["ngram"] = ngrams[order[starts]]
+    run["count"] = np.diff(np.append(starts, len(keys)))
+    run["first"] = first[order[starts]]
+    np.save(run_fpath, run)
+
+
+def _read_run(run_fpath: str, block_size: int):
+    """ generator over the (ngram, first occurrence, count) of a run written by _write_run, reading block_size rows at a time """
+    run = np.load(run_fpath, mmap_mode="r")
+    for i in range(0, len(run), block_size):
+        block = run[i:i + block_size]
+        yield from zip(map(tuple, block["ngram"].tolist()), block["first"].tolist(), block["count"].tolist())
+
+
+def _add_context(context: tuple, candidates: list, arrays: dict) -> None:
+    """ append a context of build_model and its (first occurrence, next chord, count) candidates to the lists of arrays
+        (the number of candidates to "offsets"), the candidates in order of first appearance, like NgramModel """
+    if context is None:
         return
+    candidates.sort()
+    arrays["contexts"].extend(context)
+    arrays["successors"].extend(c for _, c, _ in candidates)
+    arrays["counts"].extend(count for _, _, count in candidates)
+    arrays["offsets"].append(len(candidates))
+
+
+def build_model(pieces, n: int, fpath: str, vocab: ChordVocab, chunk_size: int = 1 << 20, tmp_dir: str = None) -> str:
+    """
+    count the ngrams of a corpus too large for memory into a saved model file (see NgramModel.save, load_model),
+    the same model as NgramModel(n, vocab=vocab).update_pieces(pieces).
+    The ngrams are encoded as arrays of codes, chunk_size at a time; each chunk is counted and sorted into a run on disk,
+    then the runs are merged (counting the same ngrams together) straight into the arrays of the model file,
+    so the memory used is bounded by chunk_size whatever the size of the corpus.
+    pieces: an iterable of (name, keys, chords), e.g. parse_chords.iter_chord_dir or ChordCorpus.pieces;
+    tmp_dir: directory of the runs (defaults to the directory of fpath);
+    returns fpath
+    """
+    if n < 2:
+        raise ValueError("N for an Ngram model must be greater than 1.")
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(fpath))
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+        run_fpaths = []
+        buffer = np.empty((chunk_size, n), dtype=">u2")
+        first = np.empty(chunk_size, dtype=np.int64)
+        filled = 0
+        position = 0
+        codes = set()
+
+        def flush():
+            run_fpaths.append(os.path.join(run_dir, f"{len(run_fpaths)}.npy"))
+            _write_run(buffer[:filled], first[:filled], run_fpaths[-1])
+
+        for _, _, chords in pieces:
+            chords = vocab.encode_seq(chords)
+            codes.update(np.unique(chords).tolist())
+            # like NgramModel.update: a start symbol stands for n-1 of them
+            chords = np.repeat(chords, np.where(chords == vocab.start, n - 1, 1))
+            if len(chords) < n:
+                continue
+            piece_ngrams = np.lib.stride_tricks.sliding_window_view(chords, n)
+            i = 0
+            while i < len(piece_ngrams):
+                rows = piece_ngrams[i:i + chunk_size - filled]
+                i += len(rows)
+                buffer[filled:filled + len(rows)] = rows
+                first[filled:filled + len(rows)] = np.arange(position, position + len(rows))
+                filled += len(rows)
+                position += len(rows)
+                if filled == chunk_size:
+                    flush()
+                    filled = 0
+        if filled:
+            flush()
+
+        # merge the runs into the arrays of the model, written to flat files as they grow
+        array_dtypes = {"contexts": ">u2", "offsets": np.int64, "successors": np.uint16, "counts": np.int64}
+        array_files = {name: open(os.path.join(run_dir, name), "wb") for name in array_dtypes}
+        np.zeros(1, dtype=np.int64).tofile(array_files["offsets"])
+        lengths = dict.fromkeys(array_dtypes, 0)
+        pending = {name: [] for name in array_dtypes}
+
+        def write_pending():
+            for name, values in pending.items():
+                values = np.array(values, dtype=array_dtypes[name])
+                if name == "offsets":
+                    values = lengths["successors"] + np.cumsum(values)
+                values.tofile(array_files[name])
+                lengths[name] += len(values)
+                pending[name].clear()
+
+        block_size = max(1024, chunk_size // max(1, len(run_fpaths)))
+        runs = heapq.merge(*(_read_run(run_fpath, block_size) for run_fpath in run_fpaths))
+        context, candidates = None, []
+        # (the same ngram can come from several runs: add the counts, and keep the first occurrence)
+        for ngram, group in groupby(runs, key=lambda entry: entry[0]):
+            group = list(group)
+            if ngram[:-1] != context:
+                _add_context(context, candidates, pending)
+                context, candidates = ngram[:-1], []
+                if len(pending["successors"]) >= block_size:
+                    write_pending()
+            candidates.append((min(first for _, first, _ in group), ngram[-1], sum(count for _, _, count in group)))
+        _add_context(context, candidates, pending)
+        write_pending()
+        for f in array_files.values():
+            f.close()
+        lengths["offsets"] += 1
 
-    _, chord_list = read_chord_dir(args.dir)
-    # print(chord_list)
+        arrays = {name: np.memmap(os.path.join(run_dir, name), dtype=dtype, mode="r", shape=(lengths[name],))
+                  if lengths[name] else np.zeros(0, dtype=dtype) for name, dtype in array_dtypes.items()}
+        header = {
+            "version": MODEL_VERSION,
+            "n": n,
+            "backoff": False,
+            "chords": [vocab.decode(code) for code in sorted(codes)],
+        }
+        write_packed(fpath, MODEL_MAGIC, header, arrays)
+        del arrays
+    return fpath
 
-    m = NgramModel(5, verbose=True)
-    m.update(chord_list)
+
+def main(args):
+    if args.load:
+        m = load_model(args.load, verbose=True)
+    elif args.dir and args.save and args.chunk_size:
+        # count out of core, straight into the saved model
+        vocab = ChordVocab()
+        build_model(iter_chord_dir(args.dir, vocab=vocab), 5, args.save, vocab, chunk_size=args.chunk_size)
+        m = load_model(args.save, verbose=True)
+    elif args.dir:
+        vocab = ChordVocab()
+        m = NgramModel(5, verbose=True, vocab=vocab)
+        m.update_pieces(iter_chord_dir(args.dir, vocab=vocab))
+    else:
+        return
+    if args.save:
+        m.save(args.save)
     # for x in m.ngram_counter:
     #     if x[0][0] == '<s>':
     #         print(x)
@@ -192,6 +1231,19 @@ if __name__ == "__main__":
         type=dir_path,
         help="directory path for reading chord txt files",
     )
+    parser.add_argument(
+        "--save",
+        help="filepath to save the trained model to",
+    )
+    parser.add_argument(
+        "--load",
+        help="filepath of a saved model to use instead of training one",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        help="with --save, count the ngrams on disk this many at a time instead of in memory (for corpora larger than memory)",
+    )
     args = parser.parse_args()
 
-    main(args)
\ No newline at end of file
+    main(args)
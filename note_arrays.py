@@ -0,0 +1,190 @@
+import numpy as np
+
+from functools import lru_cache
+from music21 import interval, note, pitch, stream
+
+
+# default spelling of each pitch class (index = pitch class), the way music21 spells midi pitches
+PC_NAMES = ('C', 'C#', 'D', 'E-', 'E', 'F', 'F#', 'G', 'G#', 'A', 'B-', 'B')
+
+
+class NoteArrays:
+    """ the notes of a piece as flat arrays, with one entry per sounding pitch in a measure:
+        the pitches of a chord and the pieces of a note tied over barlines are separate entries.
+        Entries are sorted the way Tune.update_chords iterates them: by part, measure, position in the measure
+        (music21's order) and pitch within a chord.
+        Times are ints in 1/grid quarter notes (grid: lcm of the quantization divisors), so that sums of durations are exact """
+    def __init__(self, grid: int, part: np.ndarray, measure: np.ndarray, offset: np.ndarray, duration: np.ndarray,
+                 pitch_class: np.ndarray, names: tuple, measure_start: np.ndarray, measure_length: np.ndarray,
+                 numerator: np.ndarray, beat_count: np.ndarray, beat_duration: np.ndarray, num_measures: np.ndarray) -> None:
+        self.grid = grid
+        # per entry: part index (0 = melody, 1 = bass), measure index (from 0), offset in the measure, duration, pitch class
+        self.part = part
+        self.measure = measure
+        self.offset = offset
+        self.duration = duration
+        self.pitch_class = pitch_class
+        # the name (spelling) of each pitch class in this piece
+        self.names = names
+        # per measure: start and length of the measure, and its time signature
+        self.measure_start = measure_start
+        self.measure_length = measure_length
+        self.numerator = numerator
+        self.beat_count = beat_count
+        self.beat_duration = beat_duration
+        # number of measures of each part
+        self.num_measures = num_measures
+
+    def __len__(self) -> int:
+        return len(self.part)
+
+
+@lru_cache(maxsize=None)
+def transposed_spelling(from_tonic: str, to_tonic: str) -> tuple:
+    """ pitch class and name of each of the 12 midi pitch classes after transposing a piece from from_tonic to to_tonic
+        with music21. returns (tuple of pitch classes indexed by the original pitch class, tuple of names
+        indexed by the new pitch class) """
+    if from_tonic == to_tonic:
+        return tuple(range(12)), PC_NAMES
+    i = interval.Interval(note.Note(from_tonic), note.Note(to_tonic))
+    transposed = []
+    for pc in range(12):
+        # pitches read from midi have an inferred spelling, which transposes differently than an explicit one
+        p = pitch.Pitch()
+        p.midi = 60 + pc
+        transposed.append(p.transpose(i))
+    names = [None] * 12
+    for p in transposed:
+        names[p.pitchClass] = p.name
+    return tuple(p.pitchClass for p in transposed), tuple(names)
+
+
+def transpose_notes(notes: NoteArrays, from_tonic: str, to_tonic: str) -> NoteArrays:
+    """ normalize the key of the notes of a midi file from from_tonic to to_tonic: a rotation of the pitch classes, spelled
+        the way transposing the music21 score would (e.g. E-, B-, A-, C#) """
+    pc_map, names = transposed_spelling(from_tonic, to_tonic)
+    return NoteArrays(notes.grid, notes.part, notes.measure, notes.offset, notes.duration,
+                      np.array(pc_map)[notes.pitch_class], names, notes.measure_start, notes.measure_length,
+                      notes.numerator, notes.beat_count, notes.beat_duration, notes.num_measures)
+
+
+def chord_unit_weights(notes: NoteArrays, chord_per_measure: bool = False):
+    """ the weighted duration of each pitch class in each chord unit (measure, or half measure if the measure has an even
+        number of beats, more than 2) of the melody (part 0) and bass (part 1), in one pass over the note arrays.
+        A note counts for its duration within its chord unit; a note of the first half that rings into the second half carries
+        the rest of its duration over. Downbeat notes, carried-over durations and bass notes get min(1 quarter, duration) more.
+        The durations are counted in ticks of the grid, so the weights are exact: a weight that music21 durations summed
+        to just below min_threshold (e.g. 0.9999999999999999) is 1.0 here, and weights that only differed by float noise tie.
+        returns the same as Tune.get_chord_weights (without the names):
+        weights: (num_units, 12) float array; order: (num_units, 12) int array of first appearance in each unit (-1 if absent) """
+    grid = notes.grid
+    num_mm = int(notes.num_measures[:2].max()) if len(notes.num_measures) else 0
+    # chord units of each measure: two halves if the measure has an even number of beats (more than 2)
+    beat_count = notes.beat_count[:num_mm]
+    halves = (notes.numerator[:num_mm] > 2) & (beat_count % 2 == 0) & (not chord_per_measure)
+    unit_length = beat_count * notes.beat_duration[:num_mm] // np.where(halves, 2, 1)
+    units_per_mm = np.where(halves, 2, 1)
+    unit_start = np.concatenate(([0], np.cumsum(units_per_mm)[:-1])).astype(int)
+    num_units = int(units_per_mm.sum())
+
+    sel = notes.part < 2
+    part, mm = notes.part[sel], notes.measure[sel]
+    offset, duration, pc = notes.offset[sel], notes.duration[sel], notes.pitch_class[sel]
+    half, unit = halves[mm], unit_length[mm]
+
+    # the offset of a note is its start within the measure (music21 beats are evenly spaced in these meters)
+    second = half & (offset >= unit)
+    dur1 = np.minimum(duration, np.where(second, 2 * unit, unit) - offset)
+    # notes in the first half that ring into the second half carry the rest of their duration over
+    carry = half & ~second & (offset + duration - unit > 0)
+    dur2 = (offset + duration - unit)[carry]
+    downbeat = (offset == 0) | (half & (offset == unit))
+    bass = part == 1
+    bonus1 = np.minimum(grid, dur1)
+    bonus2 = np.minimum(grid, dur2)
+    w1 = dur1 + bonus1 * downbeat + bonus1 * bass
+    w2 = dur2 + bonus2 + bonus2 * bass[carry]
+
+    u1 = unit_start[mm] + second
+    u2 = u1[carry] + 1
+    rows = np.concatenate((u1, u2))
+    cols = np.concatenate((pc, pc[carry]))
+    weights = np.zeros((num_units, 12), dtype=np.int64)
+    np.add.at(weights, (rows, cols), np.concatenate((w1, w2)))
+
+    # order of first appearance: update_chords counts each measure's melody notes before its bass notes
+    n = len(part)
+    processed = np.empty(n, dtype=np.int64)
+    processed[np.lexsort((np.arange(n), part, mm))] = np.arange(n)
+    first = np.full((num_units, 12), n, dtype=np.int64)
+    np.minimum.at(first, (rows, cols), np.concatenate((processed, processed[carry])))
+    present = first < n
+    # merging the bass into the melody (Counter +=) drops the pitch classes with a zero weight (grace notes)
+    both_parts = np.arange(num_mm) < notes.num_measures[:2].min()
+    unit_mm = np.repeat(np.arange(num_mm), units_per_mm)
+    present &= ~((weights == 0) & both_parts[unit_mm][:, None])
+
+    ranks = np.argsort(np.argsort(np.where(present, first, n + 1), axis=-1, kind='stable'), axis=-1, kind='stable')
+    order = np.where(present, ranks, -1).astype(np.int16)
+    return weights / grid, order
+
+
+def measure_histograms(notes: NoteArrays):
+    """ pitch class histogram of every measure (all parts), like Tune.get_mm_histograms.
+        returns a (num_measures, 12) array of the durations (in quarter notes) of each pitch class in each measure,
+        and a bool array of whether each measure has any notes """
+    num_mm = int(notes.num_measures.max()) if len(notes.num_measures) else 0
+    histograms = np.zeros((num_mm, 12))
+    np.add.at(histograms, (notes.measure, notes.pitch_class), notes.duration / notes.grid)
+    has_notes = np.bincount(notes.measure, minlength=num_mm)[:num_mm] > 0
+    return histograms, has_notes
+
+
+def score_note_arrays(score: stream.Score, grid: int) -> NoteArrays:
+    """ flatten each part of a music21 score once into NoteArrays, binning the notes into measures by their offset.
+        grid: the number of time steps per quarter note, such that every offset and duration of the score is a multiple of 1/grid.
+        The time signature of a measure is carried over from the previous measures like in Tune.update_chords
+        (melody first, then bass) """
+    parts = list(score.getElementsByClass(stream.Part))
+    part_measures = [list(part.getElementsByClass(stream.Measure)) for part in parts]
+    num_measures = np.array([len(measures) for measures in part_measures], dtype=np.int64)
+    num_mm = int(num_measures.max()) if len(num_measures) else 0
+    longest = part_measures[int(num_measures.argmax())] if num_mm else []
+
+    def to_grid(ql) -> int:
+        return int(round(float(ql) * grid))
+
+    measure_start = np.array([to_grid(mm.offset) for mm in longest], dtype=np.int64)
+    ts_columns = np.zeros((4, num_mm), dtype=np.int64)
+    ts = None
+    for i in range(num_mm):
+        for measures in part_measures[:2]:
+            if i < len(measures):
+                ts = measures[i].timeSignature or ts
+        if ts is None:
+            raise ValueError("the first measure has no time signature")
+        ts_columns[:, i] = (to_grid(ts.barDuration.quarterLength), ts.numerator, ts.beatCount,
+                            to_grid(ts.beatDuration.quarterLength))
+    measure_length, numerator, beat_count, beat_duration = ts_columns
+
+    columns = [[] for _ in range(4)]
+    pitch_class = []
+    names = list(PC_NAMES)
+    spelled = {}
+    for i, (part, measures) in enumerate(zip(parts, part_measures)):
+        starts = np.array([to_grid(mm.offset) for mm in measures], dtype=np.int64)
+        for n in part.flat.notes:
+            note_pitches = n.pitches
+            onset = to_grid(n.offset)
+            m = int(np.searchsorted(starts, onset, side='right')) - 1
+            for column, value in zip(columns, (i, m, onset - starts[m], to_grid(n.quarterLength))):
+                column.extend([value] * len(note_pitches))
+            for p in note_pitches:
+                pc = p.pitchClass
+                if spelled.setdefault(pc, p.name) != p.name:
+                    raise ValueError(f"pitch class {pc} is spelled both as {spelled[pc]} and {p.name}")
+                names[pc] = p.name
+                pitch_class.append(pc)
+    part, mm, offset, duration = (np.array(c, dtype=np.int64) for c in columns)
+    return NoteArrays(grid, part, mm, offset, duration, np.array(pitch_class, dtype=np.int64), tuple(names), measure_start,
+                      measure_length, numerator, beat_count, beat_duration, num_measures)
@@ -0,0 +1,144 @@
+import argparse
+import hashlib
+import json
+import music21
+import os
+import pickle
+import tempfile
+
+from music21 import converter
+
+
+def file_hash(fname: str) -> str:
+    """ sha256 of the content of a file """
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class ParseCache:
+    """ on-disk cache of parsed scores, as read from the midi file (not transposed), keyed by the content of the midi file
+        and the parse parameters. The pieces are normalized to a common key after reading, by rotating the extracted pitch
+        classes, so the target tonic isn't part of the key: an entry serves any target tonic, and adding it would only
+        duplicate the same score once per tonic.
+        Entries are evicted least-recently-used first once the cache grows over max_bytes. """
+    def __init__(self, cache_dir: str = "cache", max_bytes: int = 512 * 1024 * 1024) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def entry_path(self, fname: str, **params) -> str:
+        """ path of the cache entry for a midi file parsed with params;
+            the file name starts with the hash of the midi file so that all entries of a file can be invalidated together """
+        params["music21"] = music21.__version__
+        params_hash = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.cache_dir, f"{file_hash(fname)}-{params_hash[:16]}.p")
+
+    def get(self, fname: str, **params):
+        """ returns (first key tonic, parsed score) for the midi file, or None if it isn't cached;
+            the score is untransposed and still has to be normalized to the target tonic """
+        path = self.entry_path(fname, **params)
+        try:
+            with open(path, "rb") as f:
+                entry = json.loads(f.readline())
+                score = converter.thawStr(f.read())
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+            # missing or corrupt entry
+            return None
+        # mark the entry as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return entry["key"], score
+
+    def put(self, fname: str, first_key: str, score, **params) -> None:
+        """ cache the parsed, untransposed score of a midi file together with its first key tonic """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.entry_path(fname, **params)
+        # write to a temporary file first: several processes may write to the cache at the same time
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(json.dumps({"key": first_key, "midi": os.path.basename(fname)}).encode() + b"\n")
+            f.write(converter.freezeStr(score, fmt="pickle"))
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def entries(self) -> list:
+        """ list of (path, size, last used time) of all cache entries """
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for f in os.listdir(self.cache_dir):
+            if not f.endswith(".p"):
+                continue
+            path = os.path.join(self.cache_dir, f)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def evict(self) -> None:
+        """ remove least recently used entries until the cache fits in max_bytes """
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def invalidate(self, fname: str = None) -> int:
+        """ remove the entries of one midi file (all parse parameters), or every entry if fname is None.
+            returns the number of removed entries """
+        prefix = file_hash(fname) if fname else ""
+        removed = 0
+        for path, _, _ in self.entries():
+            if os.path.basename(path).startswith(prefix):
+                try:
+                    os.remove(path)
+                    removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+
+def main(args):
+    cache = ParseCache(args.cache_dir)
+    if args.clear:
+        print(f"removed {cache.invalidate()} cached scores from {args.cache_dir}")
+    for fname in args.invalidate or []:
+        print(f"removed {cache.invalidate(fname)} cached scores of {fname}")
+    entries = cache.entries()
+    print(f"{len(entries)} cached scores, {sum(size for _, size, _ in entries) / (1024 * 1024):.1f} MB in {args.cache_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default="cache",
+        help="directory of the parse cache",
+    )
+    parser.add_argument(
+        "--clear",
+        action="store_true",
+        help="remove every cached score",
+    )
+    parser.add_argument(
+        "--invalidate",
+        type=str,
+        nargs="+",
+        help="midi files whose cached scores should be removed",
+    )
+    args = parser.parse_args()
+
+    main(args)
@@ -1,29 +1,75 @@
 import argparse
+import json
+import math
 import matplotlib.pyplot as plt
+import numpy as np
 import os
+import time
 
+from chord_codes import ChordVocab
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from key_analysis import key_correlations, keys_from_correlations
+from midi_events import read_midi_notes
 from music21 import *
+from note_arrays import NoteArrays, chord_unit_weights, measure_histograms, score_note_arrays, transpose_notes
+from parse_cache import ParseCache, file_hash
+
+
+# divisors for quantizing the midi file, and the tonic that every piece is normalized to
+QUARTER_LENGTH_DIVISORS = [12, 16]
+NORMALIZED_TONIC = 'E-'
+
+# build manifest of the chords directory, recording the source and parameters of every output file
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+
+# extraction engines: music21 streams, or the note events read straight from the midi file (see midi_events)
+ENGINES = ("music21", "events")
 
 
 class Tune:
     """ class for a musical piece """
-    def __init__(self, mid_fname: str, chord_per_measure: bool = False) -> None:
+    def __init__(self, mid_fname: str, chord_per_measure: bool = False, cache: ParseCache = None, engine: str = "music21") -> None:
         # the chord_per_measure flag disgards the possible harmonic rhythm of 2+ chords per measure
         self.chord_per_measure = chord_per_measure
+        if engine not in ENGINES:
+            raise ValueError(f"unknown engine {engine}, expected one of {ENGINES}")
+        self.engine = engine
 
         self.tune_name, ext = os.path.splitext(os.path.basename(mid_fname))
-        # convert the midi file into music21 stream.Score object
-        self.score = converter.parse(mid_fname, format='midi', quarterLengthDivisors=[12,16])
-        
-        # normalize the score to a universal key
-        self.key = self.score[0][0].getElementsByClass(key.KeySignature)[0].tonic.name
-        print(f"first key: {self.key}")
-        self.normalize_score(self.score, self.key)
+        # the notes as flat arrays: the "events" engine reads them instead of building a score (it is fast enough not to need
+        # the cache), otherwise they are flattened from the score when needed
+        self.notes = None
+        # (weights, order, names) of the chord units, when update_chords computes them as arrays
+        self.chord_weights = None
+        # the parsed score may already be in the parse cache
+        # (the score is cached as parsed: the key is normalized on the extracted pitch classes, see get_note_arrays)
+        parse_params = dict(quarterLengthDivisors=QUARTER_LENGTH_DIVISORS)
+        cached = cache.get(mid_fname, **parse_params) if cache and engine == "music21" else None
+        if engine == "events":
+            self.score = None
+            self.key, self.notes = read_midi_notes(mid_fname, QUARTER_LENGTH_DIVISORS, to_tonic=NORMALIZED_TONIC)
+            print(f"first key: {self.key}")
+        elif cached:
+            self.key, self.score = cached
+            print(f"first key: {self.key} (cached)")
+        else:
+            # convert the midi file into music21 stream.Score object
+            self.score = converter.parse(mid_fname, format='midi', quarterLengthDivisors=QUARTER_LENGTH_DIVISORS)
+
+            # the first key, to normalize the piece to a universal key
+            self.key = self.score[0][0].getElementsByClass(key.KeySignature)[0].tonic.name
+            print(f"first key: {self.key}")
+            if cache:
+                cache.put(mid_fname, self.key, self.score, **parse_params)
 
         # time signature
         # NOTE: we only deal with 1 time signature per tune for now
-        self.mm_beats = self.score.getTimeSignatures()[0].barDuration.quarterLength
+        if self.notes is not None:
+            self.mm_beats = self.notes.measure_length[0] / self.notes.grid
+        else:
+            self.mm_beats = self.score.getTimeSignatures()[0].barDuration.quarterLength
         # unit in terms of quarter note to evaluate as a chord
         # (e.g. default to 4.0 -> evaluate chords per measure in 4/4 times)
 
@@ -31,46 +77,27 @@ class Tune:
         # e.g. (E: 8, G: 2.5, B: 1, F: 0.5)
         self.chords = []
 
-    def normalize_score(self, score: stream.Score, from_tonic: str, to_tonic: str = 'E-'):
-        """ normalize key to 3flats (Cm or EbM)
-            from_tonic: the first key tonic str of the piece
-            to_tonic: the string symbol for the tonic (in Major)
-        """
-        if from_tonic == to_tonic:
-            return
-        i = interval.Interval(note.Note(from_tonic), note.Note(to_tonic))
-        score.transpose(i, inPlace=True)
+    def get_mm_histograms(self):
+        """ pitch class histogram of every measure (all parts), from the flat note arrays.
+            returns a (num_measures, 12) array of the durations of each pitch class in each measure,
+            and a bool array of whether each measure has any notes """
+        return measure_histograms(self.get_note_arrays())
+
+    def get_mm_key_correlations(self):
+        """ correlation of every measure with each of the 24 keys (see key_analysis.key_correlations),
+            and a bool array of whether each measure has any notes """
+        histograms, has_notes = self.get_mm_histograms()
+        return key_correlations(histograms), has_notes
 
     def get_mm_keys(self, nc_threshold: float = 0.6):
-        """ predict the key of each measure using the analyze function from music21;
+        """ predict the key of each measure with the key profiles that music21's analyze('key') uses,
+        correlating all the measures with all 24 keys at once (see key_analysis);
         nc_threshold: threshold below which a measure will be labeled as 'NC';
         """
-        num_mm = 0
-        for part in self.score.parts:
-            num_mm = max(len(part.getElementsByClass('Measure')), num_mm)
-        # print(num_mm)
-        keys = ["<s>"]
-        # measure num starts from 1
-        for i in range(num_mm+1)[1:]:
-            mm = self.score.measure(i)
-            if len(mm.flatten().notes) == 0:
-                keys.append("NC")
-                continue
-            # analyze key for each measure
-            k = mm.analyze('key')
-            # print(i, k)
-            # if the most likely key is below nc_threshold, label the measure as "NC" (no-chord)
-            if k.correlationCoefficient < nc_threshold:
-                keys.append("NC")
-            else:            
-                # # get a list of alternativ keys above the alt_key_threshold
-                # alt_ks = list(filter(lambda ak: ak.correlationCoefficient > alt_key_threshold, k.alternateInterpretations))
-                # alt_knames = [ak.tonic.name for ak in alt_ks]
-                # # there can be multiple tags for one measure
-                # keys.append([k.tonic.name] + alt_knames)
-                keys.append(k.tonic.name)
-        keys.append("<e>")
-        return keys
+        correlations, has_notes = self.get_mm_key_correlations()
+        # if the most likely key is below nc_threshold, label the measure as "NC" (no-chord)
+        keys = keys_from_correlations(correlations, has_notes, nc_threshold=nc_threshold)
+        return ["<s>"] + keys + ["<e>"]
 
     def get_chords(self, min_threshold: float = 1.0, max_notes: int = None) -> list:
         """ get chords from counters. Each chord is represented as a list of note symbols.
@@ -86,128 +113,29 @@ class Tune:
         extracted_chords.append(['<e>'])
         return extracted_chords
 
-    def get_note_dur(self, note, downbeats: list, ts: meter.TimeSignature, isBass: bool = False) -> list:
-        """ get a note(chord)'s duration, considering added weights on downbeat and bassline notes.
-            chord_unit: float, the max duration for a note (length of a chord_unit: a measure / a half measure).
-            returns list[float]: if a note spans into the second half measure, the second element in the list is its dur to add to the second half """
-        # variables with a unit of quarterLength all start with 0
-        # chord_unit: the unit of a chord in quarterlength
-        chord_unit = ts.beatCount * ts.beatDuration.quarterLength
-        if not self.chord_per_measure and ts.numerator > 2 and ts.beatCount % 2 == 0:
-            chord_unit /= 2
-        # end tick of the first chord_unit in the measure
-        end_unit1_tick = chord_unit 
-        # end tick of the second chord_unit in the measure, if it exists
-        end_unit2_tick = chord_unit * 2 
-        # the starting tick (position) of note in quarterlength
-        start_tick = (note.beat - 1) * ts.beatDuration.quarterLength
-        
-        isDownbeat = note.beat in downbeats
-
-        # if the chord unit is the entire measure: the note duration can't exceed the remaining duration in the measure from its starting beat
-        if len(downbeats) == 1:
-            durations = [min(note.quarterLength, end_unit1_tick - start_tick)]
-        # if the note is in the second half measure: the note duration can't exceed the remaining duration in the measure from its starting beat
-        elif note.beat >= downbeats[1]:
-            durations = [min(note.quarterLength, end_unit2_tick - start_tick)]
-        # if the note is in the first half measure: the note duration can't exceed the chord unit; record carry-over
-        else:
-            dur1 = min(note.quarterLength, end_unit1_tick - start_tick)
-            # dur2: carry-over to the next half measure
-            dur2 = start_tick + note.quarterLength - end_unit1_tick
-            if dur2 <= 0:
-                durations = [dur1]
-            else: 
-                durations = [dur1, dur2]
-                # print(note, end_unit1_tick, end_unit2_tick, start_tick, note.quarterLength, dur2)
-         
-        for i, dur in enumerate(durations):
-            if isDownbeat or i == 1:
-                durations[i] += min(1, dur)
-            if isBass:
-                durations[i] += min(1, dur)
-        return durations
-
-    def count_notes(self, mm: stream.Measure, ts: meter.TimeSignature, isBass: bool = False) -> list:
-        """ count the duration for notes in a Measure (usually a chord unit in melody / bassline). 
-            returns a list of Counters - each counter is a chord.
-            If the beatCount is even in this measure, divide it in half and find chord for each half """
-        # beatCount: how many beats are there in a measure (2 for 6/8; 4 for 4/4; 3 for 3/4)
-        downbeats = [1.0]
-        counters = [Counter()]
-        if not self.chord_per_measure and ts.numerator > 2 and ts.beatCount % 2 == 0:
-            downbeats.append(ts.beatCount / 2 + 1)
-            counters.append(Counter())
-
-        # print(downbeats)
-
-        mm_notes = mm.flat.notes
-        # record each note's duration / strength
-        for note in mm_notes:
-            # print(note.beat)
-            # add notes to the appropriate counter
-            note_counts = counters[0]
-            if len(downbeats) > 1 and note.beat >= downbeats[1]:
-                note_counts = counters[1]
-
-            # note can be either a note or a chord...
-            if note.isChord:
-                # now the beat information is with the chord, but not the notes
-                durations = self.get_note_dur(note, downbeats, ts, isBass=isBass)
-                for n in note.notes:
-                    note_counts.update({n.name: durations[0]})
-                    if len(durations) > 1:
-                        counters[1].update({n.name: durations[1]})
-                    # print(n.name, durations)
-            else:
-                durations = self.get_note_dur(note, downbeats, ts, isBass=isBass)
-                note_counts.update({note.name: durations[0]})
-                if len(durations) > 1:
-                    counters[1].update({note.name: durations[1]})
-                # print(note.name, durations)
-        # print(counters)
-        return counters
+    def get_note_arrays(self) -> NoteArrays:
+        """ the notes of the piece as flat arrays (see note_arrays), read from the midi events or flattened once from the score,
+            normalized to NORMALIZED_TONIC (the pitch classes are rotated instead of transposing the score) """
+        if self.notes is None:
+            notes = score_note_arrays(self.score, math.lcm(*QUARTER_LENGTH_DIVISORS))
+            self.notes = transpose_notes(notes, self.key, NORMALIZED_TONIC)
+        return self.notes
 
     def update_chords(self):
-        """ parse chord information by counting notes per chord unit """
-        # elements in chords are note counters for each chord unit 
-        chords = []
-        # score -> parts (melody line & bass line)
-        parts = self.score.getElementsByClass(stream.Part)
-        melody_part = parts[0]
-        bass_part = parts[1]
-        # parts -> measures (melody line & bass line)
-        melody_mms = melody_part.getElementsByClass(stream.Measure)
-        bass_mms = bass_part.getElementsByClass(stream.Measure)
-
-        num_mms = max(len(melody_mms), len(bass_mms))
-
-        timesig = melody_mms.measure(1).timeSignature
-        for i in range(num_mms):
-            chord_counters = []
-
-            hasMelody = i < len(melody_mms)
-            hasBass = i < len(bass_mms)
-
-            if hasMelody:
-                mm = melody_mms[i]
-                timesig = mm.timeSignature or timesig
-                # count notes in each measure of the melody line
-                chord_counters = self.count_notes(mm, timesig)
-            if hasBass:
-                bm = bass_mms[i]
-                timesig = bm.timeSignature or timesig
-                # count notes in each measure of the bass line
-                bass_counters = self.count_notes(bm, timesig, isBass=True)
-                if chord_counters:
-                    for i, c in enumerate(bass_counters):
-                        chord_counters[i] += c
-                else:
-                    chord_counters = bass_counters
-            
-            chords += chord_counters
-
-        self.chords = chords
+        """ parse chord information by weighting the notes of the melody and bass in each chord unit
+            (see note_arrays.chord_unit_weights) """
+        notes = self.get_note_arrays()
+        if len(notes.num_measures) < 2:
+            raise ValueError(f"{self.tune_name} needs a melody and a bass part")
+        weights, order = chord_unit_weights(notes, chord_per_measure=self.chord_per_measure)
+        names = list(notes.names)
+        self.chord_weights = weights, order, names
+        # elements in chords are note counters for each chord unit
+        self.chords = []
+        for w, o in zip(weights.tolist(), order.tolist()):
+            # keep the order of first appearance, which breaks ties in Counter.most_common
+            present = sorted((rank, pc) for pc, rank in enumerate(o) if rank >= 0)
+            self.chords.append(Counter({names[pc]: w[pc] for _, pc in present}))
 
     def write(self, min_threshold: float = 1.0, max_notes: int = None):
         """ write to file;
@@ -222,8 +150,8 @@ class Tune:
         name = ("-").join([self.tune_name, thresh_suffix])
 
         f_dir = os.path.join(chords_dir, maxnotes_dir)
-        if not os.path.exists(f_dir):
-            os.mkdir(f_dir)
+        # several worker processes may be writing to the same directory
+        os.makedirs(f_dir, exist_ok=True)
         # write to file
         chord_fpath = os.path.join(f_dir, name)
         chords = self.get_chords(min_threshold=min_threshold, max_notes=max_notes)
@@ -241,11 +169,61 @@ class Tune:
                 f.write(" ".join(chord_notes))
                 f.write("\n")
 
-
-def read_chord_file(fp):
+    def get_chord_weights(self):
+        """ the weights of the chord units as arrays indexed by pitch class (0 = C), as computed by update_chords.
+            returns
+            weights: (num_units, 12) float array of the weighted duration of each pitch class;
+            order: (num_units, 12) int array with the order in which each pitch class first appeared in the unit (-1 if absent),
+                   used to break ties between equal weights the same way as Counter.most_common;
+            names: the 12 note names (spelling) used in this piece for each pitch class """
+        if self.chord_weights is None:
+            self.update_chords()
+        return self.chord_weights
+
+    def write_raw(self, chords_dir: str = "chords") -> str:
+        """ write the weighted pitch class counts of each chord unit (before any thresholding) to
+            chords_dir/raw[_per_mm]/<tune_name>.npz; every max_notes/min_threshold corpus can be derived from it.
+            Per measure, the correlations with all 24 keys are stored instead of the key names, so that the
+            nc_threshold can be chosen when reading.
+            returns the path of the written file """
+        raw_fpath = raw_file_path(self.tune_name, self.chord_per_measure, chords_dir=chords_dir)
+        os.makedirs(os.path.dirname(raw_fpath), exist_ok=True)
+
+        weights, order, names = self.get_chord_weights()
+        # key correlations of the chord units (measures)
+        correlations, has_notes = np.zeros((0, 24)), np.zeros(0, dtype=bool)
+        if self.chord_per_measure:
+            correlations, has_notes = self.get_mm_key_correlations()
+            if len(correlations) != len(weights):
+                raise ValueError(f"number of chords ({len(weights)}) not equal to number of keys per measure ({len(correlations)})")
+
+        np.savez_compressed(raw_fpath, weights=weights, order=order, names=np.array(names),
+                            key_correlations=correlations, has_notes=has_notes, chord_per_measure=self.chord_per_measure)
+        return raw_fpath
+
+
+def raw_file_path(tune_name: str, chord_per_measure: bool, chords_dir: str = "chords") -> str:
+    """ path of the raw count file of a piece (see Tune.write_raw) """
+    raw_dir = "raw"
+    if chord_per_measure:
+        raw_dir += "_per_mm"
+    return os.path.join(chords_dir, raw_dir, f"{tune_name}.npz")
+
+def chord_file_path(tune_name: str, min_threshold: float, max_notes: int, chord_per_measure: bool, chords_dir: str = "chords") -> str:
+    """ path of the chord file of a piece for a (min_threshold, max_notes) variant (see Tune.write) """
+    maxnotes_dir = f"max{max_notes}"
+    if chord_per_measure:
+        maxnotes_dir += "_per_mm"
+    name = ("-").join([tune_name, f"thresh{min_threshold}"])
+    return os.path.join(chords_dir, maxnotes_dir, name)
+
+def read_chord_file(fp, vocab: ChordVocab = None):
     """
     reads a txt file that represents a chord generated by parse_chords
     and returns 1) a list of keys; 2) a list of chord strings, each note separated by space
+    (or an int array of chord codes if a vocab is given, see chord_codes).
+    The keys were labeled 'NC' with the nc_threshold used when writing the file; to choose it at load time,
+    read the raw count file instead (see read_raw_chord_file)
     """
     keys = []
     chords = []
@@ -258,32 +236,405 @@ def read_chord_file(fp):
             notes = sorted(line_split)
         c = " ".join(notes)
         chords.append(c)
+    if vocab is not None:
+        chords = vocab.encode_seq(chords)
     return keys, chords 
 
-def read_chord_dir(directory: str):
-    """Takes a directory of chord files and appends them into one list"""
-    all_keys = []
-    all_chords = []
-    for root, dirs, files in os.walk(directory, topdown=False):
-        for filename in files:
+def iter_chord_dir(directory: str, vocab: ChordVocab = None):
+    """ generator over the chord files of a directory (and its subdirectories) in sorted order, one piece at a time:
+        yields (file name relative to directory, list of keys, chords as returned by read_chord_file) """
+    for root, dirs, files in os.walk(directory):
+        # walk the subdirectories in sorted order too
+        dirs.sort()
+        for filename in sorted(files):
             if filename.startswith('.'):
                 continue
-            with open(os.path.join(root, filename)) as fp:
-                keys, chords = read_chord_file(fp)
-                all_keys.extend(keys)
-                all_chords.extend(chords)
+            fpath = os.path.join(root, filename)
+            with open(fpath) as fp:
+                keys, chords = read_chord_file(fp, vocab=vocab)
+            yield os.path.relpath(fpath, directory), keys, chords
+
+def read_chord_dir(directory: str, vocab: ChordVocab = None):
+    """Takes a directory of chord files and appends them into one list (an int array of chord codes if a vocab is given),
+    in the order of iter_chord_dir (see read_raw_chord_dir to choose the nc_threshold at load time)"""
+    all_keys = []
+    all_chords = []
+    for _, keys, chords in iter_chord_dir(directory, vocab=vocab):
+        all_keys.extend(keys)
+        if vocab is not None:
+            all_chords.append(chords)
+        else:
+            all_chords.extend(chords)
+    if vocab is not None:
+        all_chords = np.concatenate(all_chords) if all_chords else np.zeros(0, dtype=np.int32)
+    return all_keys, all_chords
+
+def load_raw_chord_file(raw_fpath: str) -> dict:
+    """ load a .npz file written by Tune.write_raw as a dict of arrays """
+    with np.load(raw_fpath) as raw:
+        return {k: raw[k] for k in raw.files}
+
+def select_chord_notes(weights: np.ndarray, order: np.ndarray, min_threshold: float = 1.0, max_notes: int = None):
+    """ vectorized version of the thresholding and top-k in Tune.get_chords, for all chord units at once.
+        returns
+        ranked: (num_units, 12) pitch classes of each unit sorted by weight (ties: first appearance first);
+        keep: (num_units, 12) bool mask over ranked of the notes to keep """
+    present = order >= 0
+    # absent pitch classes sort last
+    sort_weights = np.where(present, weights, -np.inf)
+    sort_order = np.where(present, order, np.iinfo(order.dtype).max)
+    ranked = np.lexsort((sort_order, -sort_weights), axis=-1)
+
+    keep = np.take_along_axis(present & (weights >= min_threshold), ranked, axis=-1)
+    if max_notes is not None:
+        keep &= np.cumsum(keep, axis=-1) <= max_notes
+    return ranked, keep
+
+def raw_to_keys(raw: dict, nc_threshold: float = 0.6) -> list:
+    """ keys of the measures of a per measure piece from its raw key correlations, with <s> and <e> """
+    return ['<s>'] + keys_from_correlations(raw["key_correlations"], raw["has_notes"], nc_threshold=nc_threshold) + ['<e>']
+
+def raw_to_chords(raw: dict, min_threshold: float = 1.0, max_notes: int = None, nc_threshold: float = 0.6, sort_notes: bool = True):
+    """ derive the keys and chords of a piece from its raw counts (as loaded by load_raw_chord_file).
+        nc_threshold: correlation below which the key of a measure is labeled 'NC';
+        sort_notes: sort the notes of each chord by name (like read_chord_file) instead of by weight (like Tune.write)
+        returns 1) a list of keys (empty if the piece isn't per measure); 2) a list of lists of note names, with <s> and <e> """
+    ranked, keep = select_chord_notes(raw["weights"], raw["order"], min_threshold=min_threshold, max_notes=max_notes)
+    names = raw["names"].tolist()
+    if sort_notes:
+        # many chord units share the same set of notes: only build each distinct set once
+        codes = np.where(keep, 1 << ranked, 0).sum(axis=-1)
+        _, first_idx, inverse = np.unique(codes, return_index=True, return_inverse=True)
+        unique_chords = [sorted(names[pc] for pc in ranked[i][keep[i]]) for i in first_idx]
+        chords = [unique_chords[j] for j in inverse.ravel()]
+    else:
+        chords = [[names[pc] for pc in ranked[i][keep[i]]] for i in range(len(ranked))]
+    chords = [['<s>']] + chords + [['<e>']]
+
+    keys = []
+    if raw["chord_per_measure"]:
+        keys = raw_to_keys(raw, nc_threshold=nc_threshold)
+    return keys, chords
+
+def raw_to_codes(raw: dict, vocab: ChordVocab, min_threshold: float = 1.0, max_notes: int = None, nc_threshold: float = 0.6):
+    """ derive the keys and chord codes of a piece from its raw counts, without building the chord strings
+        (the vocab only parses the spelling of each distinct chord once).
+        returns 1) a list of keys; 2) an int array of chord codes, with the start and end codes """
+    ranked, keep = select_chord_notes(raw["weights"], raw["order"], min_threshold=min_threshold, max_notes=max_notes)
+    codes = np.where(keep, 1 << ranked.astype(np.int32), 0).sum(axis=-1, dtype=np.int32)
+    names = raw["names"].tolist()
+    for code in np.unique(codes).tolist():
+        # teach the vocab the spelling of this piece
+        vocab.encode(" ".join(sorted(names[pc] for pc in range(12) if code >> pc & 1)))
+    codes = np.concatenate(([vocab.start], codes, [vocab.end])).astype(np.int32)
+
+    keys = []
+    if raw["chord_per_measure"]:
+        keys = raw_to_keys(raw, nc_threshold=nc_threshold)
+    return keys, codes
+
+def read_raw_chord_file(raw_fpath: str, min_threshold: float = 1.0, max_notes: int = None, nc_threshold: float = 0.6,
+                        vocab: ChordVocab = None):
+    """
+    reads a raw count file written by Tune.write_raw, applying min_threshold, max_notes and nc_threshold on the fly;
+    returns the same as read_chord_file on the corresponding chord file: 1) a list of keys; 2) a list of chord strings
+    (or an int array of chord codes if a vocab is given)
+    """
+    raw = load_raw_chord_file(raw_fpath)
+    if vocab is not None:
+        return raw_to_codes(raw, vocab, min_threshold=min_threshold, max_notes=max_notes, nc_threshold=nc_threshold)
+    keys, chords = raw_to_chords(raw, min_threshold=min_threshold, max_notes=max_notes, nc_threshold=nc_threshold)
+    return keys, [" ".join(notes) for notes in chords]
+
+def iter_raw_chord_dir(directory: str, min_threshold: float = 1.0, max_notes: int = None, nc_threshold: float = 0.6,
+                       vocab: ChordVocab = None):
+    """ generator over the raw count files of a directory in sorted order, one piece at a time:
+        yields (file name, list of keys, chords as returned by read_raw_chord_file) """
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.npz'):
+            continue
+        keys, chords = read_raw_chord_file(os.path.join(directory, filename), min_threshold=min_threshold, max_notes=max_notes,
+                                           nc_threshold=nc_threshold, vocab=vocab)
+        yield filename, keys, chords
+
+def read_raw_chord_dir(directory: str, min_threshold: float = 1.0, max_notes: int = None, nc_threshold: float = 0.6,
+                       vocab: ChordVocab = None):
+    """ takes a directory of raw count files and appends the derived keys and chords into one list
+        (an int array of chord codes if a vocab is given) """
+    all_keys = []
+    all_chords = []
+    for _, keys, chords in iter_raw_chord_dir(directory, min_threshold=min_threshold, max_notes=max_notes,
+                                              nc_threshold=nc_threshold, vocab=vocab):
+        all_keys.extend(keys)
+        if vocab is not None:
+            all_chords.append(chords)
+        else:
+            all_chords.extend(chords)
+    if vocab is not None:
+        all_chords = np.concatenate(all_chords) if all_chords else np.zeros(0, dtype=np.int32)
     return all_keys, all_chords
 
-def write_midi_to_chords(fname: str, min_threshold: float = 1.0, max_notes: int = None, chord_per_measure: bool = False):
+def write_chords_from_raw(raw_fpath: str, min_threshold: float = 1.0, max_notes: int = None, chords_dir: str = "chords",
+                          nc_threshold: float = 0.6) -> str:
+    """ write the chord file of one (min_threshold, max_notes) variant from a raw count file;
+        the output is the same as Tune.write. returns the path of the written file """
+    raw = load_raw_chord_file(raw_fpath)
+    tune_name = os.path.splitext(os.path.basename(raw_fpath))[0]
+    chord_per_measure = bool(raw["chord_per_measure"])
+
+    chord_fpath = chord_file_path(tune_name, min_threshold, max_notes, chord_per_measure, chords_dir=chords_dir)
+    os.makedirs(os.path.dirname(chord_fpath), exist_ok=True)
+    keys, chords = raw_to_chords(raw, min_threshold=min_threshold, max_notes=max_notes, nc_threshold=nc_threshold, sort_notes=False)
+    with open(chord_fpath, "w") as f:
+        for i, chord_notes in enumerate(chords):
+            if chord_per_measure:
+                f.write(f"{keys[i]}: ")
+            f.write(" ".join(chord_notes))
+            f.write("\n")
+    return chord_fpath
+
+def write_raw_dir_to_chords(raw_dir: str, variants: list, chords_dir: str = "chords", nc_threshold: float = 0.6):
+    """ derive the chord files of every (min_threshold, max_notes) variant for all the raw count files in raw_dir, without parsing any midi """
+    for filename in sorted(os.listdir(raw_dir)):
+        if not filename.endswith('.npz'):
+            continue
+        for min_threshold, max_notes in variants:
+            write_chords_from_raw(os.path.join(raw_dir, filename), min_threshold=min_threshold, max_notes=max_notes, chords_dir=chords_dir,
+                                  nc_threshold=nc_threshold)
+
+def write_midi_to_chords(fname: str, min_threshold: float = 1.0, max_notes: int = None, chord_per_measure: bool = False,
+                         engine: str = "music21"):
     print(f"writing {fname} to chords with min_threshold: {min_threshold}; max_notes: {max_notes}; chord_per_measure: {chord_per_measure}")
-    tune = Tune(fname, chord_per_measure=chord_per_measure)
+    tune = Tune(fname, chord_per_measure=chord_per_measure, engine=engine)
     # tune.score.show()
     tune.update_chords()
     tune.write(min_threshold=min_threshold, max_notes=max_notes)
 
+def write_midi_variants(fname: str, variants: list, chord_per_measure: bool = False, cache: ParseCache = None,
+                        chords_dir: str = "chords", engine: str = "music21") -> list:
+    """ parse a midi file once, write its raw counts and derive one chord file per (min_threshold, max_notes) variant from them.
+        returns the paths of the written files """
+    print(f"writing {fname} to chords with variants (min_threshold, max_notes): {variants}; chord_per_measure: {chord_per_measure}")
+    tune = Tune(fname, chord_per_measure=chord_per_measure, cache=cache, engine=engine)
+    tune.update_chords()
+    outputs = [tune.write_raw(chords_dir=chords_dir)]
+    for min_threshold, max_notes in variants:
+        outputs.append(write_chords_from_raw(outputs[0], min_threshold=min_threshold, max_notes=max_notes, chords_dir=chords_dir))
+    return outputs
+
+def _write_midi_job(job: tuple) -> tuple:
+    """ worker entry point for write_midi_files_to_chords.
+        returns (fname, error message or None) so that one broken file doesn't stop the others """
+    fname, variants, chord_per_measure, cache, chords_dir, engine = job
+    try:
+        write_midi_variants(fname, variants, chord_per_measure=chord_per_measure, cache=cache, chords_dir=chords_dir,
+                            engine=engine)
+    except Exception as e:
+        return fname, f"{type(e).__name__}: {e}"
+    return fname, None
+
+def list_midi_files(midi_dir: str) -> list:
+    """ sorted list of the midi file paths in midi_dir (hidden files are skipped) """
+    fnames = []
+    for f in sorted(os.listdir(midi_dir)):
+        if f.startswith('.'):
+            continue
+        midi_filepath = os.path.join(midi_dir, f)
+        if os.path.isfile(midi_filepath):
+            fnames.append(midi_filepath)
+    return fnames
+
+def write_midi_dir_to_chords(midi_dir: str, variants: list = None, chord_per_measure: bool = False, workers: int = None,
+                             cache: ParseCache = None, engine: str = "music21") -> list:
+    """ parse every midi file in midi_dir into chords, spreading the files over a pool of worker processes.
+        variants: list of (min_threshold, max_notes) to write for each file (each file is parsed only once), defaults to [(1.0, None)];
+        workers: number of processes (defaults to the number of cpus; 1 runs everything in this process);
+        cache: optional parse cache shared by the workers;
+        engine: "music21" or "events" (see Tune);
+        returns a list of (fname, error message) for the files that failed, sorted by file name """
+    return write_midi_files_to_chords(list_midi_files(midi_dir), variants, chord_per_measure=chord_per_measure,
+                                      workers=workers, cache=cache, engine=engine)
+
+def write_midi_files_to_chords(fnames: list, variants: list = None, chord_per_measure: bool = False, workers: int = None,
+                               cache: ParseCache = None, chords_dir: str = "chords", engine: str = "music21") -> list:
+    """ parse a list of midi files into chords with a pool of worker processes (see write_midi_dir_to_chords) """
+    if variants is None:
+        variants = [(1.0, None)]
+    jobs = [(f, variants, chord_per_measure, cache, chords_dir, engine) for f in fnames]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    results = {}
+    if workers == 1 or len(jobs) <= 1:
+        for job in jobs:
+            fname, error = _write_midi_job(job)
+            results[fname] = error
+    else:
+        # submit the biggest files first so that a long piece doesn't end up running alone at the end
+        jobs.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_write_midi_job, job): job[0] for job in jobs}
+            for future in as_completed(futures):
+                try:
+                    fname, error = future.result()
+                except Exception as e:
+                    # the worker process itself died (e.g. killed / out of memory)
+                    fname, error = futures[future], f"{type(e).__name__}: {e}"
+                results[fname] = error
+
+    failures = [(fname, results[fname]) for fname in fnames if results[fname] is not None]
+    print(f"parsed {len(fnames) - len(failures)}/{len(fnames)} midi files")
+    for fname, error in failures:
+        print(f"  FAILED {fname}: {error}")
+    return failures
+
+def compare_engines(fnames: list, chord_per_measure: bool = False) -> list:
+    """ extract each midi file with both engines and check that they agree on the first key, the weights of the chord units,
+        their order of first appearance, the spelling of the notes and the key correlations of the measures.
+        returns the list of (fname, description of the first difference) """
+    differences = []
+    times = {engine: 0.0 for engine in ENGINES}
+    for fname in fnames:
+        results = {}
+        for engine in ENGINES:
+            start = time.perf_counter()
+            try:
+                tune = Tune(fname, chord_per_measure=chord_per_measure, engine=engine)
+                tune.update_chords()
+                weights, order, names = tune.get_chord_weights()
+                correlations, has_notes = tune.get_mm_key_correlations()
+            except Exception as e:
+                results[engine] = f"{type(e).__name__}: {e}"
+                continue
+            finally:
+                times[engine] += time.perf_counter() - start
+            results[engine] = tune.key, weights, order, names, correlations, has_notes
+        m21, events = (results[engine] for engine in ENGINES)
+        if isinstance(m21, str) or isinstance(events, str):
+            difference = None if m21 == events else f"errors: {m21} / {events}"
+        elif m21[0] != events[0]:
+            difference = f"first key: {m21[0]} / {events[0]}"
+        elif m21[1].shape != events[1].shape or not np.array_equal(m21[1], events[1]):
+            difference = "chord weights"
+        elif not np.array_equal(m21[2], events[2]):
+            difference = "order of the notes"
+        elif any(m21[3][pc] != events[3][pc] for pc in np.flatnonzero((m21[2] >= 0).any(axis=0))):
+            difference = f"spelling: {m21[3]} / {events[3]}"
+        elif m21[4].shape != events[4].shape or not np.allclose(m21[4], events[4]) or not np.array_equal(m21[5], events[5]):
+            difference = "key correlations"
+        else:
+            difference = None
+        if difference:
+            differences.append((fname, difference))
+    print(f"compared {len(fnames)} midi files: {len(differences)} differences; " +
+          ", ".join(f"{engine} {t:.1f}s" for engine, t in times.items()))
+    for fname, difference in differences:
+        print(f"  {fname}: {difference}")
+    return differences
+
+def load_manifest(chords_dir: str = "chords") -> dict:
+    """ load the build manifest of chords_dir (an empty one if it doesn't exist yet) """
+    manifest_fpath = os.path.join(chords_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_fpath):
+        return {"version": MANIFEST_VERSION, "sources": {}}
+    with open(manifest_fpath) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"{manifest_fpath} has version {manifest.get('version')}, expected {MANIFEST_VERSION}")
+    return manifest
+
+def save_manifest(manifest: dict, chords_dir: str = "chords"):
+    os.makedirs(chords_dir, exist_ok=True)
+    manifest_fpath = os.path.join(chords_dir, MANIFEST_NAME)
+    tmp_fpath = manifest_fpath + ".tmp"
+    with open(tmp_fpath, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_fpath, manifest_fpath)
+
+def remove_outputs(outputs: list, chords_dir: str = "chords"):
+    """ remove output files listed in the manifest (relative to chords_dir) """
+    for output in outputs:
+        try:
+            os.remove(os.path.join(chords_dir, output))
+        except FileNotFoundError:
+            pass
+
+def rebuild_chords(midi_dir: str, variants: list = None, chord_per_measure: bool = False, workers: int = None,
+                   cache: ParseCache = None, chords_dir: str = "chords", engine: str = "music21") -> list:
+    """ incrementally rebuild the chord files of midi_dir using the build manifest in chords_dir:
+        only the midi files that are new, changed, or extracted with different parameters are parsed again
+        (if only the variants changed, they are derived from the raw counts), and the outputs of midi files that were deleted are removed.
+        Extractions with and without chord_per_measure are recorded separately, so each can be rebuilt on its own.
+        returns a list of (fname, error message) for the files that failed """
+    if variants is None:
+        variants = [(1.0, None)]
+    manifest = load_manifest(chords_dir)
+    sources = manifest["sources"]
+    mode = "per_mm" if chord_per_measure else "per_unit"
+    params = {"extract": {"quarterLengthDivisors": QUARTER_LENGTH_DIVISORS, "to_tonic": NORMALIZED_TONIC, "engine": engine},
+              "variants": [list(v) for v in variants]}
+
+    # sources that were deleted from midi_dir
+    fnames = list_midi_files(midi_dir)
+    current = {os.path.basename(f): f for f in fnames}
+    for source in sorted(set(sources) - set(current)):
+        print(f"removing outputs of deleted {source}")
+        for extraction in sources[source]["extractions"].values():
+            remove_outputs(extraction["outputs"], chords_dir)
+        del sources[source]
+
+    # sources that are new or changed
+    todo = []
+    for source, fname in current.items():
+        h = file_hash(fname)
+        entry = sources.get(source)
+        if entry is None or entry["hash"] != h:
+            # the outputs of every mode are out of date
+            if entry is not None:
+                for extraction in entry["extractions"].values():
+                    remove_outputs(extraction["outputs"], chords_dir)
+            entry = sources[source] = {"hash": h, "extractions": {}}
+        extraction = entry["extractions"].get(mode)
+        if extraction is not None and extraction["params"] == params and \
+                all(os.path.exists(os.path.join(chords_dir, o)) for o in extraction["outputs"]):
+            continue
+        if extraction is not None:
+            remove_outputs(extraction["outputs"][1:], chords_dir)
+            raw_fpath = os.path.join(chords_dir, extraction["outputs"][0])
+            if extraction["params"]["extract"] == params["extract"] and os.path.exists(raw_fpath):
+                # only the variants changed: derive them from the raw counts without parsing the midi file again
+                outputs = [extraction["outputs"][0]]
+                for min_threshold, max_notes in variants:
+                    chord_fpath = write_chords_from_raw(raw_fpath, min_threshold=min_threshold, max_notes=max_notes, chords_dir=chords_dir)
+                    outputs.append(os.path.relpath(chord_fpath, chords_dir))
+                entry["extractions"][mode] = {"params": params, "outputs": outputs}
+                continue
+            remove_outputs(extraction["outputs"][:1], chords_dir)
+            del entry["extractions"][mode]
+        todo.append(fname)
+    print(f"{len(todo)}/{len(fnames)} midi files to rebuild in {midi_dir}")
+
+    failures = write_midi_files_to_chords(todo, variants, chord_per_measure=chord_per_measure, workers=workers,
+                                          cache=cache, chords_dir=chords_dir, engine=engine)
+    failed = {fname for fname, _ in failures}
+    for fname in todo:
+        if fname in failed:
+            continue
+        tune_name = os.path.splitext(os.path.basename(fname))[0]
+        outputs = [raw_file_path(tune_name, chord_per_measure, chords_dir="")]
+        outputs += [chord_file_path(tune_name, t, m, chord_per_measure, chords_dir="") for t, m in variants]
+        sources[os.path.basename(fname)]["extractions"][mode] = {"params": params, "outputs": outputs}
+    save_manifest(manifest, chords_dir)
+    return failures
+
 def main(args):
     midi_filepath = args.mid
     midi_dir = args.dir
+    raw_dir = args.raw
+    variants = [(args.min_threshold, max_notes) for max_notes in args.max_notes]
+    cache = ParseCache(args.cache, max_bytes=args.cache_size * 1024 * 1024) if args.cache else None
+    if cache and args.clear_cache:
+        print(f"removed {cache.invalidate()} cached scores from {args.cache}")
 
     # t = Tune(midi_filepath, chord_per_measure=True)
     # print(t.get_mm_keys())
@@ -292,20 +643,22 @@ def main(args):
     # print(t.chords)
     # write_midi_to_chords(midi_filepath, max_notes=5)
 
-    # if midi_filepath:                
-    #     write_midi_to_chords(midi_filepath, max_notes=5, chord_per_measure=True)
-    #     # write_midi_to_chords(midi_filepath, max_notes=5)
-    #     # write_midi_to_chords(midi_filepath)
-    # if midi_dir:
-    #     for f in os.listdir(midi_dir):
-    #         if f.startswith('.'):
-    #             continue
-    #         midi_filepath = os.path.join(midi_dir, f)
-    #         if os.path.isfile(midi_filepath):                
-    #             # write_midi_to_chords(midi_filepath, max_notes=3)
-    #             # write_midi_to_chords(midi_filepath, max_notes=3, chord_per_measure=True)
-    #             # write_midi_to_chords(midi_filepath, max_notes=5)
-    #             write_midi_to_chords(midi_filepath, chord_per_measure=True)
+    if args.check_engines:
+        fnames = [midi_filepath] if midi_filepath else list_midi_files(midi_dir or "midi")
+        compare_engines(fnames, chord_per_measure=args.per_mm)
+        return
+    if midi_filepath:
+        write_midi_variants(midi_filepath, variants, chord_per_measure=args.per_mm, cache=cache, engine=args.engine)
+    if midi_dir and args.rebuild:
+        rebuild_chords(midi_dir, variants, chord_per_measure=args.per_mm, workers=args.workers, cache=cache, engine=args.engine)
+    elif midi_dir:
+        write_midi_dir_to_chords(midi_dir, variants, chord_per_measure=args.per_mm, workers=args.workers, cache=cache,
+                                 engine=args.engine)
+    if raw_dir:
+        write_raw_dir_to_chords(raw_dir, variants, nc_threshold=args.nc_threshold)
+    if midi_filepath or midi_dir or raw_dir or args.clear_cache:
+        return
+
     for corpus in ["max3", "max3_per_mm", "max5", "max5_per_mm"]:
         print(f"for {corpus}")
         _, chords = read_chord_dir(f"chords/{corpus}")
@@ -317,6 +670,11 @@ def main(args):
         # plt.hist(chords, len(count))
         # plt.show()
     
+def max_notes_arg(string):
+    if string == "None":
+        return None
+    return int(string)
+
 def dir_path(string):
     if os.path.isdir(string):
         return string
@@ -338,6 +696,76 @@ if __name__ == "__main__":
         type=dir_path,
         help="filepath of a midi folder to parse each file in that folder into chords",
     )
+    parser.add_argument(
+        "--raw",
+        "-r",
+        type=dir_path,
+        help="folder of raw count files (e.g. chords/raw) to derive chord files from, without parsing midi",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="with --dir, only parse the midi files that changed since the last build (see chords/manifest.json)",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=None,
+        help="number of worker processes for parsing a midi folder (defaults to the number of cpus)",
+    )
+    parser.add_argument(
+        "--max-notes",
+        type=max_notes_arg,
+        nargs="+",
+        default=[None],
+        help="max number of notes per chord; several values write several corpora from one parse (use None for no limit)",
+    )
+    parser.add_argument(
+        "--min-threshold",
+        type=float,
+        default=1.0,
+        help="min weight for a note to be part of a chord",
+    )
+    parser.add_argument(
+        "--nc-threshold",
+        type=float,
+        default=0.6,
+        help="with --raw, key correlation below which a measure is labeled NC",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        default=None,
+        help="directory of a parse cache for the normalized scores (no caching if not given)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=512,
+        help="max size of the parse cache in MB; the least recently used scores are evicted first",
+    )
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="remove every score from the parse cache given by --cache",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="music21",
+        help="extract the notes with music21 streams, or read the midi events directly (much faster, same chords)",
+    )
+    parser.add_argument(
+        "--check-engines",
+        action="store_true",
+        help="extract --mid (or every file of --dir, default midi) with both engines and report any difference",
+    )
+    parser.add_argument(
+        "--per-mm",
+        action="store_true",
+        help="one chord per measure, with the key of each measure",
+    )
     args = parser.parse_args()
 
     main(args)
\ No newline at end of file
@@ -1,5 +1,6 @@
 # Consulted for generating text with an RNN: https://machinelearningmastery.com/text-generation-lstm-recurrent-neural-networks-python-keras/ 
 
+import itertools
 import parse_chords 
 import numpy
 import os
@@ -26,7 +27,7 @@ def create_datasets(notes, char_to_int, seq_length):
     return dataX, dataY
 
 def get_vocab(l):
-    """Extracts each character used in the dataset, adding a space in between each chord 
+    """Extracts each character used in the dataset (l: any iterable of chord strings), adding a space in between each chord 
     so the model can distinguish different chords. The resulting set "vocab" will likely contain
     the 12 tones used in Western music. """
     vocab = set()
@@ -78,8 +79,8 @@ def generate_output(seq_length, notelength, filename, dir, output_file):
     has already been trained. Then predicts notelength notes based on a randomly generated seed
     The resulting output is stored in output_file"""
 
-    # Read the chord dir and extract the chord sequences 
-    _, text = parse_chords.read_chord_dir(dir)
+    # Read the chord dir one piece at a time and extract the chord sequences
+    text = itertools.chain.from_iterable(chords for _, _, chords in parse_chords.iter_chord_dir(dir))
 
     # Get the total characters/vocab for the data
     vocab, total = get_vocab(text)
@@ -0,0 +1,20 @@
+import os
+import pytest
+
+from parse_chords import Tune, compare_engines
+
+MIDI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "midi")
+# a few short pieces, to keep the test fast (python parse_chords.py --check-engines compares every midi file)
+MIDI_FILES = ["Battle2.mid", "Yubaba2.mid", "The_Sixth_Station1.mid"]
+
+
+@pytest.mark.parametrize("chord_per_measure", [False, True])
+@pytest.mark.parametrize("midi_file", MIDI_FILES)
+def test_engines_agree(midi_file, chord_per_measure):
+    """ the events engine extracts the same keys and chord weights as the music21 engine """
+    fname = os.path.join(MIDI_DIR, midi_file)
+    # (compare_engines also accepts both engines failing the same way)
+    tune = Tune(fname, chord_per_measure=chord_per_measure, engine="events")
+    tune.update_chords()
+    assert len(tune.get_chord_weights()[0]) > 0
+    assert compare_engines([fname], chord_per_measure=chord_per_measure) == []